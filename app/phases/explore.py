@@ -2,7 +2,7 @@ from chatlib.chatlib.chatbot import DialogueTurn, ChatCompletionParams
 from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator, StateBasedResponseGenerator
 from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
 from chatlib.chatlib.llm.integration.openai_api import GPTChatCompletionAPI, ChatGPTModel
-from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, MapperInputOutputPair, ChatCompletionFewShotMapperParams
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, MapperInputOutputPair, ChatCompletionFewShotMapperParams, MapperCascade
 from chatlib.chatlib.tool.converter import generate_pydantic_converter
 from pydantic import BaseModel
 
@@ -84,7 +84,9 @@ summarizer = DialogueSummarizer(
 Refer to the examples below.""",
     str_output_converter=_str_to_result,
     output_str_converter=_result_to_str,
-    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 1)
+    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 1),
+    output_model=ExploreSummarizerResult,
+    cascade=MapperCascade(cheap_model=ChatGPTModel.GPT_4o_mini, escalate_if=lambda result: result.move_to_next is True, name="explore")
 )
 
 
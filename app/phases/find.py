@@ -2,8 +2,8 @@
 from chatlib.chatlib.chatbot import DialogueTurn
 from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator, StateBasedResponseGenerator
 from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
-from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, Dialogue, DialogueTurn, MapperInputOutputPair
-from chatlib.chatlib.llm.integration.openai_api import GPTChatCompletionAPI
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, Dialogue, DialogueTurn, MapperInputOutputPair, MapperCascade
+from chatlib.chatlib.llm.integration.openai_api import GPTChatCompletionAPI, ChatGPTModel
 from chatlib.chatlib.tool.converter import generate_pydantic_converter
 
 from app.common import FindDialogueSummarizerParams, FindSummarizerResult, PromptFactory, SPECIAL_TOKEN_CONFIG
@@ -52,7 +52,9 @@ summarizer = DialogueSummarizer(
     instruction_generator=_generate_instruction,
     output_str_converter=_result_to_str,
     str_output_converter=_str_to_result,
-    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 3)
+    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 3),
+    output_model=FindSummarizerResult,
+    cascade=MapperCascade(cheap_model=ChatGPTModel.GPT_4o_mini, escalate_if=lambda result: result.proceed_to_next_phase is True, name="find")
 )
 
 
@@ -33,7 +33,8 @@ Follow this JSON format:
 """,
     str_output_converter=_str_to_result,
     output_str_converter=_result_to_str,
-    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 1)
+    dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, 1),
+    output_model=HelpSummarizerResult
 )
 
 summarizer_params = ChatCompletionFewShotMapperParams(
@@ -5,7 +5,7 @@ from chatlib.chatlib.chatbot import Dialogue, DialogueTurn, RegenerateRequestExc
 from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator, StateBasedResponseGenerator
 from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
 # Help the user label their emotion based on the Wheel of Emotions. Empathize their emotion.
-from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, MapperInputOutputPair
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, MapperInputOutputPair, MapperCascade
 from chatlib.chatlib.llm.integration.openai_api import ChatGPTModel, GPTChatCompletionAPI
 from chatlib.chatlib.tool.converter import generate_pydantic_converter
 
@@ -127,7 +127,9 @@ summarizer = DialogueSummarizer(
     dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(
                              dialogue, 2),
     output_str_converter=_result_to_str,
-    str_output_converter=str_to_result
+    str_output_converter=str_to_result,
+    output_model=LabelSummarizerResult,
+    cascade=MapperCascade(cheap_model=ChatGPTModel.GPT_4o_mini, escalate_if=lambda result: result.next_phase is not None, name="label")
     )
 
 
@@ -3,9 +3,9 @@ import json
 from chatlib.chatlib.chatbot import DialogueTurn, RegenerateRequestException
 from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator, StateBasedResponseGenerator
 from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
-from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, Dialogue, DialogueTurn, MapperInputOutputPair
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, Dialogue, DialogueTurn, MapperInputOutputPair, MapperCascade
 from chatlib.chatlib.tool.converter import generate_pydantic_converter
-from chatlib.chatlib.llm.integration.openai_api import GPTChatCompletionAPI
+from chatlib.chatlib.llm.integration.openai_api import GPTChatCompletionAPI, ChatGPTModel
 
 from app.common import FindDialogueSummarizerParams, PromptFactory, SPECIAL_TOKEN_CONFIG, RecordSummarizerResult
 
@@ -77,7 +77,9 @@ summarizer = DialogueSummarizer[RecordSummarizerResult, FindDialogueSummarizerPa
     dialogue_filter=lambda dialogue, _: StateBasedResponseGenerator.trim_dialogue_recent_n_states(
                              dialogue, 3),
     output_str_converter=_result_to_str,
-    str_output_converter=_str_to_result_func
+    str_output_converter=_str_to_result_func,
+    output_model=RecordSummarizerResult,
+    cascade=MapperCascade(cheap_model=ChatGPTModel.GPT_4o_mini, escalate_if=lambda result: result.proceed_to_next_phase is True, name="record")
 )
      
 
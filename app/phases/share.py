@@ -49,5 +49,6 @@ summarizer = DialogueSummarizer[ShareSummarizerResult, FindDialogueSummarizerPar
     instruction_generator=_generate_instruction,
     output_str_converter=_result_to_str,
     str_output_converter=_str_to_result,
-    dialogue_filter=lambda dialogue, params: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, N=1)
+    dialogue_filter=lambda dialogue, params: StateBasedResponseGenerator.trim_dialogue_recent_n_states(dialogue, N=1),
+    output_model=ShareSummarizerResult
 )
\ No newline at end of file
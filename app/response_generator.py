@@ -1,8 +1,12 @@
+from typing import Any
+
 from chatlib.chatlib.utils import dict_utils
 from chatlib.chatlib.chatbot import ResponseGenerator, Dialogue, dialogue_utils
 from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator, StateBasedResponseGenerator, StateType
 from chatlib.chatlib.chatbot.dialogue_to_csv import DialogueCSVWriter, TurnValueExtractor
 from chatlib.chatlib.chatbot.message_transformer import SpecialTokenExtractionTransformer
+from chatlib.chatlib.tool.fused_summarizer import FusedSummarizer, FusedSummarizerTask
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, MapperInputOutputPair, IncrementalSummaryState
 
 from app.common import EmotionChatbotPhase, SPECIAL_TOKEN_REGEX, SPECIAL_TOKEN_CONFIG, ChatbotLocale, FindDialogueSummarizerParams
 import app.common
@@ -15,7 +19,23 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
                  user_name: str | None = None,
                  user_age: int = None,
                  locale: ChatbotLocale = ChatbotLocale.Korean,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 fused_summarization: bool = False,
+                 incremental_summarization: bool = False,
+                 summarizer_cascade: bool = False):
+        """
+        :param fused_summarization: If True, the help summarizer and the current phase's summarizer are run in a
+        single request, falling back to separate requests if the fused output fails validation.
+        :param incremental_summarization: If True, the phase summarizers receive their previous result and only the
+        turns added since then. The states are kept in memory, so the first evaluation after a restore is a full one.
+        :param summarizer_cascade: If True, the phase summarizers ask a cheap model first and escalate to their own
+        model only for low-confidence outputs and proposed transitions. Off until its agreement with the full model
+        is measured, since it decides the phase transitions. Not available with fused_summarization, whose single
+        request goes to the summarizers' own model.
+        """
+        if fused_summarization and summarizer_cascade:
+            raise ValueError("summarizer_cascade cannot be combined with fused_summarization.")
+
         super().__init__(initial_state=EmotionChatbotPhase.Explore,
                          verbose=verbose,
                          message_transformers=[
@@ -28,6 +48,10 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
         self.__user_age = user_age
         self.__locale = locale
 
+        self.__fused_summarizer = FusedSummarizer() if fused_summarization else None
+        self.__summary_states: dict[EmotionChatbotPhase, IncrementalSummaryState | None] | None = dict() if incremental_summarization else None
+        self.__summarizer_cascade = summarizer_cascade
+
         self.__generators: dict[EmotionChatbotPhase, ChatGPTResponseGenerator] = dict()
 
         self.__generators[EmotionChatbotPhase.Explore] = explore.create_generator()
@@ -94,6 +118,34 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
         if isinstance(generator, ChatGPTResponseGenerator) and payload is not None:
             generator.update_instruction_parameters(dict(summarizer_result=payload))
 
+    def __get_phase_summarizer(self, current: EmotionChatbotPhase, current_state_ai_turns: Dialogue) -> tuple[
+                            DialogueSummarizer, list[MapperInputOutputPair] | None, Any] | None:
+        phase_summarizer = self.__get_phase_summarizer_impl(current, current_state_ai_turns)
+        if phase_summarizer is not None:
+            summarizer, examples, params = phase_summarizer
+            return summarizer, examples, params.model_copy(update=dict(use_cascade=self.__summarizer_cascade))
+        return None
+
+    def __get_phase_summarizer_impl(self, current: EmotionChatbotPhase, current_state_ai_turns: Dialogue) -> tuple[
+                            DialogueSummarizer, list[MapperInputOutputPair] | None, Any] | None:
+        if current == EmotionChatbotPhase.Explore:
+            # Minimum 3 rapport building conversation turns
+            if len(current_state_ai_turns) >= 2:
+                return explore.summarizer, explore.summarizer_examples, explore.summarizer_params
+        elif current == EmotionChatbotPhase.Label:
+            return label.summarizer, label.summarizer_examples, app.common.LabelDialogueSummarizerParams(
+                key_episode=self._get_memoized_payload(EmotionChatbotPhase.Explore)["key_episode"],
+                user_emotion=self._get_memoized_payload(EmotionChatbotPhase.Explore)["user_emotion"],
+            )
+        elif current == EmotionChatbotPhase.Find or current == EmotionChatbotPhase.Record:
+            return (find.summarizer if current == EmotionChatbotPhase.Find else record.summarizer,
+                    find.summarizer_examples if current == EmotionChatbotPhase.Find else record.summarizer_examples,
+                    FindDialogueSummarizerParams(
+                        key_episode=self._get_memoized_payload(EmotionChatbotPhase.Explore)["key_episode"],
+                        identified_emotions=self._get_memoized_payload(EmotionChatbotPhase.Label)[
+                            "identified_emotions"]))
+        return None
+
     async def calc_next_state_info(self, current: EmotionChatbotPhase, dialog: Dialogue) -> tuple[
                                                                                                 EmotionChatbotPhase | None, dict | None] | None:
 
@@ -105,16 +157,43 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
 
         if len(dialog) == 0:
             return None
+
+        phase_summarizer = self.__get_phase_summarizer(current, current_state_ai_turns)
+        phase_summarizer_result = None
+
         # Check if the user expressed sensitive topics
-        summarizer_result = await help.summarizer.run(None, dialog, help.summarizer_params)
+        if self.__fused_summarizer is not None and phase_summarizer is not None:
+            summarizer, examples, params = phase_summarizer
+            # The help task reads the phase summarizer's dialogue window, which contains the current phase.
+            results = await self.__fused_summarizer.run([
+                FusedSummarizerTask(name=str(current), mapper=summarizer, params=params, examples=examples),
+                FusedSummarizerTask(name=str(EmotionChatbotPhase.Help), mapper=help.summarizer,
+                                    params=help.summarizer_params, use_shared_input=True)
+            ], dialog)
+            summarizer_result = results[str(EmotionChatbotPhase.Help)]
+            phase_summarizer_result = results[str(current)]
+            if self.__summary_states is not None:
+                # The fused result covers the whole window, so the next incremental run continues from it.
+                self.__summary_states[current] = summarizer.make_incremental_summary_state(
+                    dialog, phase_summarizer_result, params)
+        else:
+            summarizer_result = await help.summarizer.run(None, dialog, help.summarizer_params)
+
         if summarizer_result.sensitive_topic is True:
             return EmotionChatbotPhase.Help, None
 
+        if phase_summarizer is not None and phase_summarizer_result is None:
+            summarizer, examples, params = phase_summarizer
+            if self.__summary_states is not None:
+                phase_summarizer_result, self.__summary_states[current] = await summarizer.run_incremental(
+                    examples, dialog, params, self.__summary_states.get(current))
+            else:
+                phase_summarizer_result = await summarizer.run(examples, dialog, params)
+
         # Explore --> Label
         if current == EmotionChatbotPhase.Explore:
-            # Minimum 3 rapport building conversation turns
-            if len(current_state_ai_turns) >= 2:
-                summarizer_result = await explore.summarizer.run(explore.summarizer_examples, dialog, explore.summarizer_params)
+            if phase_summarizer_result is not None:
+                summarizer_result = phase_summarizer_result
                 print(summarizer_result)
                 # print(f"Phase suggestion: {phase_suggestion}")
                 if summarizer_result.move_to_next is True:
@@ -124,16 +203,7 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
         # Label --> Find OR Record
         elif current == EmotionChatbotPhase.Label:
             print("Current AI turns: ", len(current_state_ai_turns))
-            summarizer_result = \
-                await label.summarizer.run(label.summarizer_examples, 
-                                            dialog, app.common.LabelDialogueSummarizerParams(
-                                            key_episode=self._get_memoized_payload(
-                                            EmotionChatbotPhase.Explore)[
-                                                                   "key_episode"],
-                                                               user_emotion=self._get_memoized_payload(
-                                                                   EmotionChatbotPhase.Explore)[
-                                                                   "user_emotion"],
-                                                           ))
+            summarizer_result = phase_summarizer_result
             print(summarizer_result)
 
             if summarizer_result.next_phase == "find":
@@ -146,17 +216,7 @@ class EmotionChatbotResponseGenerator(StateBasedResponseGenerator[EmotionChatbot
                 return None, summarizer_result.model_dump()
         # Find/Record --> Share
         elif current == EmotionChatbotPhase.Find or current == EmotionChatbotPhase.Record:
-
-            summarizer = find.summarizer if current == EmotionChatbotPhase.Find else record.summarizer
-            summarizer_result = await summarizer.run(find.summarizer_examples if current == EmotionChatbotPhase.Find else record.summarizer_examples, dialog,
-                                                     FindDialogueSummarizerParams(
-                                                             key_episode=
-                                                             self._get_memoized_payload(
-                                                                 EmotionChatbotPhase.Explore)[
-                                                                 "key_episode"],
-                                                             identified_emotions=self._get_memoized_payload(
-                                                                 EmotionChatbotPhase.Label)[
-                                                                 "identified_emotions"]))
+            summarizer_result = phase_summarizer_result
             print(summarizer_result)
             if summarizer_result.proceed_to_next_phase is True and len(
                     current_state_ai_turns) >= 2:
@@ -1,24 +1,59 @@
+import asyncio
+from contextlib import asynccontextmanager
 from io import StringIO
-from typing import Optional, Any
-
-from fastapi import APIRouter, HTTPException, Path
-from pydantic import BaseModel
+from os import getenv, getpid
+from socket import gethostname
+from typing import Optional, Any, AsyncIterator, Callable
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+from fastapi import APIRouter, HTTPException, Path, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, ValidationError
 from starlette import status
 from fastapi.responses import StreamingResponse
 
 from app.common import ChatbotLocale
 from app.response_generator import EmotionChatbotResponseGenerator
 from chatlib.chatlib.chatbot import TurnTakingChatSession, session_writer, DialogueTurn
+from chatlib.chatlib.chatbot.async_session_writer import get_async_session_writer
+from chatlib.chatlib.chatbot.session_cache import ChatSessionCache, ChatSessionCacheStats
+from chatlib.chatlib.chatbot.session_lease import SessionLeaseManagerBase, LocalSessionLeaseManager, \
+    SqliteSessionLeaseManager, SessionLease, SessionLeaseTimeoutError
+from chatlib.chatlib.chatbot.session_writer import WriteBehindSessionWriter
+from chatlib.chatlib.chatbot.sqlite_session_writer import SqliteSessionWriter
 
 router = APIRouter()
 
-active_sessions: dict[str, TurnTakingChatSession] = dict()
+# A SQLite store can be shared by several worker processes, which take a lease on a session to change it.
+# The other stores keep per-process state, so they support a single worker only.
+session_store = session_writer.base if isinstance(session_writer, WriteBehindSessionWriter) else session_writer
+is_session_store_shared = isinstance(session_store, SqliteSessionWriter)
+session_lease_manager: SessionLeaseManagerBase = SqliteSessionLeaseManager(session_store.db_path) \
+    if is_session_store_shared else LocalSessionLeaseManager()
+
+WORKER_ID = f"{gethostname()}:{getpid()}:{uuid4().hex[:8]}"
+SESSION_LEASE_TTL_SECONDS = 30
+SESSION_LEASE_TIMEOUT_SECONDS = 60
+
+# Serializes the requests that change a session within this worker. A lock lives while a request holds or awaits it.
+_session_locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+
+# Sessions beyond these limits or idle for the TTL are saved and dropped from memory, and restored on the next access.
+session_cache: ChatSessionCache[TurnTakingChatSession] = ChatSessionCache(
+    max_sessions=int(getenv("SESSION_CACHE_MAX_SESSIONS", 1000)),
+    max_bytes=int(float(getenv("SESSION_CACHE_MAX_MB")) * 1024 * 1024) if getenv("SESSION_CACHE_MAX_MB") else None,
+    idle_ttl=float(getenv("SESSION_CACHE_IDLE_TTL_SECONDS", 1800)),
+    # Another worker may have changed a session since this worker last saved it.
+    save_on_hibernate=not is_session_store_shared)
+
+async_session_writer = get_async_session_writer(session_writer)
 
 
-def _restore_session_instance(session_id: str) -> TurnTakingChatSession | None:
-    if session_writer.exists(session_id):
+async def _restore_session_instance(session_id: str) -> TurnTakingChatSession | None:
+    if await async_session_writer.exists(session_id):
         session = TurnTakingChatSession(session_id, EmotionChatbotResponseGenerator())
-        if session.load():
+        if await session.load_async():
             return session
         else:
             return None
@@ -26,13 +61,19 @@ def _restore_session_instance(session_id: str) -> TurnTakingChatSession | None:
         return None
 
 
-def _assert_get_session(session_id: str) -> TurnTakingChatSession:
-    if session_id in active_sessions and active_sessions[session_id] is not None:
-        return active_sessions[session_id]
+async def _assert_get_session(session_id: str, version: int | None = None) -> TurnTakingChatSession:
+    """
+    :param version: Current version of the session. If not given, it is looked up from the lease manager.
+    """
+    if version is None:
+        version = await session_lease_manager.get_version_async(session_id)
+    session = await session_cache.get(session_id, version)
+    if session is not None:
+        return session
     else:
-        instance = _restore_session_instance(session_id)
+        instance = await _restore_session_instance(session_id)
         if instance is not None:
-            active_sessions[session_id] = instance
+            await session_cache.put(session_id, instance, version)
             return instance
         else:
             raise HTTPException(
@@ -41,6 +82,39 @@ def _assert_get_session(session_id: str) -> TurnTakingChatSession:
             )
 
 
+def _get_session_lock(session_id: str) -> asyncio.Lock:
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _session_locks[session_id] = lock
+    return lock
+
+
+@asynccontextmanager
+async def _lease_session(session_id: str) -> AsyncIterator[SessionLease]:
+    """
+    Hold the lock and the lease of a session while changing it. The changes are flushed before the lease is released,
+    so that the worker that takes the session over next reads them from the store.
+    Releasing the lease changes the version, so another worker serving the session next reloads it even if it has it
+    cached. Handoffs are cheap only if the requests of a session mostly reach the same worker.
+    """
+    async with _get_session_lock(session_id):
+        try:
+            async with session_lease_manager.hold(session_id, WORKER_ID, SESSION_LEASE_TTL_SECONDS,
+                                                  SESSION_LEASE_TIMEOUT_SECONDS) as lease:
+                with session_cache.pin(session_id):
+                    try:
+                        yield lease
+                    finally:
+                        await async_session_writer.flush(session_id)
+        except SessionLeaseTimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The session is busy."
+            )
+        session_cache.update_version(session_id, lease.released_version)
+
+
 # APIs==========================================================================================
 
 class ChatMessage(BaseModel):
@@ -70,73 +144,235 @@ class ChatSessionInitializeArgs(BaseModel):
 
 
 @router.get("/sessions/{session_id}/info", response_model=ChatSessionInitializeArgs)
-def get_messages(session_id: str = Path(...)):
-    session = _assert_get_session(session_id)
+async def get_messages(session_id: str = Path(...)):
+    session = await _assert_get_session(session_id)
     gen: EmotionChatbotResponseGenerator = session.response_generator
     return ChatSessionInitializeArgs(user_age=gen.user_age, user_name=gen.user_name, locale=gen.locale)
 
 
 @router.get("/sessions/{session_id}/messages")
-async def get_messages(session_id: str = Path(...)) -> list[ChatMessage]:
-    session = _assert_get_session(session_id)
-    return [ChatMessage.from_turn(turn) for turn in session.dialog]
+async def get_messages(session_id: str = Path(...), recent: int | None = None,
+                       after: str | None = None) -> list[ChatMessage]:
+    """
+    :param recent: If set, only the last messages of this number.
+    :param after: If set, only the messages after the message with this ID.
+    """
+    if session_id not in session_cache and (recent is not None or after is not None):
+        # Read the requested part from the storage without restoring the whole session.
+        if await async_session_writer.exists(session_id):
+            if after is not None:
+                dialogue = await async_session_writer.read_turns_after(session_id, after)
+            else:
+                dialogue = await async_session_writer.read_recent_turns(session_id, recent)
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="No sessions with that ID."
+            )
+    else:
+        session = await _assert_get_session(session_id)
+        dialogue = session.dialog
+        if after is not None:
+            ids = [turn.id for turn in dialogue]
+            dialogue = dialogue[ids.index(after) + 1:] if after in ids else None
+        if recent is not None and dialogue is not None:
+            dialogue = dialogue[max(0, len(dialogue) - recent):]
+
+    if dialogue is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No messages with that ID."
+        )
+    return [ChatMessage.from_turn(turn) for turn in dialogue]
 
 
 @router.post("/sessions/{session_id}/initialize", response_model=ChatMessage)
 async def _initialize_chat_session(args: ChatSessionInitializeArgs, session_id: str = Path(...)):
-    if session_id in active_sessions and active_sessions[session_id] is not None:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="Duplicate active session ID."
-        )
-    else:
+    async with _lease_session(session_id) as lease:
+        # A hibernated session, or one stored by another worker, is not in the cache but still exists.
+        if session_id in session_cache or await async_session_writer.exists(session_id):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Duplicate active session ID."
+            )
+
         print(f"Initialize session - ID: {session_id} // Name: {args.user_name} // Age: {args.user_age} // Locale: {args.locale}")
         new_session = TurnTakingChatSession(session_id,
                                             EmotionChatbotResponseGenerator(user_name=args.user_name,
                                                                             user_age=args.user_age,
                                                                             locale=args.locale))
-        active_sessions[session_id] = new_session
+        await session_cache.put(session_id, new_session, lease.version)
         system_turn = await new_session.initialize()
 
-        new_session.save()
+        await new_session.save_async()
 
-        return ChatMessage.from_turn(system_turn)
+    return ChatMessage.from_turn(system_turn)
 
 
 @router.post("/sessions/{session_id}/terminate")
-def _terminate_chat_session(session_id: str = Path(...)):
-    if session_id in active_sessions:
-        del active_sessions[session_id]
+async def _terminate_chat_session(session_id: str = Path(...)):
+    async with _lease_session(session_id):
+        session = session_cache.remove(session_id)
+        if session is not None:
+            # Every change was saved as it was made, and the dropped instance must not overwrite the changes that
+            # another worker stores later.
+            session.detach_writer()
 
 
 @router.post("/sessions/{session_id}/message", response_model=ChatMessage)
 async def user_message(args: ChatMessage, session_id: str = Path(...)):
-    session = _assert_get_session(session_id)
-
-    system_turn = await session.push_user_message(DialogueTurn(
-        message=args.message,
-        metadata=args.metadata,
-        id=args.id,
-        is_user=args.is_user,
-        processing_time=args.processing_time
-    ))
+    async with _lease_session(session_id) as lease:
+        session = await _assert_get_session(session_id, lease.version)
+
+        system_turn = await session.push_user_message(DialogueTurn(
+            message=args.message,
+            metadata=args.metadata,
+            id=args.id,
+            is_user=args.is_user,
+            processing_time=args.processing_time
+        ))
     return ChatMessage.from_turn(system_turn)
 
 
 @router.post("/sessions/{session_id}/regenerate", response_model=ChatMessage)
 async def regenerate_last_system_message(session_id: str = Path(...)):
-    session = _assert_get_session(session_id)
+    async with _lease_session(session_id) as lease:
+        session = await _assert_get_session(session_id, lease.version)
 
-    system_turn = await session.regenerate_last_system_message()
+        system_turn = await session.regenerate_last_system_message()
     if system_turn is not None:
         return ChatMessage.from_turn(system_turn) if system_turn is not None else None
     else:
         return None
 
 
+class ChatSocketUserMessage(BaseModel):
+    id: str
+    message: str
+    metadata: dict | None = None
+    processing_time: float | None = None
+
+
+# Close code of a WebSocket connected to a missing session, in the application range of 4000-4999.
+WEBSOCKET_CLOSE_SESSION_NOT_FOUND = 4404
+
+
+async def _serve_socket_request(session_id: str, request: dict, emit: Callable[[dict], None]):
+    reply_to = request.get("id")
+
+    def emit_event(event_type: str, **fields):
+        emit(dict(type=event_type, reply_to=reply_to, **fields))
+
+    try:
+        if request.get("type") == "message":
+            args = ChatSocketUserMessage.model_validate(request)
+        elif request.get("type") != "regenerate":
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown request type: {request.get('type')}"
+            )
+
+        async with _lease_session(session_id) as lease:
+            session = await _assert_get_session(session_id, lease.version)
+            generator: EmotionChatbotResponseGenerator = session.response_generator
+            state = generator.current_state
+
+            def emit_state_transition():
+                nonlocal state
+                if generator.current_state != state:
+                    state = generator.current_state
+                    emit_event("state", state=state, payload=jsonable_encoder(generator.current_state_payload))
+
+            def on_delta(delta: str | None):
+                if delta is None:
+                    emit_event("discard")
+                    return
+                # The state is decided before the response is generated.
+                emit_state_transition()
+                emit_event("delta", delta=delta)
+
+            if request.get("type") == "message":
+                system_turn = await session.push_user_message(DialogueTurn(
+                    message=args.message,
+                    metadata=args.metadata,
+                    id=args.id,
+                    is_user=True,
+                    processing_time=args.processing_time
+                ), on_delta=on_delta)
+            else:
+                system_turn = await session.regenerate_last_system_message(on_delta=on_delta)
+            emit_state_transition()
+
+        emit_event("turn", turn=jsonable_encoder(ChatMessage.from_turn(system_turn))
+                   if system_turn is not None else None)
+    except ValidationError as e:
+        emit_event("error", status=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=jsonable_encoder(e.errors()))
+    except HTTPException as e:
+        emit_event("error", status=e.status_code, detail=e.detail)
+    except Exception as e:
+        print(f"Error while serving a socket request of session {session_id} - {e}")
+        emit_event("error", status=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+
+@router.websocket("/sessions/{session_id}/ws")
+async def chat_session_socket(websocket: WebSocket, session_id: str = Path(...)):
+    """
+    Serves the messages of an initialized session over a single connection, with the same semantics as the REST APIs.
+    Requests: {"type": "message", "id", "message", "metadata"?, "processing_time"?} or {"type": "regenerate", "id"?}.
+    Events, each with the "reply_to" ID of its request: "delta" with a part of the system message being generated,
+    "discard" when the deltas received so far are dropped because the message is generated again, "state" when the
+    phase changes, "turn" with the final system message, and "error" with the HTTP status and detail.
+    """
+    await websocket.accept()
+    try:
+        await _assert_get_session(session_id)
+    except HTTPException as e:
+        await websocket.close(code=WEBSOCKET_CLOSE_SESSION_NOT_FOUND, reason=e.detail)
+        return
+
+    # Deltas are emitted synchronously from the generator, and a socket must not be sent to concurrently,
+    # so every event is queued and sent by a single task.
+    events: asyncio.Queue[dict | None] = asyncio.Queue()
+
+    async def send_events():
+        event = await events.get()
+        while event is not None:
+            following = events.get_nowait() if not events.empty() else False
+            # Deltas that piled up while the previous event was being sent are merged into a single frame.
+            while (following and event["type"] == following["type"] == "delta"
+                   and event["reply_to"] == following["reply_to"]):
+                event = dict(event, delta=event["delta"] + following["delta"])
+                following = events.get_nowait() if not events.empty() else False
+            await websocket.send_json(event)
+            event = following if following is not False else await events.get()
+
+    sender = asyncio.create_task(send_events())
+    try:
+        while not sender.done():
+            try:
+                request = await websocket.receive_json()
+            except ValueError:
+                request = None
+            if isinstance(request, dict):
+                await _serve_socket_request(session_id, request, events.put_nowait)
+            else:
+                events.put_nowait(dict(type="error", reply_to=None, status=status.HTTP_400_BAD_REQUEST,
+                                       detail="A request must be a JSON object."))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        events.put_nowait(None)
+        await asyncio.gather(sender, return_exceptions=True)
+
+
+@router.get("/session_cache/stats", response_model=ChatSessionCacheStats)
+def get_session_cache_stats():
+    return session_cache.stats
+
+
 @router.get("/sessions/{session_id}/download_csv")
 async def download_csv(session_id: str = Path(...), timezone: str | None = None):
-    session = _assert_get_session(session_id)
+    session = await _assert_get_session(session_id)
 
     writer = EmotionChatbotResponseGenerator.get_csv_writer(session_id)
     csv_string = writer.to_csv_string(session.dialog, dict(timezone=timezone))
@@ -1,4 +1,5 @@
-from os import path, getcwd
+import asyncio
+from os import path, getcwd, getenv
 from time import perf_counter
 
 from fastapi import FastAPI, Request, status
@@ -6,36 +7,81 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 
-from starlette.responses import HTMLResponse, FileResponse
-from starlette.staticfiles import StaticFiles
-from re import compile
-
 from backend.routers import chat
+from backend.static_frontend import StaticFrontend
+from chatlib.chatlib.chatbot.async_session_writer import get_async_session_writer
+from chatlib.chatlib.chatbot.session_writer import session_writer, WriteBehindSessionWriter, SessionFileWriter
 
 app = FastAPI()
 
 app.include_router(chat.router, prefix="/api/v1/chat")
 
-##########################################################
 
-asset_path_regex = compile("\.[a-z][a-z0-9]+$")
+# Archives the sessions idle for this number of days. Disabled if not set.
+session_archive_idle_days = getenv("SESSION_ARCHIVE_IDLE_DAYS")
+SESSION_ARCHIVE_INTERVAL_SECONDS = 3600
+
+
+async def archive_idle_sessions_periodically(store: SessionFileWriter, idle_seconds: float):
+    while True:
+        await asyncio.sleep(SESSION_ARCHIVE_INTERVAL_SECONDS)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, store.archive_idle_sessions, idle_seconds, set(chat.session_cache.session_ids))
+            if result.num_archived > 0:
+                print(result)
+        except Exception as e:
+            print(f"Error while archiving idle sessions - {e}")
+
+
+SESSION_CACHE_SWEEP_INTERVAL_SECONDS = 60
+
+
+async def hibernate_idle_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_CACHE_SWEEP_INTERVAL_SECONDS)
+        try:
+            if await chat.session_cache.hibernate_idle_sessions() > 0:
+                print(chat.session_cache.stats)
+        except Exception as e:
+            print(f"Error while hibernating idle sessions - {e}")
+
+
+@app.on_event("startup")
+async def start_session_cache_sweeping():
+    app.state.session_cache_sweep_task = asyncio.create_task(hibernate_idle_sessions_periodically())
+
+
+@app.on_event("startup")
+async def start_session_archiving():
+    store = session_writer.base if isinstance(session_writer, WriteBehindSessionWriter) else session_writer
+    if session_archive_idle_days is not None and isinstance(store, SessionFileWriter):
+        app.state.session_archive_task = asyncio.create_task(
+            archive_idle_sessions_periodically(store, float(session_archive_idle_days) * 86400))
+
+
+@app.on_event("shutdown")
+async def flush_session_writes():
+    await chat.session_cache.clear()
+    get_async_session_writer(session_writer).shutdown()
+    if isinstance(session_writer, WriteBehindSessionWriter):
+        session_writer.close()
+
+##########################################################
 
 static_frontend_path = path.join(getcwd(), "frontend/dist")
 if path.exists(static_frontend_path):
-    @app.get("/{rest_of_path:path}", response_class=HTMLResponse)
-    def redirect_frontend_nested_url(*, rest_of_path: str):
+    static_frontend = StaticFrontend(static_frontend_path)
 
-        if len(asset_path_regex.findall(rest_of_path)) > 0:
-            # This is a static asset file path.
-            return FileResponse(path.join(static_frontend_path, rest_of_path))
-        else:
-            return HTMLResponse(
-                status_code=200,
-                content=open(path.join(static_frontend_path, "index.html")).read()
-            )
+    @app.on_event("startup")
+    async def preload_static_frontend():
+        num_files = await asyncio.get_running_loop().run_in_executor(None, static_frontend.preload)
+        print(f"Loaded {num_files} static frontend file(s).")
 
+    @app.get("/{rest_of_path:path}")
+    async def redirect_frontend_nested_url(request: Request, rest_of_path: str):
+        return await static_frontend.get_response(rest_of_path, request.headers)
 
-    app.mount("/", StaticFiles(directory=static_frontend_path, html=True), name="static")
     print("Compiled static frontend file path was found. Mount the file.")
 
 #############################################
@@ -0,0 +1,182 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+from dataclasses import dataclass
+from os import path, stat, walk, sep
+from re import compile
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+asset_path_regex = compile(r"\.[a-z][a-z0-9]+$")
+
+# Parcel names the bundles it emits with a content hash, e.g., index.1a2b3c4d.js, so they never change.
+hashed_asset_path_regex = compile(r"\.[0-9a-f]{8}\.[a-z][a-z0-9]+$")
+
+compressible_media_type_regex = compile(r"^(text/|application/(javascript|json|xml|manifest\+json)|image/svg\+xml)")
+MIN_COMPRESSIBLE_BYTES = 256
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+IDENTITY = "identity"
+
+
+def _compress_brotli(content: bytes) -> bytes:
+    return brotli.compress(content, quality=11)
+
+
+def _compress_gzip(content: bytes) -> bytes:
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+# In order of preference. Files with these extensions next to an asset, if not older, are used instead of compressing.
+_compressors = ({"br": (".br", _compress_brotli)} if brotli is not None else {}) | {"gzip": (".gz", _compress_gzip)}
+
+
+@dataclass(frozen=True)
+class StaticFile:
+    file_path: str
+    mtime_ns: int
+    size: int
+    media_type: str
+    cache_control: str
+    variants: dict[str, tuple[bytes, str]]  # content coding => (content, ETag)
+
+
+def _read_precompressed_file(file_path: str, mtime_ns: int) -> bytes | None:
+    try:
+        if stat(file_path).st_mtime_ns >= mtime_ns:
+            with open(file_path, "rb") as f:
+                return f.read()
+    except OSError:
+        pass
+    return None
+
+
+def load_static_file(file_path: str) -> StaticFile:
+    """
+    Read a file with its compressed variants, each with a strong ETag derived from the content.
+    """
+    file_stat = stat(file_path)  # Before reading, so that a change during the read shows on the next check.
+    with open(file_path, "rb") as f:
+        content = f.read()
+
+    digest = hashlib.sha256(content).hexdigest()[:32]
+    media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    variants = {IDENTITY: (content, f'"{digest}"')}
+    if len(content) >= MIN_COMPRESSIBLE_BYTES and compressible_media_type_regex.match(media_type) is not None:
+        for coding, (extension, compress) in _compressors.items():
+            compressed = _read_precompressed_file(file_path + extension, file_stat.st_mtime_ns) or compress(content)
+            if len(compressed) < len(content):
+                variants[coding] = (compressed, f'"{digest}-{coding}"')
+
+    return StaticFile(file_path=file_path, mtime_ns=file_stat.st_mtime_ns, size=file_stat.st_size,
+                      media_type=media_type,
+                      cache_control=IMMUTABLE_CACHE_CONTROL if hashed_asset_path_regex.search(file_path) is not None
+                      else REVALIDATE_CACHE_CONTROL,
+                      variants=variants)
+
+
+def _choose_content_coding(static_file: StaticFile, accept_encoding: str | None) -> str:
+    qualities: dict[str, float] = dict()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        try:
+            quality = float(params.strip()[2:]) if params.strip().startswith("q=") else 1
+        except ValueError:
+            quality = 0
+        qualities[coding.strip().lower()] = quality
+
+    for coding in static_file.variants:
+        if coding != IDENTITY and qualities.get(coding, qualities.get("*", 0)) > 0:
+            return coding
+    return IDENTITY
+
+
+def _matches_etag(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+class StaticFrontend:
+    """
+    Serves the compiled frontend from memory. Paths that do not look like asset files get index.html,
+    so that the frontend routes nested URLs.
+    The files are read and compressed once, and read again only when they change on disk, such as after a rebuild.
+    """
+
+    def __init__(self, directory: str, index_file_name: str = "index.html"):
+        self.__directory = path.realpath(directory)
+        self.__index_file_name = index_file_name
+        self.__files: dict[str, StaticFile] = dict()  # Relative path => file
+
+    def preload(self) -> int:
+        """
+        Load and compress all files in advance, so that no request waits for it.
+        :return: Number of files loaded.
+        """
+        for dir_path, _, file_names in walk(self.__directory):
+            for file_name in file_names:
+                if file_name.endswith(tuple([extension for extension, _ in _compressors.values()])):
+                    continue
+                file_path = path.join(dir_path, file_name)
+                relative_path = path.relpath(file_path, self.__directory).replace(sep, "/")
+                self.__files[relative_path] = load_static_file(file_path)
+        return len(self.__files)
+
+    def __resolve(self, relative_path: str) -> str | None:
+        file_path = path.realpath(path.join(self.__directory, relative_path))
+        if file_path.startswith(self.__directory + sep) and path.isfile(file_path):
+            return file_path
+        else:
+            return None
+
+    @staticmethod
+    def __is_up_to_date(static_file: StaticFile) -> bool:
+        try:
+            file_stat = stat(static_file.file_path)
+        except OSError:
+            return False
+        return file_stat.st_mtime_ns == static_file.mtime_ns and file_stat.st_size == static_file.size
+
+    async def __get_file(self, relative_path: str) -> StaticFile | None:
+        static_file = self.__files.get(relative_path)
+        if static_file is not None and self.__is_up_to_date(static_file):
+            return static_file
+
+        file_path = self.__resolve(relative_path)
+        if file_path is None:
+            self.__files.pop(relative_path, None)
+            return None
+
+        static_file = await asyncio.get_running_loop().run_in_executor(None, load_static_file, file_path)
+        self.__files[relative_path] = static_file
+        return static_file
+
+    async def get_response(self, rest_of_path: str, headers: Headers) -> Response:
+        relative_path = rest_of_path if asset_path_regex.search(rest_of_path) is not None else self.__index_file_name
+        static_file = await self.__get_file(relative_path)
+        if static_file is None:
+            return Response(status_code=404)
+
+        coding = _choose_content_coding(static_file, headers.get("accept-encoding"))
+        content, etag = static_file.variants[coding]
+        response_headers = {"ETag": etag, "Cache-Control": static_file.cache_control}
+        if len(static_file.variants) > 1:
+            response_headers["Vary"] = "Accept-Encoding"
+
+        if _matches_etag(headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=response_headers)
+
+        if coding != IDENTITY:
+            response_headers["Content-Encoding"] = coding
+        return Response(content, headers=response_headers, media_type=static_file.media_type)
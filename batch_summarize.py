@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+from os import path, getcwd, makedirs
+
+from dotenv import load_dotenv
+
+from app.common import EmotionChatbotPhase, FindDialogueSummarizerParams, LabelDialogueSummarizerParams, \
+    HelpSummarizerResult
+from app.phases import explore, label, find, record, help
+from chatlib.chatlib.chatbot import session_writer
+from chatlib.chatlib.llm.integration import GPTChatCompletionAPI, MockChatCompletionAPI
+from chatlib.chatlib.tool.batch_job import write_batch_job_file, run_batch_job, ingest_batch_job_output, \
+    make_custom_id, split_custom_id
+
+
+def _get_payload_memory(session_id: str) -> dict:
+    info = session_writer.read_session_info(session_id)
+    return (info.get("response_generator") or dict()).get("payload_memory") or dict()
+
+
+def _make_params(phase: EmotionChatbotPhase, session_id: str):
+    if phase == EmotionChatbotPhase.Help:
+        return help.summarizer_params
+    elif phase == EmotionChatbotPhase.Explore:
+        return explore.summarizer_params
+
+    payload_memory = _get_payload_memory(session_id)
+    explore_payload = payload_memory.get(EmotionChatbotPhase.Explore)
+    if explore_payload is None:
+        return None
+    elif phase == EmotionChatbotPhase.Label:
+        return LabelDialogueSummarizerParams(key_episode=explore_payload["key_episode"],
+                                             user_emotion=explore_payload["user_emotion"])
+    else:
+        label_payload = payload_memory.get(EmotionChatbotPhase.Label)
+        if label_payload is None:
+            return None
+        return FindDialogueSummarizerParams(key_episode=explore_payload["key_episode"],
+                                            identified_emotions=label_payload["identified_emotions"])
+
+
+# phase => (summarizer, examples, mock output)
+SUMMARIZERS = {
+    EmotionChatbotPhase.Help: (help.summarizer, None, HelpSummarizerResult(sensitive_topic=False)),
+    EmotionChatbotPhase.Explore: (explore.summarizer, explore.summarizer_examples,
+                                  explore.summarizer_examples[0].output),
+    EmotionChatbotPhase.Label: (label.summarizer, label.summarizer_examples, label.summarizer_examples[0].output),
+    EmotionChatbotPhase.Find: (find.summarizer, find.summarizer_examples, find.summarizer_examples[0].output),
+    EmotionChatbotPhase.Record: (record.summarizer, record.summarizer_examples, record.summarizer_examples[0].output),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-summarize stored sessions with a phase summarizer in a resumable batch job.")
+
+    parser.add_argument('-phase', '--phase', dest="phase", type=EmotionChatbotPhase,
+                        choices=list(SUMMARIZERS.keys()), required=True)
+    parser.add_argument('-job', '--job', dest="job", type=str, help="Job name. Rerun with the same name to resume.")
+    parser.add_argument('-sessions', '--sessions', dest="sessions", nargs="*", type=str,
+                        help="Session IDs to summarize. All stored sessions if omitted.")
+    parser.add_argument('-concurrency', '--concurrency', dest="concurrency", type=int, default=8)
+    parser.add_argument('--mock', dest="mock", action="store_true", help="Run offline against the mock provider.")
+
+    args = parser.parse_args()
+
+    load_dotenv(path.join(getcwd(), ".env"))
+
+    phase: EmotionChatbotPhase = args.phase
+    summarizer, examples, mock_output = SUMMARIZERS[phase]
+    job_name = args.job or f"{phase}_summary"
+
+    job_dir = path.join(getcwd(), "data/batch/", job_name)
+    if not path.exists(job_dir):
+        makedirs(job_dir)
+    job_path = path.join(job_dir, "job.jsonl")
+    output_path = path.join(job_dir, "output.jsonl")
+
+    if path.exists(job_path):
+        print(f"Reuse the existing job file at {job_path}")
+    else:
+        session_ids = args.sessions or session_writer.list_session_ids()
+
+        def generate_items():
+            for session_id in session_ids:
+                params = _make_params(phase, session_id)
+                dialogue = session_writer.read_dialogue(session_id)
+                if params is not None and dialogue is not None and len(dialogue) > 0:
+                    yield make_custom_id(session_id, phase), dialogue, params
+
+        num_requests = write_batch_job_file(summarizer, examples, generate_items(), job_path)
+        print(f"Wrote {num_requests} request(s) to {job_path}")
+
+    if args.mock:
+        mock_output_str = mock_output.model_dump_json()
+        api = MockChatCompletionAPI(responder=lambda model, messages, params: mock_output_str)
+    else:
+        api = GPTChatCompletionAPI()
+
+    asyncio.run(run_batch_job(api, job_path, output_path, concurrency=args.concurrency))
+
+    num_ingested, num_failed = ingest_batch_job_output(summarizer, output_path, session_writer, job_name,
+                                                       lambda custom_id: _make_params(phase,
+                                                                                      split_custom_id(custom_id)[0]))
+    print(f"Ingested {num_ingested} result(s) into session metadata \"{job_name}\". {num_failed} failed.")
@@ -0,0 +1,160 @@
+import asyncio
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import Callable, TypeVar
+
+from .session_writer import SessionWriterBase
+from .types import DialogueTurn, Dialogue
+
+T = TypeVar("T")
+
+
+class AsyncSessionWriterBase(ABC):
+
+    @abstractmethod
+    async def exists(self, session_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def write_turn(self, session_id: str, turn: DialogueTurn):
+        pass
+
+    @abstractmethod
+    async def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
+        pass
+
+    @abstractmethod
+    async def read_dialogue(self, session_id: str) -> Dialogue:
+        pass
+
+    @abstractmethod
+    async def write_dialogue(self, session_id: str, dialog: Dialogue):
+        pass
+
+    @abstractmethod
+    async def write_session_info(self, session_id, session_info: dict):
+        pass
+
+    @abstractmethod
+    async def read_session_info(self, session_id) -> dict:
+        pass
+
+    @abstractmethod
+    async def clear_data(self, session_id) -> bool:
+        pass
+
+    @abstractmethod
+    async def list_session_ids(self) -> list[str]:
+        pass
+
+    @abstractmethod
+    async def write_session_metadata(self, session_id: str, name: str, data: dict):
+        pass
+
+    @abstractmethod
+    async def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        pass
+
+    async def append_state_log(self, session_id: str, entries: list[dict]):
+        pass
+
+    async def read_state_log(self, session_id: str) -> list[dict] | None:
+        return None
+
+    async def flush(self, session_id: str | None = None):
+        pass
+
+    async def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        dialogue = await self.read_dialogue(session_id)
+        return dialogue[max(0, len(dialogue) - n):] if dialogue is not None else None
+
+    async def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        dialogue = await self.read_dialogue(session_id)
+        if dialogue is not None:
+            for i, turn in enumerate(dialogue):
+                if turn.id == turn_id:
+                    return dialogue[i + 1:]
+        return None
+
+
+class ThreadPoolSessionWriter(AsyncSessionWriterBase):
+    """
+    Adapts a synchronous SessionWriterBase by running its calls on a bounded pool of I/O threads.
+    Each session is pinned to one thread, so the calls on a session run in the order they were made.
+    """
+
+    def __init__(self, writer: SessionWriterBase, num_threads: int = 4):
+        self.__writer = writer
+        self.__executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"session-io-{i}")
+                            for i in range(num_threads)]
+
+    @property
+    def writer(self) -> SessionWriterBase:
+        return self.__writer
+
+    async def __run(self, session_id: str | None, func: Callable[..., T], *args) -> T:
+        executor = self.__executors[zlib.crc32(session_id.encode()) % len(self.__executors)
+                                    if session_id is not None else 0]
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def shutdown(self):
+        for executor in self.__executors:
+            executor.shutdown(wait=True)
+
+    async def exists(self, session_id: str) -> bool:
+        return await self.__run(session_id, self.__writer.exists, session_id)
+
+    async def write_turn(self, session_id: str, turn: DialogueTurn):
+        await self.__run(session_id, self.__writer.write_turn, session_id, turn)
+
+    async def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
+        return await self.__run(session_id, self.__writer.delete_turn, session_id, turn_id)
+
+    async def read_dialogue(self, session_id: str) -> Dialogue:
+        return await self.__run(session_id, self.__writer.read_dialogue, session_id)
+
+    async def write_dialogue(self, session_id: str, dialog: Dialogue):
+        await self.__run(session_id, self.__writer.write_dialogue, session_id, dialog)
+
+    async def write_session_info(self, session_id, session_info: dict):
+        await self.__run(session_id, self.__writer.write_session_info, session_id, session_info)
+
+    async def read_session_info(self, session_id) -> dict:
+        return await self.__run(session_id, self.__writer.read_session_info, session_id)
+
+    async def clear_data(self, session_id) -> bool:
+        return await self.__run(session_id, self.__writer.clear_data, session_id)
+
+    async def list_session_ids(self) -> list[str]:
+        return await self.__run(None, self.__writer.list_session_ids)
+
+    async def write_session_metadata(self, session_id: str, name: str, data: dict):
+        await self.__run(session_id, self.__writer.write_session_metadata, session_id, name, data)
+
+    async def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        return await self.__run(session_id, self.__writer.read_session_metadata, session_id, name)
+
+    async def append_state_log(self, session_id: str, entries: list[dict]):
+        await self.__run(session_id, self.__writer.append_state_log, session_id, entries)
+
+    async def read_state_log(self, session_id: str) -> list[dict] | None:
+        return await self.__run(session_id, self.__writer.read_state_log, session_id)
+
+    async def flush(self, session_id: str | None = None):
+        await self.__run(session_id, self.__writer.flush, session_id)
+
+    async def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        return await self.__run(session_id, self.__writer.read_recent_turns, session_id, n)
+
+    async def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        return await self.__run(session_id, self.__writer.read_turns_after, session_id, turn_id)
+
+
+@cache
+def get_async_session_writer(writer: SessionWriterBase) -> ThreadPoolSessionWriter:
+    """
+    :return: The shared thread pool adapter of a synchronous writer.
+    """
+    return ThreadPoolSessionWriter(writer)
@@ -1,9 +1,10 @@
 from abc import ABC, abstractmethod
 from typing import TypeVar, Generic
 
-from chatlib.chatlib.chatbot import ResponseGenerator, Dialogue
+from chatlib.chatlib.chatbot import ResponseGenerator, Dialogue, get_response_delta_handler
 from chatlib.chatlib.chatbot.message_transformer import MessageTransformerChain
 from chatlib.chatlib.utils import dict_utils
+from chatlib.chatlib.utils.time import get_timestamp
 
 StateType = TypeVar('StateType')
 
@@ -11,25 +12,86 @@ StateType = TypeVar('StateType')
 class StateBasedResponseGenerator(ResponseGenerator, Generic[StateType], ABC):
 
     def __init__(self, initial_state: StateType, initial_state_payload: dict | None = None,
-                 verbose: bool = False, message_transformers: MessageTransformerChain | None = None):
+                 verbose: bool = False, message_transformers: MessageTransformerChain | None = None,
+                 state_history_tail_size: int = 16):
         super().__init__(message_transformers)
         self.__current_generator: ResponseGenerator | None = None
         self.verbose = verbose
 
         self.__payload_memory: dict[StateType, dict | None] = dict()
 
+        self.__state_history_tail_size = max(1, state_history_tail_size)
+
+        # Compact snapshot of the current state run. The entry payload is what the state was entered with,
+        # and the merged payload accumulates the generator updates received within the run.
+        self.__current_state: StateType = initial_state
+        self.__entry_payload: dict | None = initial_state_payload
+        self.__merged_payload: dict | None = initial_state_payload
+        self.__is_payload_updated: bool = False
+        self.__state_appearances: dict[StateType, int] = {initial_state: 1}
+
         self.__state_history: list[tuple[StateType, dict | None]] = [(initial_state, initial_state_payload)]
 
+        # Entries not yet handed over to the append-only state log.
+        self.__state_log_buffer: list[dict] = [self.__make_state_log_entry(initial_state, initial_state_payload, True,
+                                                                                      get_timestamp())]
+
     @property
     def current_state(self) -> StateType:
-        return self.__state_history[len(self.__state_history) - 1][0]
+        return self.__current_state
 
     @property
     def current_state_payload(self) -> dict | None:
         return self.__state_history[len(self.__state_history) - 1][1]
 
-    def _push_new_state(self, state: StateType, payload: dict | None):
+    @property
+    def state_history_tail(self) -> list[tuple[StateType, dict | None]]:
+        return self.__state_history.copy()
+
+    @staticmethod
+    def __make_state_log_entry(state: StateType, payload: dict | None, transition: bool,
+                               timestamp: int | None) -> dict:
+        return dict(state=state, payload=payload, transition=transition, timestamp=timestamp)
+
+    def _push_new_state(self, state: StateType, payload: dict | None, update_only: bool = False):
+        """
+        :param state: State to push
+        :param payload: Payload of the state
+        :param update_only: If True, the payload updates the current state run instead of entering the state anew.
+        """
+        if update_only:
+            self.__merged_payload = self._merge_state_payload(self.__merged_payload, payload)
+            self.__is_payload_updated = True
+        else:
+            self.__current_state = state
+            self.__entry_payload = payload
+            self.__merged_payload = payload
+            self.__is_payload_updated = False
+
+        self.__state_appearances[state] = self.__state_appearances.get(state, 0) + 1
+
         self.__state_history.append((state, payload))
+        if len(self.__state_history) > self.__state_history_tail_size:
+            del self.__state_history[:len(self.__state_history) - self.__state_history_tail_size]
+
+        self.__state_log_buffer.append(self.__make_state_log_entry(state, payload, not update_only, get_timestamp()))
+
+    def _merge_state_payload(self, merged: dict | None, payload: dict | None) -> dict | None:
+        """
+        Fold a generator update payload into the effective payload of the current state run.
+        The merged payload is passed to update_generator once on restore, so override this if update_generator
+        accumulates payloads instead of overwriting with the latest one.
+        :param merged: Effective payload merged so far
+        :param payload: Newly pushed payload
+        :return: New effective payload
+        """
+        return payload
+
+    def pop_state_log(self) -> list[dict]:
+        # State pushes are kept only as a bounded tail in the snapshot; the full history goes to the state log.
+        entries = self.__state_log_buffer
+        self.__state_log_buffer = []
+        return entries
 
     def _get_memoized_payload(self, state: StateType) -> dict | None:
         return self.__payload_memory[state] if state in self.__payload_memory else None
@@ -75,13 +137,14 @@ class StateBasedResponseGenerator(ResponseGenerator, Generic[StateType], ABC):
                                                                                            self.current_state))
             elif next_state_payload is not None:  # No state change but generator update.
                 print("Update generator with payload.")
-                self._push_new_state(self.current_state, next_state_payload)
+                self._push_new_state(self.current_state, next_state_payload, update_only=True)
                 self.update_generator(self.__current_generator, next_state_payload)
             elif self.__current_generator is None:  # No state change but initial run.
                 self.__current_generator = self.get_generator(self.current_state, self.current_state_payload)
 
         # Generate response from the child generator:
-        message, metadata, elapsed = await self.__current_generator.get_response(dialog, dry)
+        message, metadata, elapsed = await self.__current_generator.get_response(
+            dialog, dry, on_delta=get_response_delta_handler())
 
         metadata = dict_utils.set_nested_value(metadata, "state", self.current_state)
         metadata = dict_utils.set_nested_value(metadata, "payload", self.current_state_payload)
@@ -94,7 +157,7 @@ class StateBasedResponseGenerator(ResponseGenerator, Generic[StateType], ABC):
         :param state: state
         :return: number of appearance
         """
-        return len([tup for tup in self.__state_history if tup[0] == state])
+        return self.__state_appearances.get(state, 0)
 
     @staticmethod
     def trim_dialogue_recent_n_states(dialogue: Dialogue, N: int) -> Dialogue:
@@ -124,25 +187,63 @@ class StateBasedResponseGenerator(ResponseGenerator, Generic[StateType], ABC):
         return dialogue[pointer:]
 
     def write_to_json(self, parcel: dict):
-        parcel["state_history"] = self.__state_history
+        # Containers are copied because the parcel may be serialized on another thread while states are pushed.
+        parcel["state_snapshot"] = dict(
+            state=self.__current_state,
+            entry_payload=self.__entry_payload,
+            merged_payload=self.__merged_payload,
+            is_payload_updated=self.__is_payload_updated,
+            appearances=dict(self.__state_appearances),
+            history_tail=list(self.__state_history)
+        )
         parcel["verbose"] = self.verbose
-        parcel["payload_memory"] = self.__payload_memory
+        parcel["payload_memory"] = dict(self.__payload_memory)
 
     def restore_from_json(self, parcel: dict):
-        self.__state_history = parcel["state_history"]
         self.verbose = parcel["verbose"] or False
         self.__payload_memory = parcel["payload_memory"]
-
-        current_state = self.current_state
-        pointer = len(self.__state_history) - 1
+        self.__state_log_buffer = []
+
+        if "state_snapshot" in parcel:
+            snapshot = parcel["state_snapshot"]
+            self.__current_state = snapshot["state"]
+            self.__entry_payload = snapshot["entry_payload"]
+            self.__merged_payload = snapshot["merged_payload"]
+            self.__is_payload_updated = snapshot["is_payload_updated"]
+            self.__state_appearances = snapshot["appearances"]
+            self.__state_history = [(state, payload) for state, payload in snapshot["history_tail"]]
+        else:
+            self.__restore_from_legacy_state_history(parcel["state_history"])
+
+        self.__current_generator = self.get_generator(self.__current_state, self.__entry_payload)
+        if self.__is_payload_updated:
+            self.update_generator(self.__current_generator, self.__merged_payload)
+
+    def __restore_from_legacy_state_history(self, state_history: list[tuple[StateType, dict | None]]):
+        current_state = state_history[len(state_history) - 1][0]
+        pointer = len(state_history) - 1
         while pointer > 0:
-            state, payload = self.__state_history[pointer - 1]
+            state, payload = state_history[pointer - 1]
             if state != current_state:
                 break
             else:
                 pointer -= 1
 
-        self.__current_generator = self.get_generator(self.current_state, self.__state_history[pointer][1])
-        if pointer < len(self.__state_history) - 1:
-            for i in range(pointer + 1, len(self.__state_history)):
-                self.update_generator(self.__current_generator, self.__state_history[i][1])
+        self.__current_state = current_state
+        self.__entry_payload = state_history[pointer][1]
+        self.__merged_payload = self.__entry_payload
+        self.__is_payload_updated = pointer < len(state_history) - 1
+        for i in range(pointer + 1, len(state_history)):
+            self.__merged_payload = self._merge_state_payload(self.__merged_payload, state_history[i][1])
+
+        self.__state_appearances = dict()
+        for state, payload in state_history:
+            self.__state_appearances[state] = self.__state_appearances.get(state, 0) + 1
+
+        self.__state_history = [(state, payload) for state, payload in
+                                state_history[-self.__state_history_tail_size:]]
+
+        # Hand the whole legacy history over to the state log so that it is not lost once rewritten as a snapshot.
+        self.__state_log_buffer = [
+            self.__make_state_log_entry(state, payload, i == 0 or state_history[i - 1][0] != state, None)
+            for i, (state, payload) in enumerate(state_history)]
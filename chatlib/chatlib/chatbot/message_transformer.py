@@ -6,6 +6,10 @@ from typing import TypeAlias, Callable
 from chatlib.chatlib.utils import dict_utils
 
 
+# Trailing text that may be the beginning of a special token such as <|Terminate|>.
+PARTIAL_SPECIAL_TOKEN_REGEX = re.compile(r"<(\|[a-zA-Z0-9-_]*\|?)?$")
+
+
 class MessageTransformer(Callable[[str, dict | None], tuple[str, dict | None, bool]], ABC):
 
     def __init__(self, name: str):
@@ -15,6 +19,19 @@ class MessageTransformer(Callable[[str, dict | None], tuple[str, dict | None, bo
     def _transform(self, message: str, metadata: dict | None) -> tuple[str, dict | None, bool]:
         pass
 
+    def _get_removal_pattern(self) -> str | None:
+        """
+        :return: Regex source matching what this transformer removes, if its transformation is a pure removal.
+        Chains whose transformers all return a pattern are compiled into a single pass.
+        """
+        return None
+
+    def _get_removal_literals(self) -> list[str]:
+        """
+        :return: Literal strings among the removal pattern, used to hold back their prefixes in streaming.
+        """
+        return []
+
     def __call__(self, message: str, metadata: dict | None) -> tuple[str, dict | None, bool]:
         transformed_message, metadata, is_transformed = self._transform(message, metadata)
         if is_transformed:
@@ -47,6 +64,12 @@ class SpecialTokenExtractionTransformer(MessageTransformer):
 
         return cleaned_message or message, metadata, cleaned_message is not None
 
+    def _get_removal_pattern(self) -> str | None:
+        return self.token.pattern if isinstance(self.token, Pattern) else re.escape(self.token)
+
+    def _get_removal_literals(self) -> list[str]:
+        return [] if isinstance(self.token, Pattern) else [self.token]
+
     @classmethod
     def remove_all_regex(cls, name: str, pattern: str | Pattern) -> 'SpecialTokenExtractionTransformer':
         return SpecialTokenExtractionTransformer(name, re.compile(pattern), None)
@@ -73,8 +96,190 @@ class SpecialTokenListExtractionTransformer(MessageTransformer):
 
         return cleaned_message, metadata, len(found_tokens) > 0
 
+    def _get_removal_pattern(self) -> str | None:
+        if len(self.tokens) == 0:
+            return None
+        # Longer tokens first, so that a token is not shadowed by its own prefix.
+        return "|".join([re.escape(token) for token in sorted(self.tokens, key=len, reverse=True)])
+
+    def _get_removal_literals(self) -> list[str]:
+        return list(self.tokens)
+
+
+class CompiledMessageTransformerChain:
+    """
+    A chain of removal transformers compiled into one regex, so that a message is scanned once for all of them.
+    Most messages have nothing to remove and are returned after the scan. A message with a match goes through the
+    transformers in order, so that their callbacks receive the same messages as in the sequential chain.
+    """
+
+    def __init__(self, chain: MessageTransformerChain):
+        self.chain = chain
+        self.__pattern = _compile_combined_pattern([t._get_removal_pattern() for t in chain])
+        self.__literals = [literal for t in chain for literal in t._get_removal_literals()]
+        self.__max_literal_length = max([len(literal) for literal in self.__literals], default=0)
+
+    def run(self, message: str, metadata: dict | None) -> tuple[str, dict | None]:
+        if self.__pattern.search(message) is None:
+            return message, metadata
+        return _run_sequential_chain(message, metadata, self.chain)
+
+    def remove(self, text: str) -> str:
+        """
+        :return: The text without anything the transformers remove, without calling their callbacks.
+        """
+        return self.__pattern.sub("", text)
+
+    def get_hold_back_length(self, text: str) -> int:
+        """
+        :return: Length of the trailing text that may be the beginning of a token to be removed.
+        """
+        match = PARTIAL_SPECIAL_TOKEN_REGEX.search(text)
+        length = len(text) - match.start() if match is not None else 0
+        for i in range(max(0, len(text) - self.__max_literal_length + 1), len(text) - length):
+            suffix = text[i:]
+            if any([literal.startswith(suffix) for literal in self.__literals]):
+                return len(suffix)
+        return length
+
+    def stream(self, metadata: dict | None = None) -> 'MessageTransformerStream':
+        return MessageTransformerStream(self, metadata)
+
+
+class MessageTransformerStream:
+    """
+    Applies a compiled chain to a message that arrives in deltas. Text that may be the beginning of a token is
+    held back until the next delta resolves it, so tokens never appear in the emitted text.
+    """
+
+    def __init__(self, chain: CompiledMessageTransformerChain, metadata: dict | None = None):
+        self.__chain = chain
+        self.__metadata = metadata
+        self.__raw_chunks: list[str] = []
+        self.__pending = ""
+        self.__is_emitted = False
+
+    def feed(self, delta: str) -> str:
+        """
+        :return: Cleaned text that is safe to display.
+        """
+        self.__raw_chunks.append(delta)
+        self.__pending += delta
+        safe_length = len(self.__pending) - self.__chain.get_hold_back_length(self.__pending)
+        if safe_length <= 0:
+            return ""
+        safe_text = self.__chain.remove(self.__pending[:safe_length])
+        self.__pending = self.__pending[safe_length:]
+        self.__is_emitted = self.__is_emitted or len(safe_text) > 0
+        return safe_text
+
+    def close(self) -> tuple[str, str, dict | None]:
+        """
+        Flush the held-back text and run the chain over the whole message for its metadata.
+        :return: The last cleaned delta, the whole cleaned message, and the metadata.
+        """
+        message, metadata = self.__chain.run("".join(self.__raw_chunks), self.__metadata)
+        # A message that is nothing but tokens is kept as it is, so it is emitted whole.
+        last_delta = self.__chain.remove(self.__pending) if self.__is_emitted else message
+        self.__pending = ""
+        return last_delta, message, metadata
+
+
+_REGEX_META_CHARS = frozenset(".^$*+?{}[]|()")
+_REGEX_QUANTIFIERS = frozenset("*+?{")
+
+
+def _split_top_level_alternatives(source: str) -> list[str]:
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    i = 0
+    while i < len(source):
+        c = source[i]
+        if c == "\\":
+            i += 2
+            continue
+        elif in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            alternatives.append(source[start:i])
+            start = i + 1
+        i += 1
+    alternatives.append(source[start:])
+    return alternatives
+
+
+def _get_literal_prefix(source: str) -> list[tuple[str, int]]:
+    """
+    :return: Characters that a match of the regex source always starts with, each paired with the source offset
+    after it.
+    """
+    prefix = []
+    i = 0
+    while i < len(source):
+        if source[i] == "\\" and i + 1 < len(source) and not source[i + 1].isalnum():
+            c, end = source[i + 1], i + 2
+        elif source[i] not in _REGEX_META_CHARS and source[i] != "\\":
+            c, end = source[i], i + 1
+        else:
+            break
+        if end < len(source) and source[end] in _REGEX_QUANTIFIERS:
+            break
+        prefix.append((c, end))
+        i = end
+    return prefix
+
+
+def _compile_combined_pattern(sources: list[str]) -> Pattern:
+    """
+    :return: A pattern matching what any of the sources matches. The literal prefix shared by all sources is matched
+    in front of the alternatives.
+    """
+    # The regex engine searches a literal prefix quickly but does not factor it out of alternatives,
+    # so the prefix shared by all alternatives is moved in front of them.
+    alternatives = [_split_top_level_alternatives(source) for source in sources]
+    prefixes = [_get_literal_prefix(alternative) for alts in alternatives for alternative in alts]
+    prefix_length = 0
+    while all([len(prefix) > prefix_length for prefix in prefixes]) and len(
+            set([prefix[prefix_length][0] for prefix in prefixes])) == 1:
+        prefix_length += 1
+
+    if prefix_length == 0:
+        return re.compile("|".join([f"(?:{source})" for source in sources]))
+
+    shared_prefix = "".join([c for c, end in prefixes[0][:prefix_length]])
+    groups = []
+    for alts in alternatives:
+        rests = [alternative[_get_literal_prefix(alternative)[prefix_length - 1][1]:] for alternative in alts]
+        groups.append(f"(?:{'|'.join(rests)})")
+    return re.compile(f"{re.escape(shared_prefix)}(?:{'|'.join(groups)})")
+
+
+def compile_message_transformer_chain(chain: MessageTransformerChain | None) -> CompiledMessageTransformerChain | None:
+    """
+    :return: A compiled chain, or None if the chain is empty or has a transformer that is not a pure removal.
+    """
+    if chain is None or len(chain) == 0 or any([t._get_removal_pattern() is None for t in chain]):
+        return None
+    return CompiledMessageTransformerChain(chain)
+
+
+def run_message_transformer_chain(message: str, metadata: dict | None,
+                                  chain: MessageTransformerChain | CompiledMessageTransformerChain) -> tuple[
+    str, dict | None]:
+    if isinstance(chain, CompiledMessageTransformerChain):
+        return chain.run(message, metadata)
+    return _run_sequential_chain(message, metadata, chain)
+
 
-def run_message_transformer_chain(message: str, metadata: dict | None, chain: MessageTransformerChain) -> tuple[
+def _run_sequential_chain(message: str, metadata: dict | None, chain: MessageTransformerChain) -> tuple[
     str, dict | None]:
     cleaned_message = message
     m = metadata
@@ -1,5 +1,6 @@
 import json
 from abc import ABC, abstractmethod
+from contextvars import ContextVar
 from functools import cache
 from time import perf_counter
 from typing import TypeAlias, Callable, Awaitable, Any, Optional
@@ -9,18 +10,34 @@ from pydantic import BaseModel, Field, ConfigDict
 from typing_extensions import TypedDict
 
 from chatlib.chatlib.chatbot.message_transformer import MessageTransformerChain, run_message_transformer_chain, \
-    SpecialTokenListExtractionTransformer
+    SpecialTokenListExtractionTransformer, compile_message_transformer_chain, MessageTransformerStream
 from chatlib.chatlib.llm.chat_completion_api import ChatCompletionMessage, ChatCompletionAPI, ChatCompletionMessageRole, \
     TokenLimitExceedError, ChatCompletionFinishReason, ChatCompletionResult
 from .types import Dialogue, RegenerateRequestException
 from ..utils import dict_utils
 
+# Receives None when the deltas passed so far are discarded, such as before a regenerated response is streamed.
+ResponseDeltaHandler: TypeAlias = Callable[[str | None], None]
+
+# The handler of the response being generated by the innermost get_response() call.
+# A generator that delegates to another passes it on explicitly, so that helper generators are not streamed.
+_response_delta_handler: ContextVar[ResponseDeltaHandler | None] = ContextVar("response_delta_handler", default=None)
+
+
+def get_response_delta_handler() -> ResponseDeltaHandler | None:
+    """
+    :return: The handler to which the response being generated should be streamed in raw deltas, if any.
+    Generators that delegate the response to another generator pass this as its on_delta.
+    """
+    return _response_delta_handler.get()
+
 
 class ResponseGenerator(ABC):
 
     def __init__(self,
                  message_transformers: MessageTransformerChain | None = None):
         self._message_transformers = message_transformers
+        self._compiled_message_transformers = compile_message_transformer_chain(message_transformers)
 
     async def initialize(self):
         pass
@@ -32,28 +49,59 @@ class ResponseGenerator(ABC):
     async def _get_response_impl(self, dialog: Dialogue, dry: bool = False) -> tuple[str, dict | None]:
         pass
 
-    async def get_response(self, dialog: Dialogue, dry: bool = False) -> tuple[str, dict | None, int]:
+    async def get_response(self, dialog: Dialogue, dry: bool = False,
+                           on_delta: ResponseDeltaHandler | None = None) -> tuple[str, dict | None, int]:
+        """
+        :param on_delta: If set, receives the cleaned response in deltas while it is generated. Generators that cannot
+        stream deliver the whole response as a single delta.
+        """
         start = perf_counter()
 
+        delta_stream = _ResponseDeltaStream(self, on_delta) if on_delta is not None else None
+        context_token = _response_delta_handler.set(delta_stream.feed if delta_stream is not None
+                                                                         and delta_stream.can_stream else None)
         try:
             self._pre_get_response(dialog)
             response, metadata = await self._get_response_impl(dialog, dry)
         except RegenerateRequestException as regen:
             print(f"Regenerate response. Reason: {regen.reason}")
+            if delta_stream is not None:
+                delta_stream.discard()
             response, metadata = await self._get_response_impl(dialog, dry)
         except Exception as ex:
             raise ex
+        finally:
+            _response_delta_handler.reset(context_token)
 
         if self._message_transformers is not None:
-            cleaned_response, metadata = run_message_transformer_chain(response, metadata, self._message_transformers)
+            cleaned_response, metadata = run_message_transformer_chain(response, metadata,
+                                                                       self._compiled_message_transformers or self._message_transformers)
             if cleaned_response != response:
                 metadata = dict_utils.set_nested_value(metadata, "original_message", response)
                 response = cleaned_response
 
+        if delta_stream is not None:
+            delta_stream.close(response)
+
         end = perf_counter()
 
         return response, metadata, int((end - start) * 1000)
 
+    def open_message_transformer_stream(self, metadata: dict | None = None) -> MessageTransformerStream | None:
+        """
+        :return: A stream that cleans streamed deltas of a response, or None if the transformers cannot be streamed.
+        """
+        if self._compiled_message_transformers is not None:
+            return self._compiled_message_transformers.stream(metadata)
+        return None
+
+    def pop_state_log(self) -> list[dict]:
+        """
+        Drain log entries to be appended to the session's state log for analytics.
+        :return: Entries accumulated since the last call.
+        """
+        return []
+
     @abstractmethod
     def write_to_json(self, parcel: dict):
         pass
@@ -63,6 +111,49 @@ class ResponseGenerator(ABC):
         pass
 
 
+class _ResponseDeltaStream:
+    """
+    Cleans the raw deltas of a generator's response with its message transformers and passes them on.
+    If the transformers cannot be streamed or the response was not streamed, the cleaned response is passed at the end.
+    """
+
+    def __init__(self, generator: ResponseGenerator, on_delta: ResponseDeltaHandler):
+        self.__generator = generator
+        self.__on_delta = on_delta
+        self.__transformer_stream = generator.open_message_transformer_stream()
+        self.can_stream = generator._message_transformers is None or self.__transformer_stream is not None
+        self.__is_streamed = False
+
+    def feed(self, delta: str | None):
+        if delta is None:
+            self.discard()
+            return
+        self.__is_streamed = True
+        if self.__transformer_stream is not None:
+            delta = self.__transformer_stream.feed(delta)
+        if len(delta) > 0:
+            self.__on_delta(delta)
+
+    def discard(self):
+        """
+        Drop the response streamed so far, and tell the handler to do the same.
+        """
+        if self.__is_streamed:
+            self.__transformer_stream = self.__generator.open_message_transformer_stream()
+            self.__is_streamed = False
+            self.__on_delta(None)
+
+    def close(self, cleaned_response: str):
+        if not self.__is_streamed:
+            last_delta = cleaned_response
+        elif self.__transformer_stream is not None:
+            last_delta = self.__transformer_stream.close()[0]
+        else:
+            return
+        if len(last_delta) > 0:
+            self.__on_delta(last_delta)
+
+
 ##################
 
 TokenLimitExceedHandler: TypeAlias = Callable[[Dialogue, list[ChatCompletionMessage]], Awaitable[Any]]
@@ -91,6 +182,7 @@ class ChatCompletionParams(BaseModel):
     temperature: Optional[float] = Field(None, ge=0, le=2.0)
     presence_penalty: Optional[float] = Field(None, ge=-2, le=2)
     frequency_penalty: Optional[float] = Field(None, ge=-2, le=2)
+    max_tokens: Optional[int] = Field(None, ge=1)
     tools: list[ChatCompletionFunctionInfo | dict] | None = None
 
     @cache
@@ -216,7 +308,11 @@ class ChatCompletionResponseGenerator(ResponseGenerator):
 
         result: ChatCompletionResult
         if self.__api.is_messages_within_token_limit(messages, self.model, self.__token_limit_tolerance):
-            result = await self.__api.run_chat_completion(self.model, messages, self.__params.dict())
+            on_delta = get_response_delta_handler()
+            if on_delta is not None and self.__params.tools is None:
+                result = await self.__run_chat_completion_stream(messages, on_delta)
+            else:
+                result = await self.__api.run_chat_completion(self.model, messages, self.__params.dict())
         else:
             print(f"Token overflow - {len(messages)} message(s).")
             if self.__token_limit_exceed_handler is not None:
@@ -261,6 +357,25 @@ class ChatCompletionResponseGenerator(ResponseGenerator):
         else:
             raise Exception(f"ChatCompletion error - {result.finish_reason}")
 
+    async def __run_chat_completion_stream(self, messages: list[ChatCompletionMessage],
+                                           on_delta: ResponseDeltaHandler) -> ChatCompletionResult:
+        chunks = []
+        finish_reasons = []
+        async for delta in self.__api.run_chat_completion_stream(self.model, messages, self.__params.dict(),
+                                                                 finish_reasons.append):
+            chunks.append(delta)
+            on_delta(delta)
+        # A provider that does not report the finish reason is assumed to have finished normally.
+        finish_reason = finish_reasons[-1] if len(finish_reasons) > 0 else ChatCompletionFinishReason.Stop
+        message = ChatCompletionMessage(content="".join(chunks), role=ChatCompletionMessageRole.ASSISTANT)
+        # Streams do not report the usage, so it is counted locally.
+        prompt_tokens = self.__api.count_token_in_messages(messages, self.model)
+        completion_tokens = self.__api.count_token_in_messages([message], self.model)
+        return ChatCompletionResult(message=message, finish_reason=finish_reason,
+                                    provider=self.__api.provider_name(), model=self.model,
+                                    prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                    total_tokens=prompt_tokens + completion_tokens)
+
     def write_to_json(self, parcel: dict):
         parcel["model"] = self.model
         parcel["params"] = self.__params.dict()
@@ -2,7 +2,8 @@ from abc import ABC
 from typing import Callable
 
 from chatlib.chatlib.utils.dict_utils import set_nested_value
-from .response_generator import ResponseGenerator
+from .async_session_writer import AsyncSessionWriterBase, get_async_session_writer
+from .response_generator import ResponseGenerator, ResponseDeltaHandler
 from .session_writer import SessionWriterBase, session_writer
 from .types import Dialogue, DialogueTurn
 
@@ -16,6 +17,8 @@ class ChatSessionBase(ABC):
         self._response_generator = response_generator
         self._dialog: Dialogue = []
         self._session_writer = writer
+        self._async_session_writer: AsyncSessionWriterBase | None = get_async_session_writer(
+            writer) if writer is not None else None
 
     def __del__(self):
         if self._session_writer is not None:
@@ -26,6 +29,14 @@ class ChatSessionBase(ABC):
     def response_generator(self) -> ResponseGenerator:
         return self._response_generator
 
+    def detach_writer(self):
+        """
+        Stop writing this instance to the storage, so that an outdated instance never overwrites a newer state
+        stored by another process.
+        """
+        self._session_writer = None
+        self._async_session_writer = None
+
     def load(self) -> bool:
         if self._session_writer is not None and self._session_writer.exists(self.id):
             dialogue = self._session_writer.read_dialogue(self.id)
@@ -43,6 +54,37 @@ class ChatSessionBase(ABC):
         if self._session_writer is not None:
             session_info = self._to_info_dict()
             self._session_writer.write_session_info(self.id, session_info)
+            self._session_writer.append_state_log(self.id, self._response_generator.pop_state_log())
+            return True
+        else:
+            return False
+
+    async def load_async(self) -> bool:
+        """
+        Counterpart of load() that reads on the I/O threads without blocking the event loop.
+        """
+        if self._async_session_writer is not None and await self._async_session_writer.exists(self.id):
+            dialogue = await self._async_session_writer.read_dialogue(self.id)
+            if dialogue is not None:
+                self._dialog = dialogue
+
+            session_info = await self._async_session_writer.read_session_info(self.id)
+            if session_info is not None:
+                self._restore_from_info_dict(session_info)
+            return True
+        else:
+            return False
+
+    async def save_async(self) -> bool:
+        """
+        Counterpart of save() that writes on the I/O threads without blocking the event loop.
+        """
+        if self._async_session_writer is not None:
+            # The snapshot is taken on the calling thread before the write is handed over.
+            session_info = self._to_info_dict()
+            state_log = self._response_generator.pop_state_log()
+            await self._async_session_writer.write_session_info(self.id, session_info)
+            await self._async_session_writer.append_state_log(self.id, state_log)
             return True
         else:
             return False
@@ -73,6 +115,19 @@ class ChatSessionBase(ABC):
                 self._session_writer.delete_turn(self.id, pop.id)
             return pop
 
+    async def _push_new_turn_async(self, turn: DialogueTurn):
+        self._dialog.append(turn)
+        if self._async_session_writer is not None:
+            await self._async_session_writer.write_turn(self.id, turn)
+        await self.save_async()
+
+    async def _pop_last_turn_async(self) -> DialogueTurn | None:
+        if len(self._dialog) > 0:
+            pop = self._dialog.pop()
+            if self._async_session_writer is not None:
+                await self._async_session_writer.delete_turn(self.id, pop.id)
+            return pop
+
 
 class TurnTakingChatSession(ChatSessionBase):
 
@@ -80,24 +135,44 @@ class TurnTakingChatSession(ChatSessionBase):
         self._dialog.clear()
         initial_message, metadata, elapsed = await self._response_generator.get_response(self._dialog)
         system_turn = DialogueTurn(message=initial_message, is_user=False, processing_time=elapsed, metadata=metadata)
-        self._push_new_turn(system_turn)
+        await self._push_new_turn_async(system_turn)
         return system_turn
 
-    async def push_user_message(self, user_turn: DialogueTurn) -> DialogueTurn:
-        self._push_new_turn(user_turn)
-        system_message, metadata, elapsed = await self._response_generator.get_response(self._dialog)
+    def __find_turn_index(self, turn_id: str) -> int | None:
+        for i in range(len(self._dialog) - 1, -1, -1):
+            if self._dialog[i].id == turn_id:
+                return i
+        return None
+
+    async def push_user_message(self, user_turn: DialogueTurn,
+                                on_delta: ResponseDeltaHandler | None = None) -> DialogueTurn:
+        """
+        A message whose ID is already in the dialogue is a retry: it gets the system turn that followed it,
+        or a new one if its response was never made.
+        :param on_delta: Receives the system message in deltas while it is generated.
+        """
+        index = self.__find_turn_index(user_turn.id)
+        if index is None:
+            await self._push_new_turn_async(user_turn)
+        elif index + 1 < len(self._dialog):
+            return self._dialog[index + 1]
+
+        system_message, metadata, elapsed = await self._response_generator.get_response(self._dialog,
+                                                                                          on_delta=on_delta)
         system_turn = DialogueTurn(message=system_message, is_user=False, processing_time=elapsed, metadata=metadata)
-        self._push_new_turn(system_turn)
+        await self._push_new_turn_async(system_turn)
         return system_turn
 
-    async def regenerate_last_system_message(self) -> DialogueTurn | None:
+    async def regenerate_last_system_message(self,
+                                             on_delta: ResponseDeltaHandler | None = None) -> DialogueTurn | None:
         if len(self.dialog) > 0 and self.dialog[len(self.dialog) - 1].is_user is False:
-            popped_system_turn = self._pop_last_turn()
-            system_message, metadata, elapsed = await self._response_generator.get_response(self._dialog, dry=True)
+            popped_system_turn = await self._pop_last_turn_async()
+            system_message, metadata, elapsed = await self._response_generator.get_response(self._dialog, dry=True,
+                                                                                              on_delta=on_delta)
             metadata = set_nested_value(metadata, "regenerated", True)
             metadata = set_nested_value(metadata, "original_turn", popped_system_turn.__dict__)
             new_system_turn = DialogueTurn(message=system_message, is_user=False, processing_time=elapsed, metadata=metadata)
-            self._push_new_turn(new_system_turn)
+            await self._push_new_turn_async(new_system_turn)
             return new_system_turn
         else:
             return None
@@ -152,7 +227,7 @@ class MultiAgentChatSession(ChatSessionBase):
             turn_count += 1
             system_message, payload, elapsed = await self._response_generator.get_response(self.dialog)
             system_turn = DialogueTurn(message=system_message, is_user=False, processing_time=elapsed, metadata=payload)
-            self._push_new_turn(system_turn)
+            await self._push_new_turn_async(system_turn)
             on_message(system_turn)
 
             role_reverted_dialog = [DialogueTurn(message=turn.message, is_user=turn.is_user is False) for turn in
@@ -161,7 +236,7 @@ class MultiAgentChatSession(ChatSessionBase):
             user_message, payload, elapsed = await self.__user_generator.get_response(role_reverted_dialog)
 
             user_turn = DialogueTurn(message=user_message, is_user=True, processing_time=elapsed, metadata=payload)
-            self._push_new_turn(user_turn)
+            await self._push_new_turn_async(user_turn)
             on_message(user_turn)
 
         return self.dialog
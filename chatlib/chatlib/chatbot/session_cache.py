@@ -0,0 +1,227 @@
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from time import monotonic
+from typing import Generic, TypeVar, Callable
+
+from pydantic import BaseModel, ConfigDict
+
+from .session import ChatSessionBase
+
+SessionType = TypeVar("SessionType", bound=ChatSessionBase)
+
+# Rough footprint of a session without its dialogue: the response generator, its sub-generators and their states.
+SESSION_BASE_BYTES = 64 * 1024
+TURN_OVERHEAD_BYTES = 512
+
+
+def estimate_session_bytes(session: ChatSessionBase) -> int:
+    return SESSION_BASE_BYTES + sum([sys.getsizeof(turn.message) + TURN_OVERHEAD_BYTES for turn in session.dialog])
+
+
+class ChatSessionCacheStats(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0  # Hibernated to keep the cache within its limits
+    expirations: int = 0  # Hibernated after being idle for the TTL
+    invalidations: int = 0  # Dropped because another process changed the session
+    size: int = 0
+    resident_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses > 0 else 0
+
+    def __str__(self) -> str:
+        return (f"{self.size} session(s) cached ({self.resident_bytes / 1024 / 1024:.1f} MB), "
+                f"hit rate {self.hit_rate * 100:.1f}%, {self.evictions} evicted, {self.expirations} expired, "
+                f"{self.invalidations} invalidated")
+
+
+class ChatSessionCache(Generic[SessionType]):
+    """
+    Keeps the active chat sessions in memory up to a maximum count and an estimated memory budget, in LRU order.
+    Sessions that exceed the limits or stay idle for the TTL are hibernated: they are saved and dropped from memory,
+    so that the next access misses and restores them from the session writer.
+    An entry can carry the version of the session it was loaded at, and an access with a different version misses.
+    """
+
+    def __init__(self, max_sessions: int | None = 1000, max_bytes: int | None = None,
+                 idle_ttl: float | None = None,
+                 size_estimator: Callable[[ChatSessionBase], int] = estimate_session_bytes,
+                 save_on_hibernate: bool = True):
+        """
+        :param max_sessions: Maximum number of sessions in memory. Unlimited if None.
+        :param max_bytes: Maximum estimated memory of the sessions in memory. Unlimited if None.
+        :param idle_ttl: Seconds after the last access when a session is hibernated. Never if None.
+        :param save_on_hibernate: Whether to save the sessions being hibernated. Set False if other processes may
+        change the sessions, in which case the sessions must be saved whenever they change.
+        """
+        self.__max_sessions = max_sessions
+        self.__max_bytes = max_bytes
+        self.__idle_ttl = idle_ttl
+        self.__size_estimator = size_estimator
+        self.__save_on_hibernate = save_on_hibernate
+
+        # session id => (session, last access, estimated bytes, version)
+        self.__entries: OrderedDict[str, tuple[SessionType, float, int, int | None]] = OrderedDict()
+        self.__resident_bytes = 0
+        self.__pin_counts: dict[str, int] = dict()
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+        self.__invalidations = 0
+
+    @property
+    def stats(self) -> ChatSessionCacheStats:
+        return ChatSessionCacheStats(hits=self.__hits, misses=self.__misses, evictions=self.__evictions,
+                                     expirations=self.__expirations, invalidations=self.__invalidations,
+                                     size=len(self.__entries),
+                                     resident_bytes=self.__resident_bytes)
+
+    @property
+    def session_ids(self) -> list[str]:
+        return list(self.__entries.keys())
+
+    def __is_expired(self, last_access: float, now: float) -> bool:
+        return self.__idle_ttl is not None and now - last_access >= self.__idle_ttl
+
+    def __contains__(self, session_id: str) -> bool:
+        entry = self.__entries.get(session_id)
+        return entry is not None and not self.__is_expired(entry[1], monotonic())
+
+    def __pop(self, session_id: str) -> SessionType | None:
+        entry = self.__entries.pop(session_id, None)
+        if entry is not None:
+            self.__resident_bytes -= entry[2]
+            return entry[0]
+        else:
+            return None
+
+    def __set(self, session_id: str, session: SessionType, version: int | None):
+        size = self.__size_estimator(session)
+        self.__entries[session_id] = (session, monotonic(), size, version)
+        self.__entries.move_to_end(session_id)
+        self.__resident_bytes += size
+
+    async def __hibernate(self, session: SessionType):
+        if self.__save_on_hibernate:
+            await session.save_async()
+        # Otherwise the dropped instance would write its info again, synchronously, when it is collected.
+        session.detach_writer()
+
+    def __find_eviction_candidate(self) -> str | None:
+        # The most recent entry is the one being accessed, so it always stays.
+        for session_id in islice(self.__entries, len(self.__entries) - 1):
+            if session_id not in self.__pin_counts:
+                return session_id
+        return None
+
+    async def __enforce_limits(self):
+        while ((self.__max_sessions is not None and len(self.__entries) > self.__max_sessions)
+               or (self.__max_bytes is not None and self.__resident_bytes > self.__max_bytes)):
+            session_id = self.__find_eviction_candidate()
+            if session_id is None:
+                break
+            session = self.__pop(session_id)
+            self.__evictions += 1
+            await self.__hibernate(session)
+
+    @contextmanager
+    def pin(self, session_id: str):
+        """
+        Keep a session from being hibernated while in the context, such as while a request on it is being served.
+        """
+        self.__pin_counts[session_id] = self.__pin_counts.get(session_id, 0) + 1
+        try:
+            yield
+        finally:
+            if self.__pin_counts[session_id] > 1:
+                self.__pin_counts[session_id] -= 1
+            else:
+                del self.__pin_counts[session_id]
+
+    async def get(self, session_id: str, version: int | None = None) -> SessionType | None:
+        """
+        :param version: Current version of the session. An entry of another version is dropped without saving.
+        """
+        entry = self.__entries.get(session_id)
+        if entry is None:
+            self.__misses += 1
+            return None
+        elif version is not None and entry[3] != version:
+            self.__pop(session_id)
+            self.__invalidations += 1
+            self.__misses += 1
+            entry[0].detach_writer()
+            return None
+        elif self.__is_expired(entry[1], monotonic()) and session_id not in self.__pin_counts:
+            self.__pop(session_id)
+            self.__expirations += 1
+            self.__misses += 1
+            await self.__hibernate(entry[0])
+            return None
+        else:
+            self.__hits += 1
+            # Re-estimate the size, as the session may have grown since the last access.
+            self.__pop(session_id)
+            self.__set(session_id, entry[0], entry[3])
+            await self.__enforce_limits()
+            return entry[0]
+
+    async def put(self, session_id: str, session: SessionType, version: int | None = None):
+        previous = self.__pop(session_id)
+        if previous is not None and previous is not session:
+            await self.__hibernate(previous)
+        self.__set(session_id, session, version)
+        await self.__enforce_limits()
+
+    def update_version(self, session_id: str, version: int | None):
+        """
+        Record the version of a session after changing it. If version is None, which means that the session may have
+        been changed by another process meanwhile, the session is dropped without saving.
+        """
+        entry = self.__entries.get(session_id)
+        if entry is None:
+            return
+        elif version is None:
+            self.__pop(session_id)
+            self.__invalidations += 1
+            entry[0].detach_writer()
+        else:
+            self.__entries[session_id] = entry[:3] + (version,)
+
+    def remove(self, session_id: str) -> SessionType | None:
+        """
+        Drop a session from memory without hibernating it.
+        """
+        return self.__pop(session_id)
+
+    async def clear(self):
+        """
+        Hibernate all sessions, such as on shutdown.
+        """
+        while len(self.__entries) > 0:
+            await self.__hibernate(self.__pop(next(iter(self.__entries))))
+
+    async def hibernate_idle_sessions(self) -> int:
+        """
+        :return: Number of sessions hibernated for being idle for the TTL.
+        """
+        now = monotonic()
+        expired_ids = [session_id for session_id, entry in self.__entries.items() if self.__is_expired(entry[1], now)]
+        num_hibernated = 0
+        for session_id in expired_ids:
+            # An entry may have been accessed or removed while an earlier session was being saved.
+            entry = self.__entries.get(session_id)
+            if entry is not None and self.__is_expired(entry[1], now) and session_id not in self.__pin_counts:
+                self.__pop(session_id)
+                self.__expirations += 1
+                num_hibernated += 1
+                await self.__hibernate(entry[0])
+        return num_hibernated
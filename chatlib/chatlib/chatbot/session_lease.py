@@ -0,0 +1,215 @@
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from os import path, getcwd, makedirs
+from typing import AsyncIterator
+
+from chatlib.chatlib.utils.time import get_timestamp
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_leases (
+    session_id TEXT PRIMARY KEY,
+    owner TEXT,
+    expires_at INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class SessionLeaseTimeoutError(Exception):
+    def __init__(self, session_id: str):
+        super().__init__(f"Timed out waiting for the lease of session {session_id}.")
+        self.session_id = session_id
+
+
+class SessionLease:
+    def __init__(self, session_id: str, version: int):
+        self.session_id = session_id
+        self.version = version  # Version when the lease was acquired
+        self.released_version: int | None = None
+
+
+class SessionLeaseManagerBase(ABC):
+    """
+    Grants a worker the exclusive right to mutate a session for a limited time.
+    Each session has a version that changes whenever a lease on it is released, so that a worker can tell
+    whether its in-memory instance of the session is still up to date.
+    """
+
+    @abstractmethod
+    def try_acquire(self, session_id: str, owner: str, ttl: float) -> int | None:
+        """
+        :param ttl: Seconds after which the lease expires unless renewed.
+        :return: The version of the session if the lease was acquired, or None if another owner holds it.
+        """
+        pass
+
+    @abstractmethod
+    def renew(self, session_id: str, owner: str, ttl: float) -> bool:
+        """
+        :return: False if the lease was lost to another owner.
+        """
+        pass
+
+    @abstractmethod
+    def release(self, session_id: str, owner: str) -> int | None:
+        """
+        :return: The new version of the session, or None if the lease had been lost to another owner.
+        """
+        pass
+
+    @abstractmethod
+    def get_version(self, session_id: str) -> int:
+        pass
+
+    async def get_version_async(self, session_id: str) -> int:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_version, session_id)
+
+    async def acquire(self, session_id: str, owner: str, ttl: float = 30, timeout: float = 60) -> int:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        retry_interval = 0.005
+        while True:
+            version = await loop.run_in_executor(None, self.try_acquire, session_id, owner, ttl)
+            if version is not None:
+                return version
+            elif loop.time() + retry_interval > deadline:
+                raise SessionLeaseTimeoutError(session_id)
+            await asyncio.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, 0.2)
+
+    @asynccontextmanager
+    async def hold(self, session_id: str, owner: str, ttl: float = 30,
+                   timeout: float = 60) -> AsyncIterator[SessionLease]:
+        """
+        Hold the lease of a session while in the context, renewing it before it expires.
+        """
+        loop = asyncio.get_running_loop()
+        lease = SessionLease(session_id, await self.acquire(session_id, owner, ttl, timeout))
+
+        async def renew_periodically():
+            while True:
+                await asyncio.sleep(ttl / 3)
+                if not await loop.run_in_executor(None, self.renew, session_id, owner, ttl):
+                    print(f"Lost the lease of session {session_id}.")
+                    return
+
+        renew_task = asyncio.create_task(renew_periodically())
+        try:
+            yield lease
+        finally:
+            renew_task.cancel()
+            lease.released_version = await loop.run_in_executor(None, self.release, session_id, owner)
+
+
+class LocalSessionLeaseManager(SessionLeaseManagerBase):
+    """
+    Leases within a single process. The version never changes, as no other process touches the sessions.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__leases: dict[str, tuple[str, int]] = dict()  # session id => (owner, expires at)
+
+    def try_acquire(self, session_id: str, owner: str, ttl: float) -> int | None:
+        now = get_timestamp()
+        with self.__lock:
+            lease = self.__leases.get(session_id)
+            if lease is None or lease[0] == owner or lease[1] <= now:
+                self.__leases[session_id] = (owner, now + int(ttl * 1000))
+                return 0
+            else:
+                return None
+
+    def renew(self, session_id: str, owner: str, ttl: float) -> bool:
+        with self.__lock:
+            lease = self.__leases.get(session_id)
+            if lease is not None and lease[0] == owner:
+                self.__leases[session_id] = (owner, get_timestamp() + int(ttl * 1000))
+                return True
+            else:
+                return False
+
+    def release(self, session_id: str, owner: str) -> int | None:
+        with self.__lock:
+            lease = self.__leases.get(session_id)
+            if lease is not None and lease[0] == owner:
+                del self.__leases[session_id]
+                return 0
+            else:
+                return None
+
+    def get_version(self, session_id: str) -> int:
+        return 0
+
+    async def get_version_async(self, session_id: str) -> int:
+        return 0
+
+
+class SqliteSessionLeaseManager(SessionLeaseManagerBase):
+    """
+    Leases shared by the worker processes through a SQLite database, by default the one of SqliteSessionWriter.
+    An expired lease may be taken over, which also changes the version of the session.
+    """
+
+    def __init__(self, db_path: str | None = None):
+        self.__db_path = db_path or path.join(getcwd(), "data/sessions.db")
+        self.__local = threading.local()
+
+        dir_path = path.dirname(self.__db_path)
+        if dir_path != "" and not path.exists(dir_path):
+            makedirs(dir_path)
+
+        self.__get_connection().executescript(_SCHEMA)
+
+    def __get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self.__local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.__db_path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self.__local.connection = conn
+        return conn
+
+    def try_acquire(self, session_id: str, owner: str, ttl: float) -> int | None:
+        now = get_timestamp()
+        conn = self.__get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at, version FROM session_leases WHERE session_id = ?",
+                               (session_id,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO session_leases (session_id, owner, expires_at) VALUES (?, ?, ?)",
+                             (session_id, owner, now + int(ttl * 1000)))
+                version = 0
+            elif row[0] is None or row[0] == owner or row[1] <= now:
+                # The previous owner of an expired lease may have left partial writes.
+                version = row[2] + 1 if row[0] is not None and row[0] != owner else row[2]
+                conn.execute("UPDATE session_leases SET owner = ?, expires_at = ?, version = ? WHERE session_id = ?",
+                             (owner, now + int(ttl * 1000), version, session_id))
+            else:
+                version = None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        return version
+
+    def renew(self, session_id: str, owner: str, ttl: float) -> bool:
+        return self.__get_connection().execute(
+            "UPDATE session_leases SET expires_at = ? WHERE session_id = ? AND owner = ?",
+            (get_timestamp() + int(ttl * 1000), session_id, owner)).rowcount > 0
+
+    def release(self, session_id: str, owner: str) -> int | None:
+        row = self.__get_connection().execute(
+            "UPDATE session_leases SET owner = NULL, expires_at = 0, version = version + 1 "
+            "WHERE session_id = ? AND owner = ? RETURNING version", (session_id, owner)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_version(self, session_id: str) -> int:
+        row = self.__get_connection().execute("SELECT version FROM session_leases WHERE session_id = ?",
+                                              (session_id,)).fetchone()
+        return row[0] if row is not None else 0
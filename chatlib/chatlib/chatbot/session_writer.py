@@ -1,15 +1,37 @@
+import atexit
+from array import array
 import json
 import shutil
+import hashlib
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from os import path, getcwd, makedirs
+from contextlib import contextmanager, nullcontext
+from functools import cache
+from typing import ContextManager, Callable, IO
+from enum import StrEnum
+from os import path, getcwd, makedirs, listdir, fsync, getenv, replace, remove, walk
+from time import time
 
 import jsonlines
+from pydantic import TypeAdapter, BaseModel, ConfigDict
 
 from .types import DialogueTurn, Dialogue
+from chatlib.chatlib.utils.time import get_timestamp
+
+
+class SessionWriteDurability(StrEnum):
+    None_ = "none"  # Buffered writes reach the files only when the buffer fills up or on shutdown.
+    Flush = "flush"  # Buffered writes are handed to the OS at every flush interval.
+    Fsync = "fsync"  # Like Flush, and the written files are fsynced.
 
 
 class SessionWriterBase(ABC):
 
+    # Whether writes should be fsynced. Implementations that support it honor this.
+    fsync: bool = False
+
     @abstractmethod
     def exists(self, session_id: str) -> bool:
         pass
@@ -20,6 +42,9 @@ class SessionWriterBase(ABC):
 
     @abstractmethod
     def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
+        """
+        :return: The deleted turn. Implementations that record the deletion without reading the dialogue return None.
+        """
         pass
 
     @abstractmethod
@@ -42,71 +67,756 @@ class SessionWriterBase(ABC):
     def clear_data(self, session_id) -> bool:
         pass
 
+    @abstractmethod
+    def list_session_ids(self) -> list[str]:
+        pass
+
+    @abstractmethod
+    def write_session_metadata(self, session_id: str, name: str, data: dict):
+        pass
+
+    @abstractmethod
+    def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        pass
+
+    def append_state_log(self, session_id: str, entries: list[dict]):
+        pass
+
+    def read_state_log(self, session_id: str) -> list[dict] | None:
+        return None
+
+    def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        """
+        :return: The last n turns of the dialogue.
+        """
+        dialogue = self.read_dialogue(session_id)
+        return dialogue[max(0, len(dialogue) - n):] if dialogue is not None else None
+
+    def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        """
+        :return: The turns that come after the turn, or None if the dialogue does not have the turn.
+        """
+        dialogue = self.read_dialogue(session_id)
+        if dialogue is not None:
+            for i, turn in enumerate(dialogue):
+                if turn.id == turn_id:
+                    return dialogue[i + 1:]
+        return None
+
+    def batch(self) -> ContextManager:
+        """
+        :return: A context in which the writes are committed together, if the implementation supports it.
+        """
+        return nullcontext()
+
+    def flush(self, session_id: str | None = None):
+        """
+        Make the writes made so far visible to other processes, if the implementation buffers them.
+        """
+        pass
+
+
+_created_directory_paths: set[str] = set()
+
+
+def _ensure_directory(p: str):
+    if p not in _created_directory_paths:
+        if not path.exists(p):
+            makedirs(p)
+        _created_directory_paths.add(p)
+
+
+TOMBSTONE_KEY = "deleted_turn_id"
+_TOMBSTONE_LINE_PREFIX = b'{"' + TOMBSTONE_KEY.encode() + b'"'
+
+_dialogue_adapter = TypeAdapter(list[DialogueTurn])
+
+_rehydration_lock = threading.Lock()
+
+SHARDED_LAYOUT_MARKER_FILE_NAME = ".sharded"
+SESSION_MANIFEST_FILE_NAME = "manifest.jsonl"
+
+
+def _get_sessions_root_path() -> str:
+    return path.join(getcwd(), "data/sessions/")
+
+
+@cache
+def _is_sharded_layout(root: str) -> bool:
+    """
+    A new sessions directory uses the sharded layout. An existing flat one stays flat until it is migrated
+    with migrate_to_sharded_layout().
+    """
+    if path.exists(path.join(root, SHARDED_LAYOUT_MARKER_FILE_NAME)):
+        return True
+    elif path.exists(root) and len(listdir(root)) > 0:
+        return False
+    else:
+        makedirs(root, exist_ok=True)
+        open(path.join(root, SHARDED_LAYOUT_MARKER_FILE_NAME), "w").close()
+        return True
+
+
+def _get_shard_path(session_id: str) -> str:
+    # Two levels of 256 directories each keep every directory small even with millions of sessions.
+    digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+    return path.join(digest[0:2], digest[2:4])
+
+
+def _get_session_directory_path(session_id: str) -> str:
+    root = _get_sessions_root_path()
+    if _is_sharded_layout(root):
+        return path.join(root, _get_shard_path(session_id), session_id)
+    else:
+        return path.join(root, session_id)
+
+
+def _get_session_archive_file_path(session_id: str) -> str:
+    archive_root = path.join(getcwd(), "data/archive/")
+    if _is_sharded_layout(_get_sessions_root_path()):
+        return path.join(archive_root, _get_shard_path(session_id), f"{session_id}.zip")
+    else:
+        return path.join(archive_root, f"{session_id}.zip")
+
+
+def get_phase_from_session_info(session_info: dict) -> str | None:
+    snapshot = (session_info.get("response_generator") or dict()).get("state_snapshot")
+    return snapshot.get("state") if snapshot is not None else None
+
+
+class SessionManifestEntry(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    id: str
+    created: int
+    last_activity: int
+    turns: int = 0
+    phase: str | None = None
+
+
+class SessionManifest:
+    """
+    In-memory index of the sessions in the sharded layout, persisted as an append-only log of entry updates.
+    The log is rewritten with the current entries when it grows to twice their number.
+    """
+
+    def __init__(self, fp: str):
+        self.__fp = fp
+        self.__entries: dict[str, SessionManifestEntry] | None = None
+        self.__num_records = 0
+        self.__lock = threading.Lock()
+
+    def __load(self) -> dict[str, SessionManifestEntry]:
+        if self.__entries is None:
+            self.__entries = dict()
+            if path.exists(self.__fp):
+                with jsonlines.open(self.__fp, "r") as reader:
+                    for record in reader:
+                        if record.get("removed") is True:
+                            self.__entries.pop(record["id"], None)
+                        else:
+                            self.__entries[record["id"]] = SessionManifestEntry(**record)
+                        self.__num_records += 1
+        return self.__entries
+
+    def get(self, session_id: str) -> SessionManifestEntry | None:
+        with self.__lock:
+            return self.__load().get(session_id)
+
+    def get_all(self) -> list[SessionManifestEntry]:
+        with self.__lock:
+            return list(self.__load().values())
+
+    def __append(self, record: dict):
+        with open(self.__fp, "a", encoding="utf-8") as f:
+            jsonlines.Writer(f).write(record)
+        self.__num_records += 1
+        if self.__num_records > 2 * len(self.__entries) + 64:
+            self.__rewrite()
+
+    def __rewrite(self):
+        temp_fp = self.__fp + ".tmp"
+        with open(temp_fp, "w", encoding="utf-8") as f:
+            jsonlines.Writer(f).write_all([entry.model_dump() for entry in self.__entries.values()])
+        replace(temp_fp, self.__fp)
+        self.__num_records = len(self.__entries)
+
+    def update(self, session_id: str, turns: int | None = None, phase: str | None = None):
+        with self.__lock:
+            entries = self.__load()
+            now = get_timestamp()
+            entry = entries.get(session_id)
+            if entry is None:
+                entry = SessionManifestEntry(id=session_id, created=now, last_activity=now, turns=turns or 0,
+                                             phase=phase)
+            else:
+                entry = entry.model_copy(update=dict(last_activity=now,
+                                                     turns=turns if turns is not None else entry.turns,
+                                                     phase=phase if phase is not None else entry.phase))
+            entries[session_id] = entry
+            self.__append(entry.model_dump())
+
+    def remove(self, session_id: str):
+        with self.__lock:
+            if self.__load().pop(session_id, None) is not None:
+                self.__append(dict(id=session_id, removed=True))
+
+    def replace_entries(self, entries: list[SessionManifestEntry]):
+        with self.__lock:
+            self.__load()
+            self.__entries = {entry.id: entry for entry in entries}
+            self.__rewrite()
+
+
+@cache
+def _get_session_manifest(root: str) -> SessionManifest:
+    return SessionManifest(path.join(root, SESSION_MANIFEST_FILE_NAME))
+
+
+def _rehydrate_session(session_id: str, dir_path: str) -> bool:
+    """
+    Extract an archived session back into its directory.
+    :return: True if the session directory exists afterwards.
+    """
+    with _rehydration_lock:
+        if path.exists(dir_path):
+            return True
+        archive_fp = _get_session_archive_file_path(session_id)
+        if not path.exists(archive_fp):
+            return False
+        temp_dir_path = dir_path + ".rehydrating"
+        with zipfile.ZipFile(archive_fp, "r") as archive:
+            archive.extractall(temp_dir_path)
+        replace(temp_dir_path, dir_path)
+        remove(archive_fp)
+        print(f"Rehydrated the archived session {session_id}.")
+        return True
+
+
+class SessionArchiveResult(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    num_archived: int = 0
+    original_bytes: int = 0
+    archived_bytes: int = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.archived_bytes
+
+    def __str__(self):
+        return (f"Archived {self.num_archived} session(s): {self.original_bytes} bytes -> {self.archived_bytes} bytes "
+                f"({self.saved_bytes} bytes saved)")
+
+
+def _encode_jsonl_row(row: dict) -> bytes:
+    # Same format as jsonlines.Writer
+    return (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _copy_json_value(value):
+    """
+    Copy a JSON-serializable value as it would be written, detached from the objects that it was built from.
+    """
+    return json.loads(json.dumps(value))
+
+
+def _diff_session_info(old: dict, new: dict, prefix: list, updates: list, removals: list):
+    for key, value in new.items():
+        if key not in old:
+            updates.append([prefix + [key], value])
+        else:
+            old_value = old[key]
+            if old_value != value:
+                if isinstance(old_value, dict) and isinstance(value, dict):
+                    _diff_session_info(old_value, value, prefix + [key], updates, removals)
+                else:
+                    updates.append([prefix + [key], value])
+    for key in old.keys():
+        if key not in new:
+            removals.append(prefix + [key])
+
+
+def _apply_session_info_event(info: dict, event: dict):
+    for key_path, value in event.get("set", []):
+        node = info
+        for key in key_path[:-1]:
+            node = node.setdefault(key, dict())
+        node[key_path[-1]] = value
+    for key_path in event.get("unset", []):
+        node = info
+        for key in key_path[:-1]:
+            node = node.get(key, dict())
+        node.pop(key_path[-1], None)
+
 
 class SessionFileWriter(SessionWriterBase):
+    """
+    Stores each session as a directory under data/sessions/, nested in two levels of directories named after
+    the hash of the session ID. A manifest of the sessions in data/sessions/manifest.jsonl serves the listings.
+    Sessions directories created before the sharded layout keep the flat layout until they are migrated.
+    Deleting a turn appends a tombstone record to dialogue.jsonl, which readers apply on load. Once a dialogue file
+    holds more tombstones than the compaction threshold, it is rewritten without them in the background.
+    Alongside dialogue.jsonl, dialogue.idx holds the byte offset of each line, so that the recent turns can be read
+    with a seek. The index is rebuilt on read when it is missing or stale.
+    Session info is stored as an event log: info.json holds a snapshot, and each later write appends only the
+    changed values to info_events.jsonl. Every snapshot_interval events, the snapshot is rewritten and the log is
+    cleared. Reading the info replays the log on the snapshot.
+    """
+
+    def __init__(self, fsync: bool = False, compaction_tombstone_threshold: int = 16, snapshot_interval: int = 32):
+        """
+        :param fsync: If True, every written file is fsynced before it is closed.
+        :param compaction_tombstone_threshold: Number of tombstones in a dialogue file that triggers its compaction.
+        :param snapshot_interval: Number of session info events after which a new snapshot is written.
+        If 0, every write rewrites the snapshot.
+        """
+        self.fsync = fsync
+        self.__compaction_tombstone_threshold = compaction_tombstone_threshold
+        self.__snapshot_interval = snapshot_interval
+
+        # session id => (last written session info, number of events since its snapshot)
+        self.__session_info_states: dict[str, tuple[dict, int]] = dict()
+
+        self.__tombstone_counts: dict[str, int] = dict()
+        self.__session_locks: dict[str, threading.Lock] = dict()
+        self.__session_locks_lock = threading.Lock()
+        self.__compaction_executor: ThreadPoolExecutor | None = None
+
+    def __get_session_lock(self, session_id: str) -> threading.Lock:
+        with self.__session_locks_lock:
+            lock = self.__session_locks.get(session_id)
+            if lock is None:
+                lock = threading.Lock()
+                self.__session_locks[session_id] = lock
+            return lock
 
     @staticmethod
-    def __get_dialogue_directory_path(session_id: str, create: bool = False) -> str:
-        p = path.join(getcwd(), "data/sessions/", session_id)
-        if not path.exists(p) and create:
-            makedirs(p)
+    def __get_dialogue_directory_path(session_id: str, create: bool = False, rehydrate: bool = True) -> str:
+        p = _get_session_directory_path(session_id)
+        if p not in _created_directory_paths and rehydrate and _rehydrate_session(session_id, p):
+            _created_directory_paths.add(p)
+        if create:
+            _ensure_directory(p)
         return p
 
+    @contextmanager
+    def __open_for_write(self, fp: str, mode: str):
+        f = open(fp, mode, encoding=None if "b" in mode else 'utf-8')
+        try:
+            yield f
+            if self.fsync:
+                f.flush()
+                fsync(f.fileno())
+        finally:
+            f.close()
+
     @staticmethod
     def __get_dialogue_file_path(session_id: str, create_dir: bool = False) -> str:
         dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id, create=create_dir)
         return path.join(dir_path, "dialogue.jsonl")
 
+    @staticmethod
+    def __get_dialogue_index_file_path(session_id: str) -> str:
+        return path.join(SessionFileWriter.__get_dialogue_directory_path(session_id), "dialogue.idx")
+
     @staticmethod
     def __get_session_info_file_path(session_id: str, create_dir: bool = False) -> str:
         dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id, create_dir)
         return path.join(dir_path, "info.json")
 
+    @staticmethod
+    def __get_session_info_event_file_path(session_id: str) -> str:
+        return path.join(SessionFileWriter.__get_dialogue_directory_path(session_id), "info_events.jsonl")
+
+    @staticmethod
+    def __get_session_metadata_file_path(session_id: str, name: str, create_dir: bool = False) -> str:
+        dir_path = path.join(SessionFileWriter.__get_dialogue_directory_path(session_id, create_dir), "metadata")
+        if create_dir:
+            _ensure_directory(dir_path)
+        return path.join(dir_path, f"{name}.json")
+
+    @staticmethod
+    def __get_state_log_file_path(session_id: str, create_dir: bool = False) -> str:
+        dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id, create_dir)
+        return path.join(dir_path, "state_log.jsonl")
+
+    @staticmethod
+    def __get_manifest() -> SessionManifest | None:
+        root = _get_sessions_root_path()
+        return _get_session_manifest(root) if _is_sharded_layout(root) else None
+
+    def list_session_manifest_entries(self) -> list[SessionManifestEntry] | None:
+        """
+        :return: Manifest entries of all sessions, or None in the flat layout, which has no manifest.
+        """
+        manifest = self.__get_manifest()
+        return manifest.get_all() if manifest is not None else None
+
     def exists(self, session_id: str) -> bool:
-        return path.exists(self.__get_session_info_file_path(session_id))
+        manifest = self.__get_manifest()
+        if manifest is not None and manifest.get(session_id) is not None:
+            return True
+        # Does not rehydrate archived sessions.
+        return path.exists(path.join(self.__get_dialogue_directory_path(session_id, rehydrate=False), "info.json")) \
+            or path.exists(_get_session_archive_file_path(session_id))
 
     def write_session_info(self, session_id, session_info: dict):
-        with open(self.__get_session_info_file_path(session_id, True), "w", encoding='utf-8') as f:
-            json.dump(session_info, f, indent=2)
+        # The last written info is kept detached, since the caller may change nested values in place before the next
+        # write, which must still differ from it.
+        session_info = _copy_json_value(session_info)
+        with self.__get_session_lock(session_id):
+            state = self.__session_info_states.get(session_id)
+            if state is None and self.__snapshot_interval > 0 and self.exists(session_id):
+                state = self.__read_session_info_with_event_count(session_id)
 
-    def read_session_info(self, session_id) -> dict:
+            if state is None or state[1] >= self.__snapshot_interval:
+                self.__write_atomically(self.__get_session_info_file_path(session_id, True),
+                                        lambda f: json.dump(session_info, f, indent=2))
+                event_fp = self.__get_session_info_event_file_path(session_id)
+                if state is not None and path.exists(event_fp):
+                    remove(event_fp)
+                self.__session_info_states[session_id] = (session_info, 0)
+            else:
+                updates, removals = [], []
+                _diff_session_info(state[0], session_info, [], updates, removals)
+                num_events = state[1]
+                if len(updates) > 0 or len(removals) > 0:
+                    with self.__open_for_write(self.__get_session_info_event_file_path(session_id), "a") as f:
+                        jsonlines.Writer(f).write({"set": updates, "unset": removals} if len(removals) > 0
+                                                  else {"set": updates})
+                    num_events += 1
+                self.__session_info_states[session_id] = (session_info, num_events)
+
+        manifest = self.__get_manifest()
+        if manifest is not None:
+            manifest.update(session_id, turns=session_info.get("turns"),
+                            phase=get_phase_from_session_info(session_info))
+
+    def __read_session_info_with_event_count(self, session_id: str) -> tuple[dict, int]:
         with open(self.__get_session_info_file_path(session_id), 'r', encoding='utf-8') as f:
-            return json.load(f)
+            info = json.load(f)
+        num_events = 0
+        event_fp = self.__get_session_info_event_file_path(session_id)
+        if path.exists(event_fp):
+            with jsonlines.open(event_fp, "r") as reader:
+                for event in reader:
+                    _apply_session_info_event(info, event)
+                    num_events += 1
+        return info, num_events
+
+    def read_session_info(self, session_id) -> dict:
+        with self.__get_session_lock(session_id):
+            return self.__read_session_info_with_event_count(session_id)[0]
 
     def write_turn(self, session_id: str, turn: DialogueTurn):
-        with jsonlines.open(self.__get_dialogue_file_path(session_id, True), 'a') as writer:
-            writer.write(turn.__dict__)
+        self.write_turns(session_id, [turn])
 
-    def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
-        dialogue = self.read_dialogue(session_id)
-        deleted_turn = None
-        for i, turn in enumerate(dialogue):
-            if turn.id == turn_id:
-                deleted_turn = dialogue.pop(i)
-                break
+    def write_turns(self, session_id: str, turns: list[DialogueTurn]):
+        with self.__get_session_lock(session_id):
+            self.__append_dialogue_rows(session_id, self.__get_dialogue_file_path(session_id, True),
+                                        [turn.__dict__ for turn in turns])
 
-        if deleted_turn is not None:
-            self.write_dialogue(session_id, dialogue)
+    def __append_dialogue_rows(self, session_id: str, fp: str, rows: list[dict]):
+        lines = [_encode_jsonl_row(row) for row in rows]
+        file_size = path.getsize(fp) if path.exists(fp) else 0
+        with self.__open_for_write(fp, "ab") as f:
+            f.write(b"".join(lines))
 
-        return deleted_turn
+        # Without an index, the file is indexed when it is read next time.
+        index_fp = self.__get_dialogue_index_file_path(session_id)
+        if file_size == 0 or path.exists(index_fp):
+            offsets = array("Q")
+            offset = file_size
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            with self.__open_for_write(index_fp, "ab" if file_size > 0 else "wb") as f:
+                offsets.tofile(f)
+
+    def delete_turn(self, session_id: str, turn_id: str) -> None:
+        self.delete_turns(session_id, [turn_id])
+
+    def delete_turns(self, session_id: str, turn_ids: list[str]):
+        fp = self.__get_dialogue_file_path(session_id)
+        if len(turn_ids) == 0 or not path.exists(fp):
+            return
+
+        with self.__get_session_lock(session_id):
+            self.__append_dialogue_rows(session_id, fp, [{TOMBSTONE_KEY: turn_id} for turn_id in turn_ids])
+            num_tombstones = self.__tombstone_counts.get(session_id, 0) + len(turn_ids)
+            self.__tombstone_counts[session_id] = num_tombstones
+
+        if num_tombstones > self.__compaction_tombstone_threshold:
+            if self.__compaction_executor is None:
+                self.__compaction_executor = ThreadPoolExecutor(max_workers=1,
+                                                                thread_name_prefix="session-compaction")
+            self.__compaction_executor.submit(self.compact_dialogue, session_id)
+
+    @staticmethod
+    def __read_dialogue_rows(fp: str) -> tuple[list[dict], int]:
+        """
+        :return: Rows of the turns that were not deleted, and the number of tombstones in the file.
+        """
+        with jsonlines.open(fp, "r") as reader:
+            rows = [row for row in reader]
+        turn_rows = [row for row in rows if TOMBSTONE_KEY not in row]
+        num_tombstones = len(rows) - len(turn_rows)
+        if num_tombstones > 0:
+            deleted_turn_ids = set([row[TOMBSTONE_KEY] for row in rows if TOMBSTONE_KEY in row])
+            turn_rows = [row for row in turn_rows if row["id"] not in deleted_turn_ids]
+        return turn_rows, num_tombstones
+
+    @staticmethod
+    def __decode_dialogue_content(content: bytes) -> tuple[Dialogue, int]:
+        """
+        Validate all turns in a single call instead of one model construction per row.
+        :param content: Consecutive lines of a dialogue file.
+        :return: Turns that were not deleted by the tombstones in the content, and the number of the tombstones.
+        """
+        content = content.strip()
+        if _TOMBSTONE_LINE_PREFIX not in content:
+            return _dialogue_adapter.validate_json(b"[" + content.replace(b"\n", b",") + b"]"), 0
+
+        lines = [line for line in content.split(b"\n") if len(line.strip()) > 0]
+        turn_lines = [line for line in lines if not line.startswith(_TOMBSTONE_LINE_PREFIX)]
+        dialogue = _dialogue_adapter.validate_json(b"[" + b",".join(turn_lines) + b"]")
+        deleted_turn_ids = set([json.loads(line)[TOMBSTONE_KEY] for line in lines
+                                if line.startswith(_TOMBSTONE_LINE_PREFIX)])
+        return [turn for turn in dialogue if turn.id not in deleted_turn_ids], len(lines) - len(turn_lines)
 
     def read_dialogue(self, session_id: str) -> Dialogue | None:
         fp = self.__get_dialogue_file_path(session_id)
         if path.exists(fp):
-            with jsonlines.open(fp, "r") as reader:
-                return [DialogueTurn(**row) for row in reader]
+            with open(fp, "rb") as f:
+                dialogue, num_tombstones = self.__decode_dialogue_content(f.read())
+            self.__tombstone_counts[session_id] = num_tombstones
+            return dialogue
         else:
             return None
 
+    def __load_dialogue_index(self, session_id: str, fp: str) -> array:
+        """
+        :return: Offsets of the lines in the dialogue file. The index is rebuilt if it does not match the file.
+        """
+        index_fp = self.__get_dialogue_index_file_path(session_id)
+        file_size = path.getsize(fp)
+        offsets = array("Q")
+        if path.exists(index_fp):
+            with open(index_fp, "rb") as f:
+                offsets.frombytes(f.read())
+            if len(offsets) > 0:
+                with open(fp, "rb") as f:
+                    f.seek(offsets[-1])
+                    last_line = f.readline()
+                if offsets[-1] + len(last_line) == file_size and last_line.endswith(b"\n"):
+                    return offsets
+
+        offsets = array("Q")
+        with open(fp, "rb") as f:
+            content = f.read()
+        offset = 0
+        while offset < len(content):
+            offsets.append(offset)
+            next_line = content.find(b"\n", offset)
+            offset = len(content) if next_line < 0 else next_line + 1
+        with self.__open_for_write(index_fp, "wb") as f:
+            offsets.tofile(f)
+        return offsets
+
+    def __read_dialogue_tail(self, session_id: str, is_enough: Callable[[Dialogue], bool]) -> Dialogue | None:
+        """
+        Decode windows at the end of the dialogue file, doubling the window until is_enough is satisfied.
+        """
+        fp = self.__get_dialogue_file_path(session_id)
+        if not path.exists(fp):
+            return None
+        with self.__get_session_lock(session_id):
+            offsets = self.__load_dialogue_index(session_id, fp)
+            window_size = 16
+            with open(fp, "rb") as f:
+                while True:
+                    start = max(0, len(offsets) - window_size)
+                    f.seek(offsets[start] if start < len(offsets) else 0)
+                    dialogue = self.__decode_dialogue_content(f.read())[0]
+                    if start == 0 or is_enough(dialogue):
+                        return dialogue
+                    window_size *= 2
+
+    def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        dialogue = self.__read_dialogue_tail(session_id, lambda window: len(window) >= n)
+        return dialogue[max(0, len(dialogue) - n):] if dialogue is not None else None
+
+    def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        # A tombstone always follows its turn, so a window that holds a deleted turn also holds its tombstone.
+        dialogue = self.__read_dialogue_tail(session_id, lambda window: any([turn.id == turn_id for turn in window]))
+        if dialogue is not None:
+            for i, turn in enumerate(dialogue):
+                if turn.id == turn_id:
+                    return dialogue[i + 1:]
+        return None
+
+    def __write_atomically(self, fp: str, write: Callable[[IO], None]):
+        # Write a temporary file and rename it over the original, so that a crash never leaves a partial file.
+        temp_fp = fp + ".tmp"
+        with self.__open_for_write(temp_fp, "w") as f:
+            write(f)
+        replace(temp_fp, fp)
+
+    def __rewrite_dialogue_file(self, fp: str, rows: list[dict]):
+        self.__write_atomically(fp, lambda f: jsonlines.Writer(f).write_all(rows))
+        index_fp = path.join(path.dirname(fp), "dialogue.idx")
+        if path.exists(index_fp):
+            remove(index_fp)
+
     def write_dialogue(self, session_id: str, dialog: Dialogue):
         fp = self.__get_dialogue_file_path(session_id)
         if path.exists(fp):
-            with jsonlines.open(fp, "w") as writer:
-                writer.write_all([turn.__dict__ for turn in dialog])
+            with self.__get_session_lock(session_id):
+                self.__rewrite_dialogue_file(fp, [turn.__dict__ for turn in dialog])
+                self.__tombstone_counts[session_id] = 0
+
+    def compact_dialogue(self, session_id: str):
+        """
+        Rewrite the dialogue file of a session without tombstones and the turns they delete.
+        """
+        fp = self.__get_dialogue_file_path(session_id)
+        with self.__get_session_lock(session_id):
+            if path.exists(fp):
+                rows, num_tombstones = self.__read_dialogue_rows(fp)
+                if num_tombstones > 0:
+                    self.__rewrite_dialogue_file(fp, rows)
+                self.__tombstone_counts[session_id] = 0
+
+    def append_state_log(self, session_id: str, entries: list[dict]):
+        if len(entries) > 0:
+            with self.__open_for_write(self.__get_state_log_file_path(session_id, True), "a") as f:
+                jsonlines.Writer(f).write_all(entries)
+
+    def read_state_log(self, session_id: str) -> list[dict] | None:
+        fp = self.__get_state_log_file_path(session_id)
+        if path.exists(fp):
+            with jsonlines.open(fp, "r") as reader:
+                return [row for row in reader]
+        else:
+            return None
+
+    def list_session_ids(self) -> list[str]:
+        manifest = self.__get_manifest()
+        if manifest is not None:
+            return [entry.id for entry in manifest.get_all()]
+
+        session_ids = []
+        sessions_dir_path = _get_sessions_root_path()
+        if path.exists(sessions_dir_path):
+            session_ids.extend([session_id for session_id in listdir(sessions_dir_path) if self.exists(session_id)])
+        archive_dir_path = path.dirname(_get_session_archive_file_path(""))
+        if path.exists(archive_dir_path):
+            session_ids.extend([path.splitext(file_name)[0] for file_name in listdir(archive_dir_path)
+                                if file_name.endswith(".zip")])
+        return session_ids
+
+    def is_archived(self, session_id: str) -> bool:
+        return path.exists(_get_session_archive_file_path(session_id))
+
+    def archive_session(self, session_id: str) -> tuple[int, int] | None:
+        """
+        Pack the files of a session into a compressed archive and remove the session directory.
+        Any later access to the session rehydrates it.
+        :return: Sizes of the session files and of the archive in bytes, or None if the session was not archived.
+        """
+        dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id, rehydrate=False)
+        with self.__get_session_lock(session_id), _rehydration_lock:
+            if not path.exists(dir_path):
+                return None
+
+            archive_fp = _get_session_archive_file_path(session_id)
+            _ensure_directory(path.dirname(archive_fp))
+            original_bytes = 0
+            temp_archive_fp = archive_fp + ".tmp"
+            with zipfile.ZipFile(temp_archive_fp, "w", compression=zipfile.ZIP_LZMA) as archive:
+                for root, dir_names, file_names in walk(dir_path):
+                    for file_name in file_names:
+                        if file_name == "dialogue.idx":
+                            continue  # Rebuilt on read
+                        fp = path.join(root, file_name)
+                        original_bytes += path.getsize(fp)
+                        archive.write(fp, path.relpath(fp, dir_path))
+            if self.fsync:
+                with open(temp_archive_fp, "rb") as f:
+                    fsync(f.fileno())
+            replace(temp_archive_fp, archive_fp)
+
+            _created_directory_paths.difference_update([p for p in _created_directory_paths if p.startswith(dir_path)])
+            shutil.rmtree(dir_path)
+            return original_bytes, path.getsize(archive_fp)
+
+    def archive_idle_sessions(self, idle_seconds: float, exclude: set[str] | None = None) -> SessionArchiveResult:
+        """
+        Archive the sessions whose files were not modified for idle_seconds.
+        :param exclude: IDs of sessions not to archive, such as the ones in memory.
+        """
+        now = time()
+        num_archived, original_bytes, archived_bytes = 0, 0, 0
+        sessions_dir_path = _get_sessions_root_path()
+        manifest = self.__get_manifest()
+        if manifest is not None:
+            # The manifest knows the last activities, so the directories need not be scanned.
+            for entry in manifest.get_all():
+                if (exclude is None or entry.id not in exclude) and now - entry.last_activity / 1000 >= idle_seconds:
+                    sizes = self.archive_session(entry.id)
+                    if sizes is not None:
+                        num_archived += 1
+                        original_bytes += sizes[0]
+                        archived_bytes += sizes[1]
+        elif path.exists(sessions_dir_path):
+            for session_id in listdir(sessions_dir_path):
+                if exclude is not None and session_id in exclude or session_id.endswith(".rehydrating"):
+                    continue
+                dir_path = path.join(sessions_dir_path, session_id)
+                last_modified = max([path.getmtime(path.join(root, file_name))
+                                     for root, dir_names, file_names in walk(dir_path) for file_name in file_names],
+                                    default=path.getmtime(dir_path))
+                if now - last_modified >= idle_seconds:
+                    sizes = self.archive_session(session_id)
+                    if sizes is not None:
+                        num_archived += 1
+                        original_bytes += sizes[0]
+                        archived_bytes += sizes[1]
+        return SessionArchiveResult(num_archived=num_archived, original_bytes=original_bytes,
+                                    archived_bytes=archived_bytes)
+
+    def write_session_metadata(self, session_id: str, name: str, data: dict):
+        with self.__open_for_write(self.__get_session_metadata_file_path(session_id, name, True), "w") as f:
+            json.dump(data, f, indent=2)
+
+    def list_session_metadata_names(self, session_id: str) -> list[str]:
+        dir_path = path.join(SessionFileWriter.__get_dialogue_directory_path(session_id), "metadata")
+        if path.exists(dir_path):
+            return [path.splitext(file_name)[0] for file_name in listdir(dir_path) if file_name.endswith(".json")]
+        else:
+            return []
+
+    def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        fp = self.__get_session_metadata_file_path(session_id, name)
+        if path.exists(fp):
+            with open(fp, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        else:
+            return None
 
     def clear_data(self, session_id) -> bool:
-        dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id)
+        dir_path = SessionFileWriter.__get_dialogue_directory_path(session_id, rehydrate=False)
+        self.__tombstone_counts.pop(session_id, None)
+        self.__session_info_states.pop(session_id, None)
+        manifest = self.__get_manifest()
+        if manifest is not None:
+            manifest.remove(session_id)
+        is_archived = self.is_archived(session_id)
+        if is_archived:
+            remove(_get_session_archive_file_path(session_id))
         if path.exists(dir_path):
+            _created_directory_paths.difference_update([p for p in _created_directory_paths if p.startswith(dir_path)])
             try:
                 shutil.rmtree(dir_path)
                 return True
@@ -114,7 +824,339 @@ class SessionFileWriter(SessionWriterBase):
                 print(f"Error while removing the session directory {dir_path} - {e}")
                 return False
         else:
-            return False
+            return is_archived
+
+
+def _get_session_created_timestamp(dir_path: str) -> int | None:
+    dialogue_fp = path.join(dir_path, "dialogue.jsonl")
+    if path.exists(dialogue_fp):
+        with jsonlines.open(dialogue_fp, "r") as reader:
+            for row in reader:
+                if "timestamp" in row:
+                    return row["timestamp"]
+    return None
+
+
+def migrate_to_sharded_layout() -> int:
+    """
+    Move the session directories and archives of the flat layout into the sharded layout, and build the
+    session manifest. The server must not be running.
+    :return: Number of sessions moved.
+    """
+    root = _get_sessions_root_path()
+    if _is_sharded_layout(root):
+        return 0
+
+    archive_root = path.join(getcwd(), "data/archive/")
+    archived_session_ids = [path.splitext(file_name)[0] for file_name in listdir(archive_root)
+                            if file_name.endswith(".zip")] if path.exists(archive_root) else []
+    session_ids = [file_name for file_name in listdir(root) if not file_name.endswith(".rehydrating")
+                   and (path.exists(path.join(root, file_name, "info.json"))
+                        or path.exists(path.join(root, file_name, "dialogue.jsonl")))]
+
+    # Read the manifest entries while the sessions are still where the flat layout expects them.
+    entries = []
+    reader = SessionFileWriter()
+    for session_id in session_ids:
+        dir_path = path.join(root, session_id)
+        last_activity = int(max([path.getmtime(path.join(dir_root, file_name))
+                                 for dir_root, dir_names, file_names in walk(dir_path) for file_name in file_names],
+                                default=path.getmtime(dir_path)) * 1000)
+        # A session may have been left with only its dialogue.
+        session_info = reader.read_session_info(session_id) \
+            if path.exists(path.join(dir_path, "info.json")) else dict()
+        entries.append(SessionManifestEntry(id=session_id,
+                                            created=_get_session_created_timestamp(dir_path) or last_activity,
+                                            last_activity=last_activity, turns=session_info.get("turns") or 0,
+                                            phase=get_phase_from_session_info(session_info)))
+    for session_id in archived_session_ids:
+        fp = path.join(archive_root, f"{session_id}.zip")
+        last_activity = int(path.getmtime(fp) * 1000)
+        session_info = dict()
+        with zipfile.ZipFile(fp, "r") as archive:
+            names = archive.namelist()
+            if "info.json" in names:
+                session_info = json.loads(archive.read("info.json"))
+            if "info_events.jsonl" in names:
+                for line in archive.read("info_events.jsonl").decode("utf-8").splitlines():
+                    if line.strip():
+                        _apply_session_info_event(session_info, json.loads(line))
+        entries.append(SessionManifestEntry(id=session_id, created=last_activity, last_activity=last_activity,
+                                            turns=session_info.get("turns") or 0,
+                                            phase=get_phase_from_session_info(session_info)))
+
+    for session_id in session_ids:
+        target_path = path.join(root, _get_shard_path(session_id), session_id)
+        makedirs(path.dirname(target_path), exist_ok=True)
+        replace(path.join(root, session_id), target_path)
+    for session_id in archived_session_ids:
+        target_path = path.join(archive_root, _get_shard_path(session_id), f"{session_id}.zip")
+        makedirs(path.dirname(target_path), exist_ok=True)
+        replace(path.join(archive_root, f"{session_id}.zip"), target_path)
+
+    _get_session_manifest(root).replace_entries(entries)
+    open(path.join(root, SHARDED_LAYOUT_MARKER_FILE_NAME), "w").close()
+    _is_sharded_layout.cache_clear()
+    _created_directory_paths.clear()
+    return len(session_ids) + len(archived_session_ids)
+
+
+class _SessionWriteBuffer:
+    def __init__(self):
+        self.dialogue: Dialogue | None = None  # A pending rewrite of the whole dialogue
+        self.turns: list[DialogueTurn] = []
+        self.deleted_turn_ids: list[str] = []
+        self.session_info: dict | None = None
+        self.state_log: list[dict] = []
+        self.metadata: dict[str, dict] = dict()
+        self.write_count = 0
+
+
+class WriteBehindSessionWriter(SessionWriterBase):
+    """
+    Buffers writes per session in memory and lets a background thread write them through the base writer,
+    so that callers do not wait for disk I/O. Consecutive session info and metadata writes are coalesced
+    into the latest one. Reads of a session flush its buffer first.
+    """
+
+    def __init__(self, base: SessionWriterBase,
+                 durability: SessionWriteDurability = SessionWriteDurability.Flush,
+                 flush_interval: float = 1.0,
+                 max_buffered_writes: int = 256):
+        """
+        :param flush_interval: Seconds between background flushes. Ignored with SessionWriteDurability.None_.
+        :param max_buffered_writes: Number of buffered writes across sessions that triggers a flush.
+        """
+        self.__base = base
+        self.__durability = durability
+        self.__flush_interval = flush_interval
+        self.__max_buffered_writes = max_buffered_writes
+
+        base.fsync = durability == SessionWriteDurability.Fsync
+
+        self.__buffers: dict[str, _SessionWriteBuffer] = dict()
+        self.__buffered_write_count = 0
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()  # Keeps the writes of consecutive flushes in order.
+        self.__wakeup = threading.Condition(self.__lock)
+        self.__is_closed = False
+
+        self.__thread: threading.Thread | None = None
+
+    @property
+    def base(self) -> SessionWriterBase:
+        return self.__base
+
+    @property
+    def durability(self) -> SessionWriteDurability:
+        return self.__durability
+
+    def __ensure_thread(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name="session-write-behind", daemon=True)
+            self.__thread.start()
+            atexit.register(self.close)
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                if not self.__is_closed and self.__buffered_write_count < self.__max_buffered_writes:
+                    self.__wakeup.wait(
+                        None if self.__durability == SessionWriteDurability.None_ else self.__flush_interval)
+                if self.__is_closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error while flushing session writes - {e}")
+
+    def __buffer(self, session_id: str, update) -> bool:
+        """
+        :return: False if the writer is closed and the write should go through directly.
+        """
+        with self.__lock:
+            if self.__is_closed:
+                return False
+            buffer = self.__buffers.get(session_id)
+            if buffer is None:
+                buffer = _SessionWriteBuffer()
+                self.__buffers[session_id] = buffer
+            update(buffer)
+            buffer.write_count += 1
+            self.__buffered_write_count += 1
+            if self.__buffered_write_count >= self.__max_buffered_writes:
+                self.__wakeup.notify()
+        self.__ensure_thread()
+        return True
+
+    def __write_buffer(self, session_id: str, buffer: _SessionWriteBuffer):
+        if buffer.dialogue is not None:
+            self.__base.write_dialogue(session_id, buffer.dialogue)
+        if len(buffer.turns) > 0:
+            if isinstance(self.__base, SessionFileWriter):
+                self.__base.write_turns(session_id, buffer.turns)
+            else:
+                for turn in buffer.turns:
+                    self.__base.write_turn(session_id, turn)
+        if len(buffer.deleted_turn_ids) > 0:
+            if isinstance(self.__base, SessionFileWriter):
+                self.__base.delete_turns(session_id, buffer.deleted_turn_ids)
+            else:
+                for turn_id in buffer.deleted_turn_ids:
+                    self.__base.delete_turn(session_id, turn_id)
+        if buffer.session_info is not None:
+            self.__base.write_session_info(session_id, buffer.session_info)
+        if len(buffer.state_log) > 0:
+            self.__base.append_state_log(session_id, buffer.state_log)
+        for name, data in buffer.metadata.items():
+            self.__base.write_session_metadata(session_id, name, data)
+
+    def flush(self, session_id: str | None = None):
+        """
+        Write the buffered writes of a session, or of all sessions if session_id is None.
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                if session_id is None:
+                    buffers = self.__buffers
+                    self.__buffers = dict()
+                    self.__buffered_write_count = 0
+                else:
+                    buffer = self.__buffers.pop(session_id, None)
+                    buffers = {session_id: buffer} if buffer is not None else dict()
+                    self.__buffered_write_count -= buffer.write_count if buffer is not None else 0
+
+            if len(buffers) > 0:
+                with self.__base.batch():
+                    for sid, buffer in buffers.items():
+                        self.__write_buffer(sid, buffer)
+
+    def close(self):
+        """
+        Flush all buffered writes and stop the background thread. Later writes go through directly.
+        """
+        with self.__lock:
+            if self.__is_closed:
+                return
+            self.__is_closed = True
+            self.__wakeup.notify()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.flush()
+
+    # Writes ===========================================================
+
+    def write_turn(self, session_id: str, turn: DialogueTurn):
+        def update(buffer: _SessionWriteBuffer):
+            if buffer.dialogue is not None:
+                buffer.dialogue.append(turn)
+            else:
+                buffer.turns.append(turn)
+
+        if not self.__buffer(session_id, update):
+            self.__base.write_turn(session_id, turn)
+
+    def write_dialogue(self, session_id: str, dialog: Dialogue):
+        def update(buffer: _SessionWriteBuffer):
+            buffer.dialogue = list(dialog)
+            buffer.turns = []
+            buffer.deleted_turn_ids = []
+
+        if not self.__buffer(session_id, update):
+            self.__base.write_dialogue(session_id, dialog)
+
+    def write_session_info(self, session_id, session_info: dict):
+        def update(buffer: _SessionWriteBuffer):
+            # The background thread writes it later, while the session may keep changing the objects in it.
+            buffer.session_info = _copy_json_value(session_info)
+
+        if not self.__buffer(session_id, update):
+            self.__base.write_session_info(session_id, session_info)
+
+    def append_state_log(self, session_id: str, entries: list[dict]):
+        def update(buffer: _SessionWriteBuffer):
+            buffer.state_log.extend(_copy_json_value(entries))
+
+        if len(entries) > 0 and not self.__buffer(session_id, update):
+            self.__base.append_state_log(session_id, entries)
+
+    def write_session_metadata(self, session_id: str, name: str, data: dict):
+        def update(buffer: _SessionWriteBuffer):
+            buffer.metadata[name] = _copy_json_value(data)
+
+        if not self.__buffer(session_id, update):
+            self.__base.write_session_metadata(session_id, name, data)
+
+    # Reads see the flushed state. ===========================================
+
+    def exists(self, session_id: str) -> bool:
+        with self.__lock:
+            buffer = self.__buffers.get(session_id)
+            if buffer is not None and buffer.session_info is not None:
+                return True
+        return self.__base.exists(session_id)
+
+    def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
+        deleted_turn = None
+
+        def update(buffer: _SessionWriteBuffer):
+            nonlocal deleted_turn
+            # A turn that has not been written yet is simply dropped from the buffer.
+            pending_turns = buffer.dialogue if buffer.dialogue is not None else buffer.turns
+            for i, turn in enumerate(pending_turns):
+                if turn.id == turn_id:
+                    deleted_turn = pending_turns.pop(i)
+                    return
+            buffer.deleted_turn_ids.append(turn_id)
+
+        if not self.__buffer(session_id, update):
+            return self.__base.delete_turn(session_id, turn_id)
+        return deleted_turn
+
+    def read_dialogue(self, session_id: str) -> Dialogue:
+        self.flush(session_id)
+        return self.__base.read_dialogue(session_id)
+
+    def read_session_info(self, session_id) -> dict:
+        self.flush(session_id)
+        return self.__base.read_session_info(session_id)
+
+    def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        self.flush(session_id)
+        return self.__base.read_recent_turns(session_id, n)
+
+    def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        self.flush(session_id)
+        return self.__base.read_turns_after(session_id, turn_id)
+
+    def read_state_log(self, session_id: str) -> list[dict] | None:
+        self.flush(session_id)
+        return self.__base.read_state_log(session_id)
+
+    def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        self.flush(session_id)
+        return self.__base.read_session_metadata(session_id, name)
+
+    def list_session_ids(self) -> list[str]:
+        self.flush()
+        return self.__base.list_session_ids()
+
+    def clear_data(self, session_id) -> bool:
+        with self.__flush_lock:
+            with self.__lock:
+                buffer = self.__buffers.pop(session_id, None)
+                self.__buffered_write_count -= buffer.write_count if buffer is not None else 0
+            return self.__base.clear_data(session_id)
+
+
+def _make_session_store() -> SessionWriterBase:
+    if getenv("SESSION_STORE") == "sqlite":
+        from .sqlite_session_writer import SqliteSessionWriter
+        return SqliteSessionWriter()
+    else:
+        return SessionFileWriter()
 
 
-session_writer = SessionFileWriter()
+session_writer = WriteBehindSessionWriter(_make_session_store(),
+                                          durability=SessionWriteDurability(getenv("SESSION_WRITE_DURABILITY",
+                                                                                   SessionWriteDurability.Flush)))
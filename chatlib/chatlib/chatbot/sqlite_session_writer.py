@@ -0,0 +1,299 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from os import path, getcwd, makedirs
+from typing import Iterator
+
+from .session_writer import SessionWriterBase, SessionFileWriter, get_phase_from_session_info
+from .types import DialogueTurn, Dialogue
+from chatlib.chatlib.utils.time import get_timestamp
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    phase TEXT,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_phase ON sessions (phase);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    seq INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    is_user INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    processing_time INTEGER,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_turns_session_id ON turns (session_id);
+CREATE INDEX IF NOT EXISTS idx_turns_id ON turns (id);
+CREATE INDEX IF NOT EXISTS idx_turns_timestamp ON turns (timestamp);
+
+CREATE TABLE IF NOT EXISTS state_log (
+    seq INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    phase TEXT,
+    timestamp INTEGER,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_state_log_session_id ON state_log (session_id);
+CREATE INDEX IF NOT EXISTS idx_state_log_phase_timestamp ON state_log (phase, timestamp);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    session_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, name)
+);
+"""
+
+
+def _row_to_turn(row: tuple) -> DialogueTurn:
+    turn_id, message, is_user, timestamp, processing_time, metadata = row
+    return DialogueTurn(id=turn_id, message=message, is_user=bool(is_user), timestamp=timestamp,
+                        processing_time=processing_time,
+                        metadata=json.loads(metadata) if metadata is not None else None)
+
+
+class SqliteSessionWriter(SessionWriterBase):
+    """
+    Stores sessions in an embedded SQLite database in WAL mode, so that readers do not block the writer.
+    Each thread uses its own connection. Writes inside batch() are committed in a single transaction.
+    """
+
+    def __init__(self, db_path: str | None = None, fsync: bool = False):
+        """
+        :param db_path: Path of the database file. Defaults to data/sessions.db.
+        :param fsync: If True, every commit is synced to the disk (synchronous=FULL). Otherwise, commits are synced
+        at WAL checkpoints (synchronous=NORMAL), which keeps the database consistent but may lose the last commits
+        on a power loss.
+        """
+        self.__db_path = db_path or path.join(getcwd(), "data/sessions.db")
+        self.fsync = fsync
+        self.__local = threading.local()
+
+        dir_path = path.dirname(self.__db_path)
+        if dir_path != "" and not path.exists(dir_path):
+            makedirs(dir_path)
+
+        self.__get_connection().executescript(_SCHEMA)
+
+    @property
+    def db_path(self) -> str:
+        return self.__db_path
+
+    def __get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self.__local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.__db_path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self.__local.connection = conn
+            self.__local.transaction_depth = 0
+        return conn
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self.__get_connection()
+        if self.__local.transaction_depth > 0:
+            # Joins the enclosing transaction.
+            self.__local.transaction_depth += 1
+            try:
+                yield conn
+            finally:
+                self.__local.transaction_depth -= 1
+            return
+
+        conn.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        conn.execute("BEGIN IMMEDIATE")
+        self.__local.transaction_depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self.__local.transaction_depth = 0
+
+    def batch(self):
+        return self.__transaction()
+
+    def close(self):
+        """
+        Close the connection of the calling thread.
+        """
+        conn = getattr(self.__local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self.__local.connection = None
+
+    def exists(self, session_id: str) -> bool:
+        return self.__get_connection().execute("SELECT 1 FROM sessions WHERE id = ?",
+                                               (session_id,)).fetchone() is not None
+
+    def write_turn(self, session_id: str, turn: DialogueTurn):
+        self.write_turns(session_id, [turn])
+
+    def write_turns(self, session_id: str, turns: list[DialogueTurn]):
+        with self.__transaction() as conn:
+            conn.executemany(
+                "INSERT INTO turns (session_id, id, message, is_user, timestamp, processing_time, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(session_id, turn.id, turn.message, int(turn.is_user), turn.timestamp, turn.processing_time,
+                  json.dumps(turn.metadata) if turn.metadata is not None else None) for turn in turns])
+
+    def delete_turn(self, session_id: str, turn_id: str) -> DialogueTurn | None:
+        with self.__transaction() as conn:
+            row = conn.execute(
+                "SELECT seq, id, message, is_user, timestamp, processing_time, metadata FROM turns "
+                "WHERE id = ? AND session_id = ?", (turn_id, session_id)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM turns WHERE seq = ?", (row[0],))
+                return _row_to_turn(row[1:])
+            else:
+                return None
+
+    def read_dialogue(self, session_id: str) -> Dialogue | None:
+        conn = self.__get_connection()
+        rows = conn.execute(
+            "SELECT id, message, is_user, timestamp, processing_time, metadata FROM turns "
+            "WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        if len(rows) == 0 and not self.exists(session_id):
+            return None
+        return [_row_to_turn(row) for row in rows]
+
+    def read_recent_turns(self, session_id: str, n: int) -> Dialogue | None:
+        rows = self.__get_connection().execute(
+            "SELECT id, message, is_user, timestamp, processing_time, metadata FROM turns "
+            "WHERE session_id = ? ORDER BY seq DESC LIMIT ?", (session_id, n)).fetchall()
+        if len(rows) == 0 and not self.exists(session_id):
+            return None
+        return [_row_to_turn(row) for row in reversed(rows)]
+
+    def read_turns_after(self, session_id: str, turn_id: str) -> Dialogue | None:
+        conn = self.__get_connection()
+        row = conn.execute("SELECT seq FROM turns WHERE id = ? AND session_id = ?", (turn_id, session_id)).fetchone()
+        if row is None:
+            return None
+        return [_row_to_turn(row) for row in conn.execute(
+            "SELECT id, message, is_user, timestamp, processing_time, metadata FROM turns "
+            "WHERE session_id = ? AND seq > ? ORDER BY seq", (session_id, row[0]))]
+
+    def write_dialogue(self, session_id: str, dialog: Dialogue):
+        with self.__transaction() as conn:
+            conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self.write_turns(session_id, dialog)
+
+    def write_session_info(self, session_id, session_info: dict):
+        with self.__transaction() as conn:
+            conn.execute(
+                "INSERT INTO sessions (id, info, phase, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "info = excluded.info, phase = excluded.phase, updated_at = excluded.updated_at",
+                (session_id, json.dumps(session_info), get_phase_from_session_info(session_info), get_timestamp()))
+
+    def read_session_info(self, session_id) -> dict:
+        row = self.__get_connection().execute("SELECT info FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"No session {session_id}.")
+        return json.loads(row[0])
+
+    def append_state_log(self, session_id: str, entries: list[dict]):
+        if len(entries) > 0:
+            with self.__transaction() as conn:
+                conn.executemany("INSERT INTO state_log (session_id, phase, timestamp, entry) VALUES (?, ?, ?, ?)",
+                                 [(session_id, entry.get("state"), entry.get("timestamp"), json.dumps(entry))
+                                  for entry in entries])
+
+    def read_state_log(self, session_id: str) -> list[dict] | None:
+        rows = self.__get_connection().execute("SELECT entry FROM state_log WHERE session_id = ? ORDER BY seq",
+                                               (session_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows] if len(rows) > 0 else None
+
+    def clear_data(self, session_id) -> bool:
+        with self.__transaction() as conn:
+            for table, column in [("turns", "session_id"), ("state_log", "session_id"), ("metadata", "session_id"),
+                                  ("sessions", "id")]:
+                conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (session_id,))
+        return True
+
+    def list_session_ids(self) -> list[str]:
+        return [row[0] for row in self.__get_connection().execute("SELECT id FROM sessions ORDER BY rowid")]
+
+    def write_session_metadata(self, session_id: str, name: str, data: dict):
+        with self.__transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO metadata (session_id, name, data) VALUES (?, ?, ?)",
+                         (session_id, name, json.dumps(data)))
+
+    def read_session_metadata(self, session_id: str, name: str) -> dict | None:
+        row = self.__get_connection().execute("SELECT data FROM metadata WHERE session_id = ? AND name = ?",
+                                              (session_id, name)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    # Queries across sessions ===========================================
+
+    def find_session_ids(self, phase: str | None = None, updated_after: int | None = None) -> list[str]:
+        """
+        :param phase: If not None, only sessions whose current phase is this one.
+        :param updated_after: If not None, only sessions whose info was written after this timestamp in millis.
+        """
+        conditions = []
+        args = []
+        if phase is not None:
+            conditions.append("phase = ?")
+            args.append(phase)
+        if updated_after is not None:
+            conditions.append("updated_at > ?")
+            args.append(updated_after)
+        where = f" WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+        return [row[0] for row in self.__get_connection().execute(f"SELECT id FROM sessions{where}", args)]
+
+    def find_state_log_entries(self, phase: str, since: int | None = None,
+                               until: int | None = None) -> list[tuple[str, dict]]:
+        """
+        :return: (session id, entry) pairs of state log entries of the phase, in the order of their timestamps.
+        """
+        query = "SELECT session_id, entry FROM state_log WHERE phase = ?"
+        args: list = [phase]
+        if since is not None:
+            query += " AND timestamp >= ?"
+            args.append(since)
+        if until is not None:
+            query += " AND timestamp < ?"
+            args.append(until)
+        return [(row[0], json.loads(row[1]))
+                for row in self.__get_connection().execute(query + " ORDER BY timestamp", args)]
+
+
+def migrate_session_files(source: SessionFileWriter, target: SqliteSessionWriter,
+                          session_ids: list[str] | None = None, batch_size: int = 100,
+                          overwrite: bool = False) -> int:
+    """
+    Copy sessions stored in the directory layout into a SQLite database.
+    :param session_ids: Sessions to copy. All sessions of the source if None.
+    :param batch_size: Number of sessions committed per transaction.
+    :param overwrite: If False, sessions that already exist in the target are skipped.
+    :return: Number of sessions copied.
+    """
+    session_ids = session_ids if session_ids is not None else source.list_session_ids()
+    num_migrated = 0
+    for start in range(0, len(session_ids), batch_size):
+        with target.batch():
+            for session_id in session_ids[start:start + batch_size]:
+                if target.exists(session_id):
+                    if overwrite:
+                        target.clear_data(session_id)
+                    else:
+                        continue
+                target.write_turns(session_id, source.read_dialogue(session_id) or [])
+                target.write_session_info(session_id, source.read_session_info(session_id))
+                target.append_state_log(session_id, source.read_state_log(session_id) or [])
+                for name in source.list_session_metadata_names(session_id):
+                    target.write_session_metadata(session_id, name, source.read_session_metadata(session_id, name))
+                num_migrated += 1
+    return num_migrated
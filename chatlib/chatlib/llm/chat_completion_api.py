@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import StrEnum
 from functools import cache
-from typing import Optional
+from typing import Optional, AsyncIterator, Callable
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -118,6 +118,34 @@ class ChatCompletionAPI(IntegrationService, ABC):
 
         return result
 
+    async def run_chat_completion_stream(self, model: str, messages: list[ChatCompletionMessage],
+                                         params: dict,
+                                         on_finish_reason: Callable[[ChatCompletionFinishReason], None] | None = None
+                                         ) -> AsyncIterator[str]:
+        """
+        Stream the completion text as deltas. Closing the iterator early aborts the completion.
+        Providers without streaming support yield the whole completion at once.
+        :param on_finish_reason: Called with the reason why the completion finished, after the last delta.
+        """
+        result = await self.run_chat_completion(model, messages, params)
+        if result is not None:
+            if result.message.content is not None:
+                yield result.message.content
+            if on_finish_reason is not None:
+                on_finish_reason(result.finish_reason)
+
+    def supports_json_schema_output(self, model: str) -> bool:
+        """
+        :return: True if the provider can constrain the output of the model to a JSON schema.
+        """
+        return False
+
+    def get_json_schema_output_params(self, name: str, schema: dict) -> dict:
+        """
+        :return: Chat completion params that constrain the output to the JSON schema.
+        """
+        raise NotImplementedError(f"{self.provider_name()} does not support JSON schema output.")
+
     @abstractmethod
     def count_token_in_messages(self, messages: list[ChatCompletionMessage], model: str) -> int:
         pass
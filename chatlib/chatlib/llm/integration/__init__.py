@@ -4,3 +4,4 @@ from .cohere_api import CohereModel, CohereChatAPI
 from .gemini_api import GeminiAPI
 from .openai_api import ChatGPTModel, GPTChatCompletionAPI
 from .together_api import TogetherAPI, TogetherAIModel
+from .mock_api import MockChatCompletionAPI
@@ -0,0 +1,126 @@
+import asyncio
+import inspect
+from functools import cache
+from typing import Any, Callable, Awaitable, TypeAlias, AsyncIterator
+
+from chatlib.chatlib.llm.chat_completion_api import ChatCompletionAPI, ChatCompletionMessage, ChatCompletionResult, \
+    ChatCompletionFinishReason, ChatCompletionMessageRole
+from chatlib.chatlib.utils.integration import APIAuthorizationVariableSpec
+
+MockResponder: TypeAlias = Callable[[str, list[ChatCompletionMessage], dict], str | Awaitable[str]]
+
+
+class MockChatCompletionAPI(ChatCompletionAPI):
+    """
+    An offline ChatCompletionAPI that answers with a responder function. Useful for testing and benchmarking
+    pipelines without network access or API keys. A completion longer than params["max_tokens"] is cut off and
+    finishes for its length.
+    """
+
+    @classmethod
+    @cache
+    def provider_name(cls) -> str:
+        return "Mock"
+
+    @classmethod
+    def get_auth_variable_specs(cls) -> list[APIAuthorizationVariableSpec]:
+        return []
+
+    @classmethod
+    def _authorize_impl(cls, variables: dict[APIAuthorizationVariableSpec, Any]) -> bool:
+        return True
+
+    def __init__(self, responder: MockResponder | None = None, latency: float = 0, token_limit: int = 128000,
+                 json_schema_output: bool = False, stream_chunk_size: int = 4):
+        """
+        :param responder: Receives model, messages and params and returns the completion text.
+        If None, the content of the last message is echoed.
+        :param latency: Simulated latency per request in seconds.
+        :param token_limit: Token limit reported by is_messages_within_token_limit.
+        :param json_schema_output: Whether to report support for JSON schema output. The responder receives the
+        schema in params["response_format"].
+        :param stream_chunk_size: Number of characters per streamed delta.
+        """
+        super().__init__()
+        self.__responder = responder
+        self.__latency = latency
+        self.__token_limit = token_limit
+        self.__json_schema_output = json_schema_output
+        self.__stream_chunk_size = stream_chunk_size
+
+        self.request_count = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def reset_usage(self):
+        self.request_count = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def is_messages_within_token_limit(self, messages: list[ChatCompletionMessage], model: str,
+                                       tolerance: int = 120) -> bool:
+        return self.count_token_in_messages(messages, model) < self.__token_limit - tolerance
+
+    async def __respond(self, model: str, messages: list[ChatCompletionMessage],
+                        params: dict) -> tuple[str, ChatCompletionFinishReason]:
+        if self.__latency > 0:
+            await asyncio.sleep(self.__latency)
+
+        if self.__responder is not None:
+            content = self.__responder(model, messages, params)
+            if inspect.isawaitable(content):
+                content = await content
+        else:
+            content = messages[len(messages) - 1].content if len(messages) > 0 else ""
+
+        self.request_count += 1
+        self.prompt_tokens += self.count_token_in_messages(messages, model)
+
+        max_tokens = params.get("max_tokens")
+        if max_tokens is not None and count_mock_tokens(content) > max_tokens:
+            return content[:max_tokens * 4], ChatCompletionFinishReason.Length
+        return content, ChatCompletionFinishReason.Stop
+
+    async def _run_chat_completion_impl(self, model: str, messages: list[ChatCompletionMessage],
+                                        params: dict) -> ChatCompletionResult:
+        content, finish_reason = await self.__respond(model, messages, params)
+
+        prompt_tokens = self.count_token_in_messages(messages, model)
+        completion_tokens = count_mock_tokens(content)
+        self.completion_tokens += completion_tokens
+
+        return ChatCompletionResult(
+            message=ChatCompletionMessage(content=content, role=ChatCompletionMessageRole.ASSISTANT),
+            finish_reason=finish_reason,
+            provider=self.provider_name(),
+            model=model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+    async def run_chat_completion_stream(self, model: str, messages: list[ChatCompletionMessage],
+                                         params: dict,
+                                         on_finish_reason: Callable[[ChatCompletionFinishReason], None] | None = None
+                                         ) -> AsyncIterator[str]:
+        content, finish_reason = await self.__respond(model, messages, params)
+        for i in range(0, len(content), self.__stream_chunk_size):
+            chunk = content[i:i + self.__stream_chunk_size]
+            self.completion_tokens += count_mock_tokens(chunk)  # Only the streamed part is billed.
+            yield chunk
+        if on_finish_reason is not None:
+            on_finish_reason(finish_reason)
+
+    def supports_json_schema_output(self, model: str) -> bool:
+        return self.__json_schema_output
+
+    def get_json_schema_output_params(self, name: str, schema: dict) -> dict:
+        return dict(response_format=dict(type="json_schema", json_schema=dict(name=name, schema=schema, strict=True)))
+
+    def count_token_in_messages(self, messages: list[ChatCompletionMessage], model: str) -> int:
+        return sum([count_mock_tokens(message.content) + 3 for message in messages]) + 3
+
+
+def count_mock_tokens(text: str | None) -> int:
+    # Rough approximation of a BPE tokenizer: about four characters per token.
+    return (len(text) + 3) // 4 if text is not None else 0
@@ -1,6 +1,6 @@
 from enum import StrEnum
 from functools import cache
-from typing import Any
+from typing import Any, AsyncIterator, Callable
 
 import tiktoken
 from openai import AsyncOpenAI
@@ -24,6 +24,7 @@ class ChatGPTModel(StrEnum):
     GPT_4_0125 = "gpt-4-0125-preview"
     GPT_4_1106 = "gpt-4-1106-preview"
     GPT_4o = "gpt-4o"
+    GPT_4o_mini = "gpt-4o-mini"
 
 
 def get_token_limit(model: str):
@@ -31,7 +32,7 @@ def get_token_limit(model: str):
         return 32000
     elif model is ChatGPTModel.GPT_3_5_16k_latest or model is ChatGPTModel.GPT_3_5_0125 or model is ChatGPTModel.GPT_3_5_1106:
         return 16000
-    elif model is ChatGPTModel.GPT_4_0125 or model is ChatGPTModel.GPT_4_1106 or model is ChatGPTModel.GPT_4o:
+    elif model is ChatGPTModel.GPT_4_0125 or model is ChatGPTModel.GPT_4_1106 or model is ChatGPTModel.GPT_4o or model is ChatGPTModel.GPT_4o_mini:
         return 128000
     elif model.startswith("gpt-4-turbo"):
         return 128000
@@ -86,6 +87,37 @@ class GPTChatCompletionAPI(ChatCompletionAPI):
 
         return converted_result
 
+    async def run_chat_completion_stream(self, model: str, messages: list[ChatCompletionMessage],
+                                         params: dict,
+                                         on_finish_reason: Callable[[ChatCompletionFinishReason], None] | None = None
+                                         ) -> AsyncIterator[str]:
+        self.assert_authorize()
+        stream = await self.__client.chat.completions.create(
+            model=model,
+            messages=[message.dict() for message in messages],
+            stream=True,
+            **params
+        )
+        finish_reason = None
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) > 0:
+                    if chunk.choices[0].delta.content is not None:
+                        yield chunk.choices[0].delta.content
+                    if chunk.choices[0].finish_reason is not None:
+                        finish_reason = ChatCompletionFinishReason(chunk.choices[0].finish_reason)
+        finally:
+            await stream.close()
+        if finish_reason is not None and on_finish_reason is not None:
+            on_finish_reason(finish_reason)
+
+    def supports_json_schema_output(self, model: str) -> bool:
+        return model.startswith("gpt-4o") or model.startswith("gpt-4.1") or model.startswith("gpt-5")
+
+    def get_json_schema_output_params(self, name: str, schema: dict) -> dict:
+        # https://platform.openai.com/docs/guides/structured-outputs
+        return dict(response_format=dict(type="json_schema", json_schema=dict(name=name, schema=schema, strict=True)))
+
     def count_token_in_messages(self, 
                                 messages: list[ChatCompletionMessage], 
                                 model: str) -> int:
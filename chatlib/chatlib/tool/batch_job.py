@@ -0,0 +1,278 @@
+import asyncio
+import json
+from os import path, fsync, replace
+from time import perf_counter
+from typing import TypeVar, Iterable, Callable, Iterator, Any
+
+import nanoid
+from pydantic import BaseModel, ConfigDict
+
+from chatlib.chatlib.llm.chat_completion_api import ChatCompletionAPI, ChatCompletionMessage, ChatCompletionResult
+from chatlib.chatlib.chatbot.session_writer import SessionWriterBase
+from chatlib.chatlib.tool.versatile_mapper import ChatCompletionFewShotMapper, MapperInputOutputPair
+
+# Job and output files follow the line format of the OpenAI Batch API, so a job file can also be uploaded there
+# and its output file ingested the same way.
+# https://platform.openai.com/docs/guides/batch
+
+InputType = TypeVar('InputType')
+OutputType = TypeVar('OutputType')
+ParamsType = TypeVar('ParamsType')
+
+CHAT_COMPLETION_ENDPOINT = "/v1/chat/completions"
+
+CUSTOM_ID_SEPARATOR = "::"
+
+
+def make_custom_id(session_id: str, key: str) -> str:
+    return f"{session_id}{CUSTOM_ID_SEPARATOR}{key}"
+
+
+def split_custom_id(custom_id: str) -> tuple[str, str]:
+    session_id, key = custom_id.split(CUSTOM_ID_SEPARATOR, 1)
+    return session_id, key
+
+
+class BatchJobRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    custom_id: str
+    method: str = "POST"
+    url: str = CHAT_COMPLETION_ENDPOINT
+    body: dict
+
+
+class BatchJobProgress(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    total: int
+    resumed: int
+    completed: int
+    failed: int
+    elapsed: float
+
+    @property
+    def processed(self) -> int:
+        return self.completed + self.failed
+
+    @property
+    def throughput(self) -> float:
+        """Processed requests per second in this run, not counting resumed ones."""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0
+
+    def __str__(self) -> str:
+        return (f"{self.resumed + self.processed}/{self.total} done "
+                f"({self.completed} completed, {self.failed} failed, {self.resumed} resumed) "
+                f"- {self.throughput:.2f} req/s")
+
+
+def print_batch_job_progress(progress: BatchJobProgress):
+    print(progress)
+
+
+def write_batch_job_file(mapper: ChatCompletionFewShotMapper[InputType, OutputType, ParamsType],
+                         examples: list[MapperInputOutputPair[InputType, OutputType]] | None,
+                         items: Iterable[tuple[str, InputType, ParamsType]],
+                         job_path: str) -> int:
+    """
+    Write a chat completion request per item into a JSONL job file.
+    The file is written aside and moved into place when complete, so that an existing job file is never partial.
+    :param items: Tuples of custom id, mapper input, and mapper params. Custom ids must be unique in a job.
+    :return: Number of requests written.
+    """
+    count = 0
+    temp_path = job_path + ".tmp"
+    with open(temp_path, "w", encoding='utf-8') as f:
+        for custom_id, input, params in items:
+            messages = mapper.build_messages(examples, input, params)
+            request = BatchJobRequest(custom_id=custom_id, body=dict(
+                model=params.model,
+                messages=[message.dict() for message in messages],
+                **params.api_params.dict()
+            ))
+            f.write(request.model_dump_json())
+            f.write("\n")
+            count += 1
+        f.flush()
+        fsync(f.fileno())
+    replace(temp_path, job_path)
+    return count
+
+
+def read_batch_job_file(job_path: str) -> Iterator[BatchJobRequest]:
+    with open(job_path, "r", encoding='utf-8') as f:
+        for line in f:
+            if len(line.strip()) > 0:
+                yield BatchJobRequest.model_validate_json(line)
+
+
+def read_batch_job_output(output_path: str) -> Iterator[dict]:
+    if path.exists(output_path):
+        with open(output_path, "r", encoding='utf-8') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+
+
+def _recover_batch_job_output(output_path: str) -> set[str]:
+    """
+    Collect custom ids completed without an error in an output file, truncating a partially written last line.
+    """
+    completed_ids = set()
+    if not path.exists(output_path):
+        return completed_ids
+
+    valid_length = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                output_line = json.loads(line)
+                custom_id = output_line["custom_id"]
+            except (ValueError, KeyError):
+                break
+            # Failed requests, e.g., from rate limits or timeouts, are retried.
+            if output_line.get("error") is None:
+                completed_ids.add(custom_id)
+            valid_length += len(line)
+
+        if valid_length < f.seek(0, 2):
+            print(f"Truncate a partially written line at the end of {output_path}.")
+            with open(output_path, "r+b") as wf:
+                wf.truncate(valid_length)
+
+    return completed_ids
+
+
+def _make_output_line(request: BatchJobRequest, result: ChatCompletionResult | None,
+                      error: Exception | None) -> dict:
+    if result is not None:
+        response = dict(status_code=200, request_id=None, body=dict(
+            object="chat.completion",
+            model=result.model,
+            choices=[dict(index=0, message=result.message.dict(), finish_reason=result.finish_reason)],
+            usage=dict(prompt_tokens=result.prompt_tokens, completion_tokens=result.completion_tokens,
+                       total_tokens=result.total_tokens)
+        ))
+    else:
+        response = None
+
+    return dict(id=f"batch_req_{nanoid.generate(size=20)}", custom_id=request.custom_id, response=response,
+                error=dict(code=type(error).__name__, message=str(error)) if error is not None else None)
+
+
+async def run_batch_job(api: ChatCompletionAPI,
+                        job_path: str,
+                        output_path: str,
+                        concurrency: int = 8,
+                        fsync_interval: int = 50,
+                        on_progress: Callable[[BatchJobProgress], None] | None = print_batch_job_progress,
+                        progress_interval: int = 20
+                        ) -> BatchJobProgress:
+    """
+    Execute a job file through a ChatCompletionAPI, appending a result line to the output file as each request
+    finishes. Requests already completed without an error in the output file are skipped, so rerunning the same job
+    after a crash resumes from the last completed line, and retries the failed requests.
+    :param fsync_interval: Number of result lines between fsync calls.
+    :param on_progress: Called every progress_interval processed requests and once at the end.
+    :return: Final progress.
+    """
+    completed_ids = _recover_batch_job_output(output_path)
+
+    requests = [request for request in read_batch_job_file(job_path)]
+    pending_requests = [request for request in requests if request.custom_id not in completed_ids]
+    resumed = len(requests) - len(pending_requests)
+
+    if resumed > 0:
+        print(f"Resume batch job - {resumed} of {len(requests)} request(s) were already completed.")
+
+    start = perf_counter()
+    completed = 0
+    failed = 0
+
+    def get_progress() -> BatchJobProgress:
+        return BatchJobProgress(total=len(requests), resumed=resumed, completed=completed, failed=failed,
+                                elapsed=perf_counter() - start)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_request(request: BatchJobRequest) -> tuple[BatchJobRequest, ChatCompletionResult | None,
+                                                             Exception | None]:
+        async with semaphore:
+            body = dict(request.body)
+            model = body.pop("model")
+            messages = [ChatCompletionMessage(**message) for message in body.pop("messages")]
+            try:
+                result = await api.run_chat_completion(model, messages, body)
+                if result is None:
+                    raise Exception("No result after retries.")
+                return request, result, None
+            except Exception as e:
+                return request, None, e
+
+    with open(output_path, "a", encoding='utf-8') as f:
+        for future in asyncio.as_completed([run_request(request) for request in pending_requests]):
+            request, result, error = await future
+            f.write(json.dumps(_make_output_line(request, result, error), ensure_ascii=False))
+            f.write("\n")
+            f.flush()
+
+            if error is None:
+                completed += 1
+            else:
+                failed += 1
+
+            processed = completed + failed
+            if processed % fsync_interval == 0:
+                fsync(f.fileno())
+            if on_progress is not None and processed % progress_interval == 0:
+                on_progress(get_progress())
+
+        fsync(f.fileno())
+
+    progress = get_progress()
+    if on_progress is not None and (progress.processed == 0 or progress.processed % progress_interval != 0):
+        on_progress(progress)
+    return progress
+
+
+def ingest_batch_job_output(mapper: ChatCompletionFewShotMapper[InputType, OutputType, ParamsType],
+                            output_path: str,
+                            writer: SessionWriterBase,
+                            metadata_name: str,
+                            params: ParamsType | Callable[[str], ParamsType] | None = None) -> tuple[int, int]:
+    """
+    Parse the completions in an output file with the mapper and store them into per-session metadata.
+    Custom ids must be made with make_custom_id. Results are stored under their keys, and failures under "errors".
+    Only the last line of each custom id counts, so a retry that succeeded replaces an earlier failure.
+    :param params: Params passed to the mapper's output converter, or a function that returns them per custom id.
+    :return: Numbers of ingested and failed results.
+    """
+    session_results: dict[str, dict[str, Any]] = dict()
+    session_errors: dict[str, dict[str, str]] = dict()
+
+    last_lines = {line["custom_id"]: line for line in read_batch_job_output(output_path)}
+    for line in last_lines.values():
+        session_id, key = split_custom_id(line["custom_id"])
+        try:
+            if line["error"] is not None:
+                raise Exception(line["error"]["message"])
+            content = line["response"]["body"]["choices"][0]["message"]["content"]
+            output = mapper.parse_output(None, content, params(line["custom_id"]) if callable(params) else params)
+            session_results.setdefault(session_id, dict())[key] = output.model_dump() if isinstance(output,
+                                                                                                    BaseModel) else output
+        except Exception as e:
+            session_errors.setdefault(session_id, dict())[key] = str(e)
+
+    for session_id in set(session_results.keys()) | set(session_errors.keys()):
+        metadata = writer.read_session_metadata(session_id, metadata_name) or dict()
+        metadata.update(session_results.get(session_id, dict()))
+        errors = {k: v for k, v in (metadata.get("errors") or dict()).items() if k not in metadata}
+        errors.update(session_errors.get(session_id, dict()))
+        metadata["errors"] = errors
+        writer.write_session_metadata(session_id, metadata_name, metadata)
+
+    num_ingested = sum([len(results) for results in session_results.values()])
+    num_failed = sum([len(errors) for errors in session_errors.values()])
+    return num_ingested, num_failed
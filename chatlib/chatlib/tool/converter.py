@@ -5,7 +5,7 @@ from functools import cache
 from typing import Type, Callable, Any, TypeVar, Literal
 
 import yaml
-from pydantic import BaseModel, TypeAdapter
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
 DataType = TypeVar('DataType')
 
@@ -22,7 +22,7 @@ def generate_pydantic_converter(cls: Type[BaseModelType],
                                 serialization_kwargs: dict | None = None) -> tuple[
     Callable[[str, Any], BaseModelType], Callable[[BaseModelType, Any], str]]:
     if serialization_type == 'json':
-        return (lambda input, params: cls(**json_str_to_dict_converter(input, params))), (
+        return (lambda input, params: validate_json_str(cls, input)), (
             lambda input, params: input.json(
                 **serialization_kwargs) if serialization_kwargs is not None else input.json())
     elif serialization_type == 'yaml':
@@ -54,7 +54,7 @@ def generate_type_converter(cls: Type[DataType], serialization_type: Literal['js
 tuple[
     Callable[[str, Any], DataType], Callable[[DataType, Any], str]]:
     if serialization_type == 'json':
-        return (lambda input, params: get_type_adapter(cls).validate_json(input)), (
+        return (lambda input, params: validate_json_str(get_type_adapter(cls), input)), (
             lambda input, params: get_type_adapter(cls).dump_json(input).decode('utf-8'))
     elif serialization_type == 'yaml':
         return (
@@ -65,13 +65,165 @@ tuple[
 markdown_json_block_pattern = r'^```(json)?\s*(.*?)\s*```$'
 markdown_yaml_block_pattern = r'^```(yaml)?\s*(.*?)\s*```$'
 
+_fenced_block_regex = re.compile(r'```[a-zA-Z]*[ \t]*\n?(.*?)(?:```|$)', re.DOTALL)
+
+_SMART_QUOTES = {"\u201c": '"', "\u201d": '"', "\u201e": '"', "\u2033": '"', "\u2018": "'", "\u2019": "'"}
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSING_BRACKETS = {"{": "}", "[": "]"}
+
+
+def extract_json_str(text: str) -> str:
+    """
+    Extract the JSON value from a model output, which may be wrapped in a markdown fence or surrounded by prose.
+    The extracted text runs from the first opening bracket to its matching closing bracket, or to the end of the
+    text if the value is truncated.
+    """
+    match = _fenced_block_regex.search(text)
+    if match is not None and ("{" in match.group(1) or "[" in match.group(1)):
+        text = match.group(1)
+
+    start = -1
+    for i, c in enumerate(text):
+        if c == "{" or c == "[":
+            start = i
+            break
+    if start < 0:
+        return text.strip()
+
+    depth = 0
+    in_string = False
+    is_escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if is_escaped:
+                is_escaped = False
+            elif c == "\\":
+                is_escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{" or c == "[":
+            depth += 1
+        elif c == "}" or c == "]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def repair_json_str(text: str) -> str:
+    """
+    Fix common defects in JSON text written by a language model in a single pass:
+    smart quotes used as delimiters, single-quoted strings, comments, Python literals, trailing commas,
+    raw line breaks in strings, and brackets or strings left open by a truncated output.
+    """
+    out: list[str] = []
+    stack: list[str] = []
+    quote = None  # Delimiter of the string being read, if any.
+    is_smart_quoted = False  # Whether the string was opened with a smart quote, which may be closed by one.
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if quote is not None:
+            if c == "\\" and i + 1 < length:
+                out.append(text[i:i + 2])
+                i += 2
+                continue
+            elif c == quote or (is_smart_quoted and _SMART_QUOTES.get(c) == quote):
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')  # A double quote inside a single-quoted string.
+            elif c == "\n":
+                out.append("\\n")
+            elif c == "\r":
+                out.append("\\r")
+            elif c == "\t":
+                out.append("\\t")
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        is_smart_quoted = c in _SMART_QUOTES
+        c = _SMART_QUOTES.get(c, c)
+        if c == '"' or c == "'":
+            quote = c
+            out.append('"')
+        elif c == "/" and text.startswith("//", i):
+            newline = text.find("\n", i)
+            i = length if newline < 0 else newline
+            continue
+        elif c == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = length if end < 0 else end + 2
+            continue
+        elif c == "{" or c == "[":
+            stack.append(_CLOSING_BRACKETS[c])
+            out.append(c)
+        elif c == "}" or c == "]":
+            _strip_trailing_comma(out)
+            if len(stack) > 0 and stack[-1] == c:
+                stack.pop()
+            out.append(c)
+        elif c.isalpha():
+            j = i
+            while j < length and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(c)
+        i += 1
+
+    # Close what a truncated output left open.
+    if quote is not None:
+        out.append('"')
+    _strip_trailing_comma(out)
+    if "".join(out).rstrip().endswith(":"):
+        out.append("null")
+    while len(stack) > 0:
+        out.append(stack.pop())
+
+    return "".join(out)
+
+
+def _strip_trailing_comma(out: list[str]):
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+
+
+def validate_json_str(validator: Type[BaseModelType] | TypeAdapter[DataType], text: str) -> BaseModelType | DataType:
+    """
+    Validate a model output into a pydantic model or a type adapter, parsing and validating in one pass.
+    The output is repaired with repair_json_str only if it is not valid JSON.
+    :raise ValidationError: If the output is malformed beyond repair or does not match the schema.
+    """
+    validate = validator.model_validate_json if isinstance(validator, type) else validator.validate_json
+    text = extract_json_str(text)
+    try:
+        return validate(text)
+    except ValidationError as e:
+        if any([error["type"] == "json_invalid" for error in e.errors()]):
+            return validate(repair_json_str(text))
+        else:
+            raise
+
 
 def json_str_to_dict_converter(input: str, params: Any) -> dict:
-    match = re.search(markdown_json_block_pattern, input, re.DOTALL)
-    if match:
-        return json.loads(match.group(2))
-    else:
-        return json.loads(input)
+    text = extract_json_str(input)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(repair_json_str(text))
 
 
 def dict_to_json_str_converter(input: dict | list, params: Any) -> str:
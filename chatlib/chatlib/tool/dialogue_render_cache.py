@@ -0,0 +1,73 @@
+import operator
+from collections import OrderedDict
+
+from chatlib.chatlib.chatbot import Dialogue, DialogueTurn
+
+DIALOGUE_HEADER = "\n<dialogue>\n"
+DIALOGUE_FOOTER = "</dialogue>"
+
+
+def render_dialogue_turn(turn: DialogueTurn, user_alias: str, system_alias: str) -> str:
+    return f"{user_alias if turn.is_user else system_alias}: <msg>{turn.message}</msg>\n"
+
+
+class DialogueRenderCache:
+    """
+    Renders dialogues in the format of DIALOGUE_TEMPLATE from fragments cached per turn and alias pair.
+    Turns are keyed by their ids, which are unique across sessions, so a single cache serves all sessions and
+    a turn is rendered once over the lifetime of its session. Identical windows return the same string object.
+    """
+
+    def __init__(self, max_fragments: int = 50000, max_windows: int = 256):
+        self.__max_fragments = max_fragments
+        self.__max_windows = max_windows
+
+        # (turn id, user alias, system alias) => (message, is_user, fragment)
+        self.__fragments: OrderedDict[tuple[str, str, str], tuple[str, bool, str]] = OrderedDict()
+        # (user alias, system alias, turn ids) => (turns, rendered window)
+        self.__windows: OrderedDict[tuple, tuple[tuple[DialogueTurn, ...], str]] = OrderedDict()
+
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        self.window_hits = 0
+
+    def __get_fragment(self, turn: DialogueTurn, user_alias: str, system_alias: str) -> str:
+        key = (turn.id, user_alias, system_alias)
+        entry = self.__fragments.get(key)
+        if entry is not None and entry[0] == turn.message and entry[1] == turn.is_user:
+            self.__fragments.move_to_end(key)
+            self.fragment_hits += 1
+            return entry[2]
+
+        fragment = render_dialogue_turn(turn, user_alias, system_alias)
+        self.__fragments[key] = (turn.message, turn.is_user, fragment)
+        if len(self.__fragments) > self.__max_fragments:
+            self.__fragments.popitem(last=False)
+        self.fragment_misses += 1
+        return fragment
+
+    def render(self, dialogue: Dialogue, user_alias: str, system_alias: str) -> str:
+        turns = tuple(dialogue)
+        key = (user_alias, system_alias, tuple(map(_get_turn_id, turns)))
+        entry = self.__windows.get(key)
+        # Turns are frozen, so the same turn objects always render the same window.
+        if entry is not None and all(map(operator.is_, entry[0], turns)):
+            self.__windows.move_to_end(key)
+            self.window_hits += 1
+            return entry[1]
+
+        rendered = DIALOGUE_HEADER + "".join(
+            [self.__get_fragment(turn, user_alias, system_alias) for turn in turns]) + DIALOGUE_FOOTER
+        self.__windows[key] = (turns, rendered)
+        if len(self.__windows) > self.__max_windows:
+            self.__windows.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        self.__fragments.clear()
+        self.__windows.clear()
+
+
+_get_turn_id = operator.attrgetter("id")
+
+default_dialogue_render_cache = DialogueRenderCache()
@@ -0,0 +1,159 @@
+import json
+from dataclasses import dataclass
+from typing import Generic, Any, TypeVar
+
+from pydantic import BaseModel, ConfigDict, create_model
+
+from chatlib.chatlib.llm.chat_completion_api import ChatCompletionMessage, ChatCompletionMessageRole, \
+    ChatCompletionFinishReason
+from chatlib.chatlib.tool.converter import json_str_to_dict_converter
+from chatlib.chatlib.tool.structured_output import make_structured_output_json_schema
+from chatlib.chatlib.tool.versatile_mapper import ChatCompletionFewShotMapper, MapperInputOutputPair
+from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
+
+InputType = TypeVar('InputType')
+OutputType = TypeVar('OutputType')
+ParamsType = TypeVar('ParamsType')
+
+
+@dataclass(frozen=True)
+class FusedSummarizerTask(Generic[InputType, OutputType, ParamsType]):
+    """
+    :param use_shared_input: If True, the task reads the input of the first task instead of its own.
+    Otherwise, its own input is included in the request when it differs from the shared one.
+    """
+    name: str
+    mapper: ChatCompletionFewShotMapper[InputType, OutputType, ParamsType]
+    params: ParamsType
+    examples: list[MapperInputOutputPair[InputType, OutputType]] | None = None
+    use_shared_input: bool = False
+
+
+class FusedSummarizerStats(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    fused_run_count: int = 0
+    task_count: int = 0
+    fallback_task_count: int = 0
+
+    @property
+    def fallback_rate(self) -> float:
+        return self.fallback_task_count / self.task_count if self.task_count > 0 else 0
+
+
+FUSED_INSTRUCTION_TEMPLATE = convert_to_jinja_template("""
+You perform {{tasks|length}} tasks on the same input at once.
+Answer with a single JSON object with the keys {{tasks|map(attribute="name")|join(", ")}}, each holding the output of the task with that name, in the format that the task specifies.
+{% for task in tasks %}
+<task name="{{task.name}}">
+{{task.instruction}}
+{%- if task.examples|length > 0 %}
+Examples:
+{% for example_input, example_output in task.examples -%}
+<example_input>{{example_input}}</example_input>
+<example_output>{{example_output}}</example_output>
+{% endfor -%}
+{% endif %}
+{%- if task.input is not none %}
+This task takes the following input instead of the shared one:
+<task_input>{{task.input}}</task_input>
+{%- endif %}
+</task>
+{% endfor %}""")
+
+
+class FusedSummarizer:
+    """
+    Runs several few-shot mappers over the same input in a single request, e.g., a safety check and a phase analysis
+    over the same dialogue window. The first task's input is shared. A task whose part of the fused output fails
+    validation is run again on its own.
+    """
+
+    def __init__(self, output_malformed_retry_count: int = 0):
+        """
+        :param output_malformed_retry_count: Retries of the fused request before falling back to separate requests.
+        """
+        self.__output_malformed_retry_count = output_malformed_retry_count
+        self.__stats = FusedSummarizerStats()
+
+    @property
+    def stats(self) -> FusedSummarizerStats:
+        return self.__stats
+
+    def build_messages(self, tasks: list[FusedSummarizerTask], input: Any) -> list[ChatCompletionMessage]:
+        shared_input = None
+        task_infos = []
+        for i, task in enumerate(tasks):
+            messages = task.mapper.build_messages(task.examples, input, task.params)
+            task_input = messages[len(messages) - 1].content
+            if i == 0:
+                shared_input = task_input
+            examples = [(messages[k].content, messages[k + 1].content) for k in range(1, len(messages) - 1, 2)]
+            task_infos.append(dict(name=task.name, instruction=messages[0].content.strip(), examples=examples,
+                                   input=None if task.use_shared_input or task_input == shared_input else task_input))
+
+        return [ChatCompletionMessage(content=FUSED_INSTRUCTION_TEMPLATE.render(tasks=task_infos),
+                                      role=ChatCompletionMessageRole.SYSTEM),
+                ChatCompletionMessage(content=shared_input, role=ChatCompletionMessageRole.USER)]
+
+    def __get_output_model(self, tasks: list[FusedSummarizerTask]) -> type[BaseModel] | None:
+        if any([task.mapper.output_model is None for task in tasks]):
+            return None
+        return create_model("FusedSummarizerResult", **{task.name: (task.mapper.output_model, ...) for task in tasks})
+
+    async def __run_fused(self, tasks: list[FusedSummarizerTask], input: Any) -> dict[str, Any]:
+        api = tasks[0].mapper.api
+        model = tasks[0].params.model
+        api_params = tasks[0].params.api_params.dict()
+
+        output_model = self.__get_output_model(tasks)
+        if output_model is not None and api.supports_json_schema_output(model):
+            api_params.update(api.get_json_schema_output_params(output_model.__name__,
+                                                                make_structured_output_json_schema(output_model)))
+
+        messages = self.build_messages(tasks, input)
+
+        left_retry_count = self.__output_malformed_retry_count
+        while True:
+            chat_response = await api.run_chat_completion(model, messages, api_params)
+            if chat_response.finish_reason != ChatCompletionFinishReason.Stop:
+                raise Exception(chat_response.finish_reason)
+            try:
+                fused_output = json_str_to_dict_converter(chat_response.message.content, None)
+                if not isinstance(fused_output, dict):
+                    raise ValueError("The fused output is not a JSON object.")
+            except Exception as e:
+                if left_retry_count > 0:
+                    left_retry_count -= 1
+                    continue
+                raise e
+
+            results = dict()
+            for task in tasks:
+                if task.name not in fused_output:
+                    continue
+                try:
+                    results[task.name] = task.mapper.parse_output(input, json.dumps(fused_output[task.name]),
+                                                                  task.params)
+                except Exception as e:
+                    print(f"Fused output of task \"{task.name}\" failed validation: {e}")
+            return results
+
+    async def run(self, tasks: list[FusedSummarizerTask], input: Any) -> dict[str, Any]:
+        """
+        :return: Outputs keyed by task name.
+        """
+        try:
+            results = await self.__run_fused(tasks, input)
+        except Exception as e:
+            print(f"Fused summarization failed. Fall back to separate requests. Error: {e}")
+            results = dict()
+
+        fallback_tasks = [task for task in tasks if task.name not in results]
+        for task in fallback_tasks:
+            results[task.name] = await task.mapper.run(task.examples, input, task.params)
+
+        self.__stats = FusedSummarizerStats(fused_run_count=self.__stats.fused_run_count + 1,
+                                            task_count=self.__stats.task_count + len(tasks),
+                                            fallback_task_count=self.__stats.fallback_task_count + len(fallback_tasks))
+        return results
@@ -6,12 +6,12 @@ from typing import TypeVar, Generic, Callable
 
 from jinja2 import Template
 
-from chatlib.chatbot import DialogueTurn, Dialogue, RegenerateRequestException, TokenLimitExceedHandler, \
-    ChatCompletionParams
-from chatlib.chatbot.generators import ChatGPTResponseGenerator
-from chatlib.llm.chat_completion_api import ChatCompletionMessage, ChatCompletionMessageRole
-from chatlib.llm.integration import ChatGPTModel
-from chatlib.utils.jinja_utils import convert_to_jinja_template
+from chatlib.chatlib.chatbot import DialogueTurn, Dialogue, RegenerateRequestException, TokenLimitExceedHandler, \
+    ChatCompletionParams, ChatCompletionResponseGenerator
+from chatlib.chatlib.chatbot.generators import ChatGPTResponseGenerator
+from chatlib.chatlib.llm.chat_completion_api import ChatCompletionMessage, ChatCompletionMessageRole, ChatCompletionAPI
+from chatlib.chatlib.llm.integration import ChatGPTModel
+from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
 
 InputType = TypeVar('InputType')
 OutputType = TypeVar('OutputType')
@@ -66,22 +66,20 @@ class ChatGPTFewShotMapper(Mapper[InputType, OutputType, ChatFewShotParamsType],
                  model: str = ChatGPTModel.GPT_4_latest,
                  chat_completion_params: ChatCompletionParams | None = None,
                  examples: list[tuple[InputType, str]] | None = None,
-                 token_limit_exceed_handler: TokenLimitExceedHandler | None = None
+                 token_limit_exceed_handler: TokenLimitExceedHandler | None = None,
+                 max_regeneration_count: int = 3,
+                 api: ChatCompletionAPI | None = None
                  ):
+        self.__api = api or ChatGPTResponseGenerator.get_api()
         self.__model = model
         self.__chat_completion_params = chat_completion_params or ChatCompletionParams()
 
         self.base_instruction = base_instruction
-        self.__generator = ChatGPTResponseGenerator(
-            model=model,
-            base_instruction=base_instruction,
-            chat_completion_params=chat_completion_params,
-            token_limit_exceed_handler=token_limit_exceed_handler,
-            token_limit_tolerance=1024
-        )
+        self.__token_limit_exceed_handler = token_limit_exceed_handler
+        self.__max_regeneration_count = max_regeneration_count
 
         self.__examples = examples
-        self.__example_messages_cache: list[dict] | None = None
+        self.__example_messages_cache: list[ChatCompletionMessage] | None = None
 
     @abstractmethod
     def _convert_input_to_message_content(self, input: InputType,
@@ -109,26 +107,42 @@ class ChatGPTFewShotMapper(Mapper[InputType, OutputType, ChatFewShotParamsType],
                     ChatCompletionMessage(content=label, role=ChatCompletionMessageRole.SYSTEM, name="example_assistant")
                 ] for sample, label in self.__examples]))
 
-            return self.__example_messages_cache
+            return self.__example_messages_cache.copy()
         else:
             return None
 
-    async def run(self, input: InputType, params: ChatFewShotParamsType | None = None) -> OutputType:
-        self.__generator.initial_user_message = self.__get_example_messages(params)
-
+    def __create_generator(self, params: ChatFewShotParamsType | None = None) -> ChatCompletionResponseGenerator:
+        # A generator is created for each call so that concurrent runs never share an instruction.
         if params is not None and params.instruction_params is not None and isinstance(self.base_instruction, Template):
-            self.__generator.base_instruction = self.base_instruction.render(**params.instruction_params)
-
-        resp, _, _ = await self.__generator.get_response(
-            [DialogueTurn(message=self._convert_input_to_message_content(input, params), is_user=True)])
-        # print(resp)
+            instruction = self.base_instruction.render(**params.instruction_params)
+        else:
+            instruction = self.base_instruction
+
+        return ChatCompletionResponseGenerator(
+            api=self.__api,
+            model=self.__model,
+            base_instruction=instruction,
+            initial_user_message=self.__get_example_messages(params),
+            chat_completion_params=self.__chat_completion_params,
+            token_limit_exceed_handler=self.__token_limit_exceed_handler,
+            token_limit_tolerance=1024
+        )
 
-        try:
-            processed_resp = self._postprocess_chatgpt_output(resp, params)
-            return processed_resp
-        except RegenerateRequestException as ex:
-            print(f"Regeneration requested due to an error - {ex.reason}")
-            return await self.run(input, params)
+    async def run(self, input: InputType, params: ChatFewShotParamsType | None = None) -> OutputType:
+        generator = self.__create_generator(params)
+        dialogue = [DialogueTurn(message=self._convert_input_to_message_content(input, params), is_user=True)]
+
+        left_regeneration_count = self.__max_regeneration_count
+        while True:
+            resp, _, _ = await generator.get_response(dialogue)
+            try:
+                return self._postprocess_chatgpt_output(resp, params)
+            except RegenerateRequestException as ex:
+                if left_regeneration_count > 0:
+                    print(f"Regeneration requested due to an error - {ex.reason}")
+                    left_regeneration_count -= 1
+                else:
+                    raise Exception(f"Consumed all regeneration count. Last reason: {ex.reason}")
 
 
 class ChatGPTDialogueSummarizer(ChatGPTFewShotMapper[Dialogue, dict, ChatDialogSummarizerParams]):
@@ -136,9 +150,12 @@ class ChatGPTDialogueSummarizer(ChatGPTFewShotMapper[Dialogue, dict, ChatDialogS
     def __init__(self, base_instruction: str | Template, model: str = ChatGPTModel.GPT_4_latest,
                  chat_completion_params: ChatCompletionParams | None = None, examples: list[tuple[InputType, str]] | None = None,
                  dialogue_filter: Callable[[Dialogue, ChatDialogSummarizerParams | None], Dialogue] | None = None,
-                 token_limit_exceed_handler: TokenLimitExceedHandler | None = None
+                 token_limit_exceed_handler: TokenLimitExceedHandler | None = None,
+                 max_regeneration_count: int = 3,
+                 api: ChatCompletionAPI | None = None
                  ):
-        super().__init__(base_instruction, model, chat_completion_params, examples, token_limit_exceed_handler)
+        super().__init__(base_instruction, model, chat_completion_params, examples, token_limit_exceed_handler,
+                         max_regeneration_count, api)
         self.dialogue_filter = dialogue_filter
 
     def _convert_input_to_message_content(self, input: Dialogue,
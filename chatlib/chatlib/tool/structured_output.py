@@ -0,0 +1,311 @@
+import copy
+from typing import Type
+
+from pydantic import BaseModel
+
+
+# Keywords whose values map names to schemas, rather than being schemas themselves.
+_SCHEMA_MAP_KEYWORDS = ("properties", "$defs", "definitions", "patternProperties")
+
+
+class StreamedJsonShapeError(ValueError):
+    pass
+
+
+class StreamedJsonSyntaxError(StreamedJsonShapeError):
+    """The text is not valid JSON, though it may still be repairable into a valid output."""
+    pass
+
+
+def make_structured_output_json_schema(cls: Type[BaseModel]) -> dict:
+    """
+    Derive a JSON schema from a pydantic model, in the strict form that schema-constrained decoding expects:
+    every object lists all of its properties as required and forbids additional ones, and defaults are dropped.
+    Optional fields remain nullable.
+    """
+    schema = copy.deepcopy(cls.model_json_schema())
+
+    def recur(node, is_schema: bool = True):
+        if isinstance(node, dict):
+            if is_schema:
+                node.pop("default", None)
+                if node.get("type") == "object" and "properties" in node:
+                    node["additionalProperties"] = False
+                    node["required"] = list(node["properties"].keys())
+                for key, value in node.items():
+                    recur(value, key not in _SCHEMA_MAP_KEYWORDS)
+            else:
+                # The keys are names, e.g., a field named "default", and the values are schemas.
+                for value in node.values():
+                    recur(value)
+        elif isinstance(node, list):
+            for value in node:
+                recur(value)
+
+    recur(schema)
+    return schema
+
+
+_LITERALS = ("true", "false", "null")
+_NUMBER_CHARS = frozenset("0123456789+-.eE")
+_WHITESPACES = frozenset(" \t\r\n")
+
+
+class IncrementalJsonValidator:
+    """
+    Validates a JSON object against a JSON schema while its text arrives in chunks.
+    Only the shape is checked: JSON syntax, the kind of each value, missing required keys, and unknown keys where
+    the schema forbids them.
+    Text before the top-level value (e.g., a markdown fence) is skipped, and the text after it is ignored.
+    feed() raises StreamedJsonShapeError as soon as the text cannot become a valid output anymore,
+    or StreamedJsonSyntaxError if the text breaks JSON syntax in a way that a repair might still fix.
+    """
+
+    def __init__(self, schema: dict | None = None, max_preamble_length: int = 256):
+        self.__root_schema = schema or dict()
+        self.__max_preamble_length = max_preamble_length
+
+        self.__preamble_length = 0
+        self.__value_offset = 0
+        self.__started = False
+        self.__complete = False
+
+        # Frames of open containers: [kind, schema, state, current key, keys seen]
+        self.__stack: list[list] = []
+
+        self.__in_string = False
+        self.__is_escaped = False
+        self.__string_is_key = False
+        self.__key_chars: list[str] = []
+
+        self.__literal_chars: list[str] = []
+
+        self.__consumed_length = 0
+
+    @property
+    def is_complete(self) -> bool:
+        return self.__complete
+
+    @property
+    def consumed_length(self) -> int:
+        """Number of characters fed until the top-level value was closed."""
+        return self.__consumed_length
+
+    def extract_value(self, text: str) -> str:
+        """
+        :param text: The whole text fed so far.
+        :return: The text of the top-level value without the preamble and the text after it.
+        """
+        return text[self.__value_offset:self.__consumed_length]
+
+    def feed(self, chunk: str):
+        for c in chunk:
+            if self.__complete:
+                return
+            self.__consumed_length += 1
+            self.__feed_char(c)
+
+    # Schema helpers ======================================================
+
+    def __resolve(self, schema: dict) -> dict:
+        while "$ref" in schema:
+            ref: str = schema["$ref"]
+            node = self.__root_schema
+            for part in ref.lstrip("#/").split("/"):
+                node = node.get(part, dict())
+            schema = node
+        return schema
+
+    def __allowed_kinds(self, schema: dict) -> set[str] | None:
+        schema = self.__resolve(schema)
+        if "anyOf" in schema or "oneOf" in schema:
+            kinds = set()
+            for branch in schema.get("anyOf", schema.get("oneOf")):
+                branch_kinds = self.__allowed_kinds(branch)
+                if branch_kinds is None:
+                    return None
+                kinds |= branch_kinds
+            return kinds
+        elif "type" in schema:
+            types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+            return set(["number" if t == "integer" else t for t in types])
+        elif "enum" in schema or "const" in schema:
+            values = schema["enum"] if "enum" in schema else [schema["const"]]
+            return set([self.__kind_of_value(v) for v in values])
+        else:
+            return None
+
+    @staticmethod
+    def __kind_of_value(value) -> str:
+        if value is None:
+            return "null"
+        elif isinstance(value, bool):
+            return "boolean"
+        elif isinstance(value, (int, float)):
+            return "number"
+        elif isinstance(value, str):
+            return "string"
+        elif isinstance(value, list):
+            return "array"
+        else:
+            return "object"
+
+    def __select_branch(self, schema: dict, kind: str) -> dict:
+        schema = self.__resolve(schema)
+        for branch in schema.get("anyOf", schema.get("oneOf", [])):
+            kinds = self.__allowed_kinds(branch)
+            if kinds is None or kind in kinds:
+                return self.__select_branch(branch, kind)
+        return schema
+
+    def __child_schema(self) -> dict:
+        kind, schema, state, key, seen_keys = self.__stack[-1]
+        if kind == "object":
+            properties = schema.get("properties", dict())
+            if key in properties:
+                return properties[key]
+            additional = schema.get("additionalProperties", dict())
+            return additional if isinstance(additional, dict) else dict()
+        else:
+            items = schema.get("items", dict())
+            return items if isinstance(items, dict) else dict()
+
+    # State machine ======================================================
+
+    def __fail(self, reason: str):
+        raise StreamedJsonShapeError(f"{reason} (at character {self.__consumed_length})")
+
+    def __fail_syntax(self, reason: str):
+        raise StreamedJsonSyntaxError(f"{reason} (at character {self.__consumed_length})")
+
+    def __begin_value(self, c: str, schema: dict):
+        if c == "{":
+            kind = "object"
+        elif c == "[":
+            kind = "array"
+        elif c == '"':
+            kind = "string"
+        elif c in "tf":
+            kind = "boolean"
+        elif c == "n":
+            kind = "null"
+        elif c in "-0123456789":
+            kind = "number"
+        else:
+            self.__fail_syntax(f"Unexpected character '{c}' at the beginning of a value")
+            return
+
+        allowed = self.__allowed_kinds(schema)
+        if allowed is not None and kind not in allowed:
+            self.__fail(f"Expected {' or '.join(sorted(allowed))} but got {kind}")
+
+        if kind == "object" or kind == "array":
+            self.__stack.append([kind, self.__select_branch(schema, kind),
+                                 "key_or_end" if kind == "object" else "value_or_end", None, set()])
+        elif kind == "string":
+            self.__in_string = True
+            self.__string_is_key = False
+        else:
+            self.__literal_chars = [c]
+
+    def __end_value(self):
+        if len(self.__stack) == 0:
+            self.__complete = True
+        else:
+            self.__stack[-1][2] = "comma_or_end"
+
+    def __end_literal(self):
+        literal = "".join(self.__literal_chars)
+        self.__literal_chars = []
+        if literal not in _LITERALS:
+            try:
+                float(literal)
+            except ValueError:
+                self.__fail_syntax(f"Malformed literal '{literal}'")
+        self.__end_value()
+
+    def __feed_char(self, c: str):
+        if self.__in_string:
+            if self.__is_escaped:
+                self.__is_escaped = False
+            elif c == "\\":
+                self.__is_escaped = True
+            elif c == '"':
+                self.__in_string = False
+                if self.__string_is_key:
+                    self.__end_key("".join(self.__key_chars))
+                else:
+                    self.__end_value()
+                return
+            if self.__string_is_key:
+                self.__key_chars.append(c)
+            return
+
+        if len(self.__literal_chars) > 0:
+            if c.isalpha() or c in _NUMBER_CHARS:
+                self.__literal_chars.append(c)
+                literal = "".join(self.__literal_chars)
+                if literal[0].isalpha() and not any([lit.startswith(literal) for lit in _LITERALS]):
+                    self.__fail_syntax(f"Malformed literal '{literal}'")
+                return
+            else:
+                self.__end_literal()
+                if self.__complete:
+                    return
+
+        if not self.__started:
+            if c == "{" or c == "[":
+                self.__started = True
+                self.__value_offset = self.__consumed_length - 1
+                self.__begin_value(c, self.__root_schema)
+            else:
+                self.__preamble_length += 1
+                if self.__preamble_length > self.__max_preamble_length:
+                    self.__fail_syntax("No JSON value found in the output")
+            return
+
+        if c in _WHITESPACES:
+            return
+
+        frame = self.__stack[-1]
+        kind, schema, state, key, seen_keys = frame
+        if kind == "object":
+            if state == "key_or_end" and c == "}" or state == "comma_or_end" and c == "}":
+                missing_keys = [k for k in schema.get("required", []) if k not in seen_keys]
+                if len(missing_keys) > 0:
+                    self.__fail(f"Missing required key(s) {', '.join(missing_keys)}")
+                self.__stack.pop()
+                self.__end_value()
+            elif (state == "key_or_end" or state == "key") and c == '"':
+                self.__in_string = True
+                self.__string_is_key = True
+                self.__key_chars = []
+            elif state == "colon" and c == ":":
+                frame[2] = "value"
+            elif state == "value":
+                frame[2] = "in_value"
+                self.__begin_value(c, self.__child_schema())
+            elif state == "comma_or_end" and c == ",":
+                frame[2] = "key"
+            else:
+                self.__fail_syntax(f"Unexpected character '{c}' in an object")
+        else:
+            if state == "value_or_end" and c == "]" or state == "comma_or_end" and c == "]":
+                self.__stack.pop()
+                self.__end_value()
+            elif state == "value_or_end" or state == "value":
+                frame[2] = "in_value"
+                self.__begin_value(c, self.__child_schema())
+            elif state == "comma_or_end" and c == ",":
+                frame[2] = "value"
+            else:
+                self.__fail_syntax(f"Unexpected character '{c}' in an array")
+
+    def __end_key(self, key: str):
+        frame = self.__stack[-1]
+        schema = frame[1]
+        if schema.get("additionalProperties") is False and key not in schema.get("properties", dict()):
+            self.__fail(f"Unknown key '{key}'")
+        frame[3] = key
+        frame[4].add(key)
+        frame[2] = "colon"
@@ -1,13 +1,20 @@
+import asyncio
 import json
+from collections import OrderedDict
+from dataclasses import dataclass
 from itertools import chain
-from typing import TypeVar, Generic, Callable, Any
+from time import perf_counter
+from typing import TypeVar, Generic, Callable, Any, Hashable, AsyncIterable, Iterable, AsyncIterator, Type
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, create_model
 
 from chatlib.chatlib.chatbot import ChatCompletionParams, Dialogue, DialogueTurn
 from chatlib.chatlib.llm.chat_completion_api import ChatCompletionAPI, ChatCompletionMessage, ChatCompletionMessageRole, \
     ChatCompletionFinishReason
-from chatlib.chatlib.tool.converter import str_to_str_noop
+from chatlib.chatlib.tool.converter import str_to_str_noop, json_str_to_dict_converter
+from chatlib.chatlib.tool.dialogue_render_cache import DialogueRenderCache, default_dialogue_render_cache
+from chatlib.chatlib.tool.structured_output import IncrementalJsonValidator, StreamedJsonShapeError, \
+    StreamedJsonSyntaxError, make_structured_output_json_schema
 from chatlib.chatlib.utils.jinja_utils import convert_to_jinja_template
 
 
@@ -16,6 +23,7 @@ class ChatCompletionFewShotMapperParams(BaseModel):
 
     model: str
     api_params: ChatCompletionParams
+    use_cascade: bool = True  # Whether to apply the mapper's cascade, if it has one.
 
 
 InputType = TypeVar('InputType')
@@ -30,6 +38,104 @@ class MapperInputOutputPair(BaseModel, Generic[InputType, OutputType]):
     output: OutputType
 
 
+@dataclass(frozen=True)
+class MapperBatchItemResult(Generic[InputType, OutputType]):
+    index: int
+    input: InputType
+    output: OutputType | None = None
+    error: Exception | None = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+class MapperRetryStats(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    run_count: int = 0
+    retried_run_count: int = 0
+    retry_count: int = 0
+    failed_run_count: int = 0
+
+    @property
+    def retry_rate(self) -> float:
+        """Ratio of runs that needed at least one retry."""
+        return self.retried_run_count / self.run_count if self.run_count > 0 else 0
+
+    def __str__(self) -> str:
+        return (f"{self.run_count} run(s), {self.retried_run_count} retried ({self.retry_rate * 100:.1f}%), "
+                f"{self.retry_count} retry request(s), {self.failed_run_count} failed")
+
+
+@dataclass(frozen=True)
+class MapperCascade(Generic[OutputType]):
+    """
+    Policy to try a cheap model first and escalate to the model in params only when needed.
+    :param cheap_model: Model asked first, along with a self-reported confidence.
+    :param confidence_threshold: Escalate if the reported confidence is below this.
+    :param escalate_if: Escalate if this returns True for the cheap model's output, e.g., for a proposed transition.
+    :param name: Name used in logs.
+    """
+    cheap_model: str
+    confidence_threshold: float = 0.8
+    escalate_if: Callable[[OutputType], bool] | None = None
+    name: str | None = None
+
+
+class MapperCascadeStats(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    run_count: int = 0
+    escalated_count: int = 0
+    cheap_latency: float = 0
+    strong_latency: float = 0
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalated_count / self.run_count if self.run_count > 0 else 0
+
+    @property
+    def estimated_latency_saving(self) -> float:
+        """Seconds saved compared to asking the strong model every time, estimated from its average latency."""
+        if self.escalated_count == 0:
+            return 0
+        return (self.strong_latency / self.escalated_count) * self.run_count - (self.cheap_latency + self.strong_latency)
+
+    def __str__(self) -> str:
+        return (f"{self.run_count} run(s), {self.escalated_count} escalated ({self.escalation_rate * 100:.1f}%), "
+                f"estimated saving {self.estimated_latency_saving:.2f} sec")
+
+
+CASCADE_CONFIDENCE_INSTRUCTION = """
+In addition, include a "confidence" property in the JSON output: a number between 0 and 1 indicating how confident you are that the output is correct."""
+
+ERROR_FEEDBACK_TEMPLATE = convert_to_jinja_template("""
+Your previous output could not be accepted:
+{{error}}
+Respond again with the corrected output only, following the instruction and the format of the examples.""")
+
+# Maximum number of compiled example blocks kept per mapper, in LRU order. Blocks of examples lists or params that are
+# made per call are never hit again, so they are evicted instead of piling up.
+MAX_EXAMPLE_BLOCKS = 32
+
+
+class CompiledExampleBlock:
+    """
+    Example messages of a few-shot mapper, compiled once per examples list and example cache key.
+    """
+
+    def __init__(self, examples: list[MapperInputOutputPair], messages: tuple[ChatCompletionMessage, ...]):
+        self.examples = examples  # Keep the reference so that the id used in the cache key is not recycled.
+        self.messages = messages
+        self.__token_counts: dict[str, int] = dict()
+
+    def count_tokens(self, api: ChatCompletionAPI, model: str) -> int:
+        if model not in self.__token_counts:
+            self.__token_counts[model] = api.count_token_in_messages(list(self.messages), model)
+        return self.__token_counts[model]
+
+
 class ChatCompletionFewShotMapper(Generic[InputType, OutputType, ParamsType]):
 
     @classmethod
@@ -45,7 +151,23 @@ class ChatCompletionFewShotMapper(Generic[InputType, OutputType, ParamsType]):
                  str_output_converter: Callable[[str, ParamsType], OutputType],
                  output_validator: Callable[[InputType, OutputType], bool] | None = None,
                  example_str_converter: Callable[[InputType, ParamsType], str] | None = None,
+                 example_cache_key: Callable[[ParamsType], Hashable] | None = None,
+                 output_model: Type[BaseModel] | None = None,
+                 retry_with_error_feedback: bool = True,
+                 cascade: MapperCascade[OutputType] | None = None
                  ):
+        """
+        :param example_cache_key: Extracts the part of params that the example converters depend on.
+        Compiled example messages are reused across calls with the same examples list and key.
+        If None, the params object itself is used as the key, and unhashable params disable the cache.
+        :param output_model: Pydantic model of the JSON output. If set, the output is constrained to its schema where
+        the provider supports it. Otherwise, the completion is streamed and validated against the schema as it
+        arrives, so that a malformed output is aborted and retried early.
+        :param retry_with_error_feedback: If True, a retry after a malformed output sends the output and the error
+        back to the model instead of repeating the identical request.
+        :param cascade: If set, runs ask the cascade's cheap model first. Applied only when params.use_cascade is True
+        and params.model differs from the cheap model.
+        """
         self.__api = api
         self.__instruction_generator = instruction_generator
         self.__str_output_converter = str_output_converter
@@ -57,24 +179,94 @@ class ChatCompletionFewShotMapper(Generic[InputType, OutputType, ParamsType]):
 
         self.__output_validator = output_validator
 
+        self.__example_cache_key = example_cache_key
+        self.__example_block_cache: OrderedDict[tuple[int, Hashable], CompiledExampleBlock] = OrderedDict()
+
+        self.__output_model = output_model
+        if output_model is not None:
+            self.__output_json_schema = output_model.model_json_schema()
+            self.__structured_output_json_schema = make_structured_output_json_schema(output_model)
+        else:
+            self.__output_json_schema = None
+            self.__structured_output_json_schema = None
+
+        self.__retry_with_error_feedback = retry_with_error_feedback
+        self.__retry_stats = MapperRetryStats()
+
+        self.__cascade = cascade
+        self.__cascade_stats = MapperCascadeStats()
+        if cascade is not None and output_model is not None:
+            confidence_model = create_model(output_model.__name__, __base__=output_model, confidence=(float, ...))
+            self.__confidence_output_json_schema = make_structured_output_json_schema(confidence_model)
+        else:
+            self.__confidence_output_json_schema = None
+
     @property
     def api(self) -> ChatCompletionAPI:
         return self.__api
 
-    async def run(self,
-                  examples: list[MapperInputOutputPair[InputType, OutputType]] | None,
-                  input: InputType,
-                  params: ParamsType,
-                  output_malformed_retry_count: int = 5
-                  ) -> OutputType:
-        if examples is not None:  # TODO cache example messages
-            converter = self.__example_str_converter or self.__input_str_converter
-            example_messages = list(chain.from_iterable([[
-                ChatCompletionMessage(content=converter(example.input, params),
-                                      role=ChatCompletionMessageRole.SYSTEM, name="example_user"),
-                ChatCompletionMessage(content=self.__output_str_converter(example.output, params),
-                                      role=ChatCompletionMessageRole.SYSTEM, name="example_assistant")
-            ] for example in examples]))
+    @property
+    def output_model(self) -> Type[BaseModel] | None:
+        return self.__output_model
+
+    @property
+    def retry_stats(self) -> MapperRetryStats:
+        return self.__retry_stats
+
+    def reset_retry_stats(self):
+        self.__retry_stats = MapperRetryStats()
+
+    @property
+    def cascade_stats(self) -> MapperCascadeStats:
+        return self.__cascade_stats
+
+    def reset_cascade_stats(self):
+        self.__cascade_stats = MapperCascadeStats()
+
+    def __update_retry_stats(self, retry_count: int, failed: bool):
+        stats = self.__retry_stats
+        self.__retry_stats = MapperRetryStats(run_count=stats.run_count + 1,
+                                              retried_run_count=stats.retried_run_count + (1 if retry_count > 0 else 0),
+                                              retry_count=stats.retry_count + retry_count,
+                                              failed_run_count=stats.failed_run_count + (1 if failed else 0))
+
+    def __compile_example_block(self, examples: list[MapperInputOutputPair[InputType, OutputType]],
+                                params: ParamsType) -> CompiledExampleBlock:
+        converter = self.__example_str_converter or self.__input_str_converter
+        return CompiledExampleBlock(examples, tuple(chain.from_iterable([[
+            ChatCompletionMessage(content=converter(example.input, params),
+                                  role=ChatCompletionMessageRole.SYSTEM, name="example_user"),
+            ChatCompletionMessage(content=self.__output_str_converter(example.output, params),
+                                  role=ChatCompletionMessageRole.SYSTEM, name="example_assistant")
+        ] for example in examples])))
+
+    def get_example_block(self, examples: list[MapperInputOutputPair[InputType, OutputType]],
+                          params: ParamsType) -> CompiledExampleBlock:
+        try:
+            key = (id(examples), self.__example_cache_key(params) if self.__example_cache_key is not None else params)
+            hash(key)
+        except TypeError:  # Params are not hashable; compile without caching.
+            return self.__compile_example_block(examples, params)
+
+        block = self.__example_block_cache.get(key)
+        if block is None or block.examples is not examples:
+            block = self.__compile_example_block(examples, params)
+            self.__example_block_cache[key] = block
+            if len(self.__example_block_cache) > MAX_EXAMPLE_BLOCKS:
+                self.__example_block_cache.popitem(last=False)
+        self.__example_block_cache.move_to_end(key)
+        return block
+
+    def build_messages(self,
+                       examples: list[MapperInputOutputPair[InputType, OutputType]] | None,
+                       input: InputType,
+                       params: ParamsType,
+                       input_str: str | None = None) -> list[ChatCompletionMessage]:
+        """
+        :param input_str: If set, used as the user message instead of the converted input.
+        """
+        if examples is not None:
+            example_messages = self.get_example_block(examples, params).messages
         else:
             example_messages = None
 
@@ -88,35 +280,258 @@ class ChatCompletionFewShotMapper(Generic[InputType, OutputType, ParamsType]):
         if example_messages is not None:
             messages.extend(example_messages)
 
-        messages.append(ChatCompletionMessage(content=self.__input_str_converter(input, params),
-                                              role=ChatCompletionMessageRole.USER))
+        messages.append(ChatCompletionMessage(
+            content=input_str if input_str is not None else self.__input_str_converter(input, params),
+            role=ChatCompletionMessageRole.USER))
+        return messages
+
+    def parse_output(self, input: InputType, content: str, params: ParamsType) -> OutputType:
+        """
+        Convert and validate a raw completion text.
+        :raise Exception: If the content is malformed or the output fails validation.
+        """
+        output = self.__str_output_converter(content, params)
+        if self.__output_validator is not None and self.__output_validator(input, output) is not True:
+            raise ValueError("Output validation failed.")
+        return output
+
+    async def __stream_validated_content(self, model: str, messages: list[ChatCompletionMessage],
+                                         api_params: dict) -> str:
+        validator = IncrementalJsonValidator(self.__output_json_schema)
+        is_validating = True
+        chunks = []
+        stream = self.__api.run_chat_completion_stream(model, messages, api_params)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                if is_validating:
+                    try:
+                        validator.feed(chunk)
+                    except StreamedJsonSyntaxError:
+                        # Read the rest and leave the text to the output converter, which may repair it.
+                        is_validating = False
+                        continue
+                    if validator.is_complete:
+                        break
+        finally:
+            await stream.aclose()  # Stop generating as soon as the output is complete or malformed.
+
+        if validator.is_complete:
+            return validator.extract_value("".join(chunks))
+        else:
+            return "".join(chunks)
+
+    async def run(self,
+                  examples: list[MapperInputOutputPair[InputType, OutputType]] | None,
+                  input: InputType,
+                  params: ParamsType,
+                  output_malformed_retry_count: int = 5
+                  ) -> OutputType:
+        messages = self.build_messages(examples, input, params)
+        return await self._run_messages(messages, input, params, output_malformed_retry_count)
 
-        left_retry_count = output_malformed_retry_count
-        while True:
-            chat_response = await self.__api.run_chat_completion(params.model, messages, params.api_params.dict())
+    async def _run_messages(self, messages: list[ChatCompletionMessage], input: InputType, params: ParamsType,
+                            output_malformed_retry_count: int = 5) -> OutputType:
+        if self.__cascade is not None and params.use_cascade and self.__cascade.cheap_model != params.model:
+            return await self.__run_cascade(messages, input, params, output_malformed_retry_count)
+        else:
+            return await self.__run_with_retries(messages, input, params, output_malformed_retry_count)
+
+    async def __run_cascade(self, messages: list[ChatCompletionMessage], input: InputType, params: ParamsType,
+                            output_malformed_retry_count: int) -> OutputType:
+        cascade = self.__cascade
+
+        start = perf_counter()
+        escalation_reason = None
+        try:
+            output, confidence = await self.__run_with_confidence(messages, input, params.model_copy(
+                update=dict(model=cascade.cheap_model)))
+            if confidence < cascade.confidence_threshold:
+                escalation_reason = f"low confidence {confidence:.2f}"
+            elif cascade.escalate_if is not None and cascade.escalate_if(output) is True:
+                escalation_reason = "escalation condition met"
+        except Exception as e:
+            escalation_reason = f"cheap model failed - {e}"
+        cheap_latency = perf_counter() - start
+
+        strong_latency = 0
+        if escalation_reason is not None:
+            start = perf_counter()
+            output = await self.__run_with_retries(messages, input, params, output_malformed_retry_count)
+            strong_latency = perf_counter() - start
+
+        stats = self.__cascade_stats
+        self.__cascade_stats = MapperCascadeStats(
+            run_count=stats.run_count + 1,
+            escalated_count=stats.escalated_count + (1 if escalation_reason is not None else 0),
+            cheap_latency=stats.cheap_latency + cheap_latency,
+            strong_latency=stats.strong_latency + strong_latency)
+
+        print(f"[Cascade{' ' + cascade.name if cascade.name is not None else ''}] "
+              f"{'Escalated to ' + params.model + ' (' + escalation_reason + ')' if escalation_reason is not None else 'Answered by ' + cascade.cheap_model}"
+              f" in {int((cheap_latency + strong_latency) * 1000)} millis. {self.__cascade_stats}")
+        return output
+
+    async def __run_with_confidence(self, messages: list[ChatCompletionMessage], input: InputType,
+                                    params: ParamsType) -> tuple[OutputType, float]:
+        messages = [ChatCompletionMessage(content=messages[0].content + CASCADE_CONFIDENCE_INSTRUCTION,
+                                          role=messages[0].role)] + messages[1:]
+
+        api_params = params.api_params.dict()
+        if self.__confidence_output_json_schema is not None and self.__api.supports_json_schema_output(params.model):
+            api_params.update(self.__api.get_json_schema_output_params(self.__output_model.__name__,
+                                                                       self.__confidence_output_json_schema))
+
+        chat_response = await self.__api.run_chat_completion(params.model, messages, api_params)
+        if chat_response.finish_reason != ChatCompletionFinishReason.Stop:
+            raise Exception(chat_response.finish_reason)
+
+        output = self.parse_output(input, chat_response.message.content, params)
+        confidence = json_str_to_dict_converter(chat_response.message.content, params).get("confidence")
+        return output, float(confidence) if isinstance(confidence, (int, float)) else 0
+
+    async def __run_with_retries(self, messages: list[ChatCompletionMessage], input: InputType, params: ParamsType,
+                                 output_malformed_retry_count: int) -> OutputType:
+        api_params = params.api_params.dict()
+        stream_validation = False
+        if self.__output_model is not None:
+            if self.__api.supports_json_schema_output(params.model):
+                api_params.update(self.__api.get_json_schema_output_params(self.__output_model.__name__,
+                                                                           self.__structured_output_json_schema))
+            else:
+                stream_validation = True
+
+        request_messages = messages
+        retry_count = 0
+        try:
+            while True:
+                if stream_validation:
+                    try:
+                        content = await self.__stream_validated_content(params.model, request_messages, api_params)
+                    except StreamedJsonShapeError as e:
+                        content = e
+                else:
+                    chat_response = await self.__api.run_chat_completion(params.model, request_messages, api_params)
+                    if chat_response.finish_reason != ChatCompletionFinishReason.Stop:
+                        raise Exception(chat_response.finish_reason)
+                    content = chat_response.message.content
 
-            if chat_response.finish_reason == ChatCompletionFinishReason.Stop:
                 try:
-                    output = self.__str_output_converter(chat_response.message.content, params)
-                    if self.__output_validator is not None:
-                        if self.__output_validator(input, output) is True:
-                            return output
-                        else:
-                            raise ValueError("Output validation failed.")
-                    else:
-                        return output
+                    if isinstance(content, StreamedJsonShapeError):
+                        raise content
+                    output = self.parse_output(input, content, params)
+                    self.__update_retry_stats(retry_count, failed=False)
+                    return output
                 except Exception as e:  # If converting fails
-                    if left_retry_count > 0:
+                    if retry_count < output_malformed_retry_count:
+                        retry_count += 1
                         print(
-                            f"Output converting failed. retry count left: {left_retry_count}, Content: \"{chat_response.message.content}\"")
+                            f"Output converting failed. retry count left: {output_malformed_retry_count - retry_count + 1}, Content: \"{content}\"")
                         print(f"Error: {e}")
-                        left_retry_count -= 1
+                        if self.__retry_with_error_feedback:
+                            # Only the latest failure is fed back, so the prompt does not grow with retries.
+                            request_messages = messages + self.__make_error_feedback_messages(content, e)
                         continue
                     else:
                         raise Exception(
                             "Output malformed for conversion. Consumed all retry count. PLease check your instruction.")
-            else:
-                raise Exception(chat_response.finish_reason)
+        except Exception:
+            self.__update_retry_stats(retry_count, failed=True)
+            raise
+
+    @staticmethod
+    def __make_error_feedback_messages(content: str | Exception, error: Exception) -> list[ChatCompletionMessage]:
+        feedback_messages = []
+        if isinstance(content, str):
+            feedback_messages.append(ChatCompletionMessage(content=content, role=ChatCompletionMessageRole.ASSISTANT))
+        feedback_messages.append(ChatCompletionMessage(content=ERROR_FEEDBACK_TEMPLATE.render(error=error),
+                                                       role=ChatCompletionMessageRole.USER))
+        return feedback_messages
+
+    async def run_many(self,
+                       examples: list[MapperInputOutputPair[InputType, OutputType]] | None,
+                       inputs: AsyncIterable[InputType] | Iterable[InputType],
+                       params: ParamsType | Callable[[InputType], ParamsType],
+                       concurrency: int = 8,
+                       ordered: bool = True,
+                       output_malformed_retry_count: int = 5,
+                       reorder_window: int | None = None
+                       ) -> AsyncIterator[MapperBatchItemResult[InputType, OutputType]]:
+        """
+        Run the mapper over many inputs with a bounded number of requests in flight.
+        A failure of an item is reported in its result and does not abort the batch.
+        :param inputs: Inputs to map. Pulled lazily, so an async iterable may stream them from storage.
+        :param params: Params shared by all inputs, or a function that returns params for each input.
+        :param concurrency: Maximum number of requests in flight.
+        :param ordered: If True, results are yielded in input order. Otherwise, as they complete.
+        :param reorder_window: In ordered mode, maximum number of items started after the earliest item not yet
+        yielded. Bounds the results held back behind a slow item. Defaults to four times the concurrency.
+        :return: An async iterator of per-item results.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        result_queue: asyncio.Queue[MapperBatchItemResult | None] = asyncio.Queue()
+        tasks: set[asyncio.Task] = set()
+
+        window = max(1, reorder_window or max(1, concurrency) * 4)
+        next_index = 0  # The earliest item not yet yielded
+        window_moved = asyncio.Condition()
+
+        async def run_item(index: int, input: InputType, item_params: ParamsType):
+            try:
+                output = await self.run(examples, input, item_params, output_malformed_retry_count)
+                await result_queue.put(MapperBatchItemResult(index, input, output=output))
+            except Exception as e:
+                await result_queue.put(MapperBatchItemResult(index, input, error=e))
+            finally:
+                semaphore.release()
+
+        async def produce():
+            index = 0
+            try:
+                async for input in (inputs if isinstance(inputs, AsyncIterable) else _to_async_iterable(inputs)):
+                    item_params = params(input) if callable(params) else params
+                    if examples is not None:  # Compile examples once before the requests fan out.
+                        self.get_example_block(examples, item_params)
+                    if ordered:
+                        async with window_moved:
+                            await window_moved.wait_for(lambda: index - next_index < window)
+                    await semaphore.acquire()
+                    task = asyncio.create_task(run_item(index, input, item_params))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    index += 1
+                if len(tasks) > 0:
+                    await asyncio.wait(set(tasks))
+            finally:
+                await result_queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            pending: dict[int, MapperBatchItemResult] = dict()
+            while True:
+                result = await result_queue.get()
+                if result is None:
+                    break
+                elif ordered:
+                    pending[result.index] = result
+                    while next_index in pending:
+                        yield pending.pop(next_index)
+                        next_index += 1
+                        async with window_moved:
+                            window_moved.notify_all()
+                else:
+                    yield result
+
+            await producer  # Propagate an error raised while iterating the inputs.
+        finally:
+            producer.cancel()
+            for task in list(tasks):
+                task.cancel()
+
+
+async def _to_async_iterable(iterable: Iterable[InputType]) -> AsyncIterator[InputType]:
+    for elm in iterable:
+        yield elm
 
 
 DEFAULT_USER_ALIAS = "User"
@@ -129,6 +544,25 @@ DIALOGUE_TEMPLATE = convert_to_jinja_template("""
 {%endfor%}</dialogue>
 """)
 
+INCREMENTAL_INPUT_TEMPLATE = convert_to_jinja_template("""
+<previous_result>{{previous_result}}</previous_result>
+The result above was derived from the earlier part of the dialogue, which is omitted. Below are only the turns added since then.
+Update the result so that it reflects the whole dialogue, and output it in the same format.
+{{dialogue}}""")
+
+
+class IncrementalSummaryState(BaseModel):
+    """
+    What an incremental summarization run needs from the previous one. Pass it to the next run of the same dialogue.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    output: str
+    window_start_turn_id: str
+    last_turn_id: str
+    incremental_run_count: int = 0
+
+
 class DialogueSummarizer(ChatCompletionFewShotMapper[Dialogue, OutputType, ParamsType]):
 
     def __init__(self, 
@@ -139,10 +573,24 @@ class DialogueSummarizer(ChatCompletionFewShotMapper[Dialogue, OutputType, Param
                  output_validator: Callable[[InputType, OutputType], bool] | None = None,
                  dialogue_filter: Callable[[Dialogue, ParamsType | None], Dialogue] | None = None,
                  user_alias: str | None = None,
-                 system_alias: str | None = None
+                 system_alias: str | None = None,
+                 example_cache_key: Callable[[ParamsType], Hashable] | None = lambda params: None,
+                 output_model: Type[BaseModel] | None = None,
+                 retry_with_error_feedback: bool = True,
+                 cascade: MapperCascade[OutputType] | None = None,
+                 full_evaluation_interval: int = 4,
+                 render_cache: DialogueRenderCache | None = default_dialogue_render_cache
                  ):
+        """
+        :param full_evaluation_interval: In run_incremental, the maximum number of consecutive incremental runs
+        before the whole window is evaluated again to prevent drift.
+        :param render_cache: Cache of rendered turns shared by summarizers. If None, DIALOGUE_TEMPLATE renders
+        every window from scratch.
+        """
 
         self.__dialogue_filter = dialogue_filter
+        self.__output_str_converter = output_str_converter
+        self.__full_evaluation_interval = full_evaluation_interval
         self.__user_alias = user_alias
         self.__system_alias = system_alias
 
@@ -152,8 +600,80 @@ class DialogueSummarizer(ChatCompletionFewShotMapper[Dialogue, OutputType, Param
             self.__system_alias if self.__system_alias is not None and len(self.__system_alias) > 0 else DEFAULT_SYSTEM_ALIAS)
         
 
+        self.__resolved_user_alias = user_alias
+        self.__resolved_system_alias = system_alias
+        self.__render_cache = render_cache
+
         super().__init__(api, instruction_generator, 
-                         lambda d, p: DIALOGUE_TEMPLATE.render(user_alias=user_alias, system_alias=system_alias, dialogue=self.__dialogue_filter(d, p) if self.__dialogue_filter is not None else d), 
+                         lambda d, p: self.__render_dialogue(self.__dialogue_filter(d, p) if self.__dialogue_filter is not None else d), 
                          output_str_converter, str_output_converter, output_validator, 
-                         lambda d, p: DIALOGUE_TEMPLATE.render(user_alias=user_alias, system_alias=system_alias, dialogue=d)
-                         )
\ No newline at end of file
+                         lambda d, p: self.__render_dialogue(d),
+                         example_cache_key,
+                         output_model,
+                         retry_with_error_feedback,
+                         cascade
+                         )
+
+    def __render_dialogue(self, dialogue: Dialogue) -> str:
+        if self.__render_cache is not None:
+            return self.__render_cache.render(dialogue, self.__resolved_user_alias, self.__resolved_system_alias)
+        else:
+            return DIALOGUE_TEMPLATE.render(user_alias=self.__resolved_user_alias,
+                                            system_alias=self.__resolved_system_alias, dialogue=dialogue)
+
+    async def run_incremental(self,
+                              examples: list[MapperInputOutputPair[Dialogue, OutputType]] | None,
+                              dialogue: Dialogue,
+                              params: ParamsType,
+                              state: IncrementalSummaryState | None,
+                              output_malformed_retry_count: int = 5
+                              ) -> tuple[OutputType, IncrementalSummaryState | None]:
+        """
+        Summarize only the turns added since the previous run, along with its result.
+        The whole window is evaluated instead when there is no usable state, the window has moved (e.g., a new
+        phase), or full_evaluation_interval incremental runs have passed.
+        :return: The output and the state for the next run.
+        """
+        window = self.__dialogue_filter(dialogue, params) if self.__dialogue_filter is not None else dialogue
+        if len(window) == 0:
+            return await self.run(examples, dialogue, params, output_malformed_retry_count), None
+
+        new_turns = None
+        if (state is not None and state.incremental_run_count < self.__full_evaluation_interval
+                and window[0].id == state.window_start_turn_id):
+            turn_ids = [turn.id for turn in window]
+            if state.last_turn_id in turn_ids:
+                new_turns = window[turn_ids.index(state.last_turn_id) + 1:]
+
+        if new_turns is None:
+            output = await self.run(examples, dialogue, params, output_malformed_retry_count)
+            incremental_run_count = 0
+        elif len(new_turns) == 0:
+            return self.parse_output(dialogue, state.output, params), state
+        else:
+            input_str = INCREMENTAL_INPUT_TEMPLATE.render(
+                previous_result=state.output,
+                dialogue=self.__render_dialogue(new_turns))
+            messages = self.build_messages(examples, dialogue, params, input_str=input_str)
+            output = await self._run_messages(messages, dialogue, params, output_malformed_retry_count)
+            incremental_run_count = state.incremental_run_count + 1
+
+        return output, self.__make_incremental_summary_state(window, output, params, incremental_run_count)
+
+    def make_incremental_summary_state(self, dialogue: Dialogue, output: OutputType,
+                                       params: ParamsType) -> IncrementalSummaryState | None:
+        """
+        Make the state for run_incremental from an output of the whole window obtained elsewhere, e.g., a fused run.
+        :return: The state, or None if the window is empty.
+        """
+        window = self.__dialogue_filter(dialogue, params) if self.__dialogue_filter is not None else dialogue
+        if len(window) == 0:
+            return None
+        return self.__make_incremental_summary_state(window, output, params, 0)
+
+    def __make_incremental_summary_state(self, window: Dialogue, output: OutputType, params: ParamsType,
+                                         incremental_run_count: int) -> IncrementalSummaryState:
+        return IncrementalSummaryState(output=self.__output_str_converter(output, params),
+                                       window_start_turn_id=window[0].id,
+                                       last_turn_id=window[len(window) - 1].id,
+                                       incremental_run_count=incremental_run_count)
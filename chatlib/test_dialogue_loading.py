@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from time import perf_counter
+
+import jsonlines
+
+from chatlib.chatlib.chatbot import DialogueTurn
+from chatlib.chatlib.chatbot.session_writer import SessionFileWriter, TOMBSTONE_KEY, _get_session_directory_path
+
+# Compares the ways to load a long session from dialogue.jsonl.
+# Run from the repository root: python -m chatlib.test_dialogue_loading
+
+NUM_TURNS = 2000
+NUM_RECENT_TURNS = 20
+REPEAT = 50
+
+
+def read_dialogue_per_row(fp: str):
+    # The way read_dialogue decoded the file before: one validated model construction per row.
+    with jsonlines.open(fp, "r") as reader:
+        rows = [row for row in reader]
+    deleted_turn_ids = set([row[TOMBSTONE_KEY] for row in rows if TOMBSTONE_KEY in row])
+    return [DialogueTurn(**row) for row in rows if TOMBSTONE_KEY not in row and row["id"] not in deleted_turn_ids]
+
+
+def measure(name: str, func, baseline: float | None = None) -> float:
+    start_ts = perf_counter()
+    for _ in range(REPEAT):
+        func()
+    elapsed = (perf_counter() - start_ts) / REPEAT
+    print(f"{name}: {elapsed * 1000:.2f} millis" + (f" ({baseline / elapsed:.1f}x)" if baseline is not None else ""))
+    return elapsed
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        writer = SessionFileWriter()
+
+        turns = [DialogueTurn(message=f"Message {i} " + "lorem ipsum " * 10, is_user=i % 2 == 0,
+                              processing_time=None if i % 2 == 0 else 1200,
+                              metadata=None if i % 2 == 0 else dict(state="explore", payload=dict(i=i)))
+                 for i in range(NUM_TURNS)]
+        writer.write_turns("long", turns)
+        writer.delete_turn("long", turns[NUM_TURNS - 1].id)
+        expected = turns[:NUM_TURNS - 1]
+
+        fp = os.path.join(_get_session_directory_path("long"), "dialogue.jsonl")
+        assert writer.read_dialogue("long") == expected
+        assert writer.read_recent_turns("long", NUM_RECENT_TURNS) == expected[-NUM_RECENT_TURNS:]
+        assert writer.read_turns_after("long", expected[-5].id) == expected[-4:]
+
+        assert read_dialogue_per_row(fp) == expected
+
+        writer.write_turns("clean", expected)
+        clean_fp = os.path.join(_get_session_directory_path("clean"), "dialogue.jsonl")
+        assert writer.read_dialogue("clean") == expected
+
+        print(f"Loading a {NUM_TURNS}-turn session:")
+        baseline = measure("Per-row validation", lambda: read_dialogue_per_row(clean_fp))
+        measure("Bulk validation", lambda: writer.read_dialogue("clean"), baseline)
+        deleted_baseline = measure("Per-row validation, with a deleted turn", lambda: read_dialogue_per_row(fp))
+        measure("Bulk validation, with a deleted turn", lambda: writer.read_dialogue("long"), deleted_baseline)
+        measure(f"Last {NUM_RECENT_TURNS} turns through the offset index",
+                lambda: writer.read_recent_turns("long", NUM_RECENT_TURNS), baseline)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
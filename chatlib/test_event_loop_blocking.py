@@ -0,0 +1,94 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from time import perf_counter
+
+from chatlib.chatlib.chatbot import DialogueTurn, Dialogue, ResponseGenerator, TurnTakingChatSession
+from chatlib.chatlib.chatbot.session_writer import SessionFileWriter
+
+# Measures how long session persistence blocks the event loop per request, with the synchronous writer calls
+# and with their async counterparts that run on the I/O threads.
+# Run from the repository root: python -m chatlib.test_event_loop_blocking
+
+NUM_SESSIONS = 50
+TURNS_PER_SESSION = 20
+
+
+class EchoResponseGenerator(ResponseGenerator):
+
+    def __init__(self):
+        super().__init__()
+        self.__history = []
+
+    async def _get_response_impl(self, dialog: Dialogue, dry: bool = False) -> tuple[str, dict | None]:
+        await asyncio.sleep(0.001)
+        self.__history.append(dict(turns=len(dialog), note="x" * 200))
+        return f"Echo: {dialog[-1].message if len(dialog) > 0 else ''}", None
+
+    def write_to_json(self, parcel: dict):
+        parcel["history"] = list(self.__history)
+
+    def restore_from_json(self, parcel: dict):
+        self.__history = parcel["history"]
+
+
+class LoopTimingFileWriter(SessionFileWriter):
+    """Accumulates the time spent in writes made on the event loop thread."""
+
+    def __init__(self):
+        super().__init__(fsync=True)
+        self.loop_thread_time = 0.0
+
+    def __measure(self, func, *args):
+        ts = perf_counter()
+        func(*args)
+        if threading.current_thread() is threading.main_thread():
+            self.loop_thread_time += perf_counter() - ts
+
+    def write_turn(self, session_id: str, turn: DialogueTurn):
+        self.__measure(super().write_turn, session_id, turn)
+
+    def write_session_info(self, session_id, session_info: dict):
+        self.__measure(super().write_session_info, session_id, session_info)
+
+    def append_state_log(self, session_id: str, entries: list[dict]):
+        self.__measure(super().append_state_log, session_id, entries)
+
+
+async def run_session(session_id: str, writer: LoopTimingFileWriter, use_async: bool):
+    session = TurnTakingChatSession(session_id, EchoResponseGenerator(), writer)
+    for i in range(TURNS_PER_SESSION):
+        user_turn = DialogueTurn(message=f"Message {i}", is_user=True)
+        if use_async:
+            await session.push_user_message(user_turn)
+        else:
+            # The persistence calls as they were made before the async counterparts existed.
+            session._push_new_turn(user_turn)
+            message, metadata, elapsed = await session.response_generator.get_response(session.dialog)
+            session._push_new_turn(DialogueTurn(message=message, is_user=False, processing_time=elapsed))
+    del session
+
+
+async def measure(use_async: bool) -> tuple[float, float]:
+    writer = LoopTimingFileWriter()
+    start_ts = perf_counter()
+    await asyncio.gather(*[run_session(f"{'async' if use_async else 'sync'}_{i}", writer, use_async)
+                           for i in range(NUM_SESSIONS)])
+    return writer.loop_thread_time, perf_counter() - start_ts
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        num_requests = NUM_SESSIONS * TURNS_PER_SESSION
+        for name, use_async in [("Sync writer calls", False), ("Async writer calls", True)]:
+            loop_thread_time, elapsed = asyncio.run(measure(use_async))
+            print(f"{name}: {loop_thread_time / num_requests * 1000:.3f} millis of event loop blocking per request, "
+                  f"{elapsed:.2f} secs in total")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+from pydantic import BaseModel
+
+from chatlib.chatlib.chatbot import ChatCompletionParams, DialogueTurn
+from chatlib.chatlib.llm.integration import MockChatCompletionAPI
+from chatlib.chatlib.tool.converter import generate_pydantic_converter
+from chatlib.chatlib.tool.fused_summarizer import FusedSummarizer, FusedSummarizerTask
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, ChatCompletionFewShotMapperParams, \
+    MapperInputOutputPair
+
+# Compares separate safety + phase summarizer requests with a fused request on the mock provider.
+# Run from the repository root: python -m chatlib.test_fused_summarizer
+
+NUM_TURNS = 50
+
+
+class SafetyResult(BaseModel):
+    sensitive_topic: bool
+
+
+class PhaseResult(BaseModel):
+    key_episode: str | None
+    move_to_next: bool
+
+
+def make_summarizer(api: MockChatCompletionAPI, output_model: type[BaseModel], instruction: str) -> DialogueSummarizer:
+    str_to_result, result_to_str = generate_pydantic_converter(output_model)
+    return DialogueSummarizer(api=api, instruction_generator=instruction, output_str_converter=result_to_str,
+                              str_output_converter=str_to_result, output_model=output_model)
+
+
+def responder(model: str, messages, params: dict) -> str:
+    safety = dict(sensitive_topic=False)
+    phase = dict(key_episode="fighting with a friend", move_to_next=False)
+    instruction = messages[0].content
+    if "<task name=" in instruction:
+        if "[malformed]" in messages[-1].content:
+            return json.dumps(dict(safety=safety, phase=dict(key_episode=None)))
+        return json.dumps(dict(safety=safety, phase=phase))
+    elif "sensitive" in instruction:
+        return json.dumps(safety)
+    else:
+        return json.dumps(phase)
+
+
+def make_dialogue(n: int, malformed: bool = False):
+    dialogue = []
+    for i in range(n):
+        dialogue.append(DialogueTurn(message=f"How was your day? Tell me more about it. ({i})", is_user=False))
+        dialogue.append(DialogueTurn(message=f"I had a fight with my friend and I feel bad about it. ({i})"
+                                             + (" [malformed]" if malformed and i == n - 1 else ""), is_user=True))
+    return dialogue
+
+
+async def measure(api: MockChatCompletionAPI):
+    safety_summarizer = make_summarizer(api, SafetyResult, """
+- Analyze the input dialogue and identify if the user expressed indication of self-harm, suicide, or death.
+Follow this JSON format: {"sensitive_topic": boolean}""")
+    phase_summarizer = make_summarizer(api, PhaseResult, """
+- Given a dialogue history, determine whether it is reasonable to move on to the next conversation phase.
+- Use JSON format with the following properties: key_episode, move_to_next""")
+    examples = [MapperInputOutputPair(input=make_dialogue(1),
+                                      output=PhaseResult(key_episode="fighting with a friend", move_to_next=True))]
+    params = ChatCompletionFewShotMapperParams(model="mock", api_params=ChatCompletionParams())
+
+    api.reset_usage()
+    for i in range(1, NUM_TURNS + 1):
+        await safety_summarizer.run(None, make_dialogue(i), params)
+        await phase_summarizer.run(examples, make_dialogue(i), params)
+    separate = (api.request_count, api.prompt_tokens)
+
+    fused_summarizer = FusedSummarizer()
+    api.reset_usage()
+    for i in range(1, NUM_TURNS + 1):
+        results = await fused_summarizer.run([
+            FusedSummarizerTask(name="phase", mapper=phase_summarizer, params=params, examples=examples),
+            FusedSummarizerTask(name="safety", mapper=safety_summarizer, params=params, use_shared_input=True)
+        ], make_dialogue(i, malformed=i % 10 == 0))
+        assert isinstance(results["phase"], PhaseResult) and isinstance(results["safety"], SafetyResult)
+    fused = (api.request_count, api.prompt_tokens)
+
+    print(f"Separate: {separate[0]} requests, {separate[1]} prompt tokens")
+    print(f"Fused: {fused[0]} requests, {fused[1]} prompt tokens "
+          f"({fused_summarizer.stats.fallback_rate * 100:.1f}% of tasks fell back to separate requests)")
+    assert fused[0] < separate[0] and fused[1] < separate[1]
+
+    # A fused result seeds the incremental state, so the next phase summarizer run only sends the new turns.
+    dialogue = make_dialogue(NUM_TURNS)
+    results = await fused_summarizer.run([
+        FusedSummarizerTask(name="phase", mapper=phase_summarizer, params=params, examples=examples),
+        FusedSummarizerTask(name="safety", mapper=safety_summarizer, params=params, use_shared_input=True)
+    ], dialogue)
+    state = phase_summarizer.make_incremental_summary_state(dialogue, results["phase"], params)
+    api.reset_usage()
+    output, state = await phase_summarizer.run_incremental(examples, dialogue, params, state)
+    assert api.request_count == 0 and output == results["phase"]
+    dialogue = dialogue + make_dialogue(1)
+    output, state = await phase_summarizer.run_incremental(examples, dialogue, params, state)
+    assert api.request_count == 1 and state.incremental_run_count == 1 and isinstance(output, PhaseResult)
+    print("Incremental run after a fused run sent only the new turns.")
+
+
+if __name__ == "__main__":
+    asyncio.run(measure(MockChatCompletionAPI(responder=responder)))
@@ -0,0 +1,25 @@
+import json
+
+from chatlib.chatlib.tool.converter import repair_json_str
+
+# Checks that model outputs with common JSON defects are repaired into the intended values.
+# Run from the repository root: python -m chatlib.test_json_repair
+
+CASES = [
+    ('{"a": 1, "b": [1, 2,],}', dict(a=1, b=[1, 2])),
+    ("{'a': 'it is', 'b': None, 'c': True}", dict(a="it is", b=None, c=True)),
+    ('{“a”: “hi”}', dict(a="hi")),
+    ('{‘a’: ‘hi’}', dict(a="hi")),
+    # Smart quotes inside an ASCII-quoted string are part of the content.
+    ('{"a": "he said “hi”", "b": 1,}', dict(a="he said “hi”", b=1)),
+    ("{'a': 'it’s “fine”'}", dict(a="it’s “fine”")),
+    ('{"a": "line\nbreak" // comment\n}', dict(a="line\nbreak")),
+    ('{"a": [1, {"b": "trunc', dict(a=[1, dict(b="trunc")])),
+    ('{"a": ', dict(a=None)),
+]
+
+if __name__ == "__main__":
+    for text, expected in CASES:
+        repaired = repair_json_str(text)
+        assert json.loads(repaired) == expected, (text, repaired)
+    print(f"All {len(CASES)} JSON repair cases passed.")
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import random
+import re
+from time import perf_counter
+
+from jinja2 import Template
+
+from chatlib.chatlib.chatbot import ChatCompletionParams, DialogueTurn
+from chatlib.chatlib.llm.integration import MockChatCompletionAPI
+from chatlib.chatlib.tool.converter import generate_pydantic_converter
+from chatlib.chatlib.tool.mapper import ChatGPTDialogueSummarizer, ChatDialogSummarizerParams
+from chatlib.chatlib.tool.versatile_mapper import DialogueSummarizer, ChatCompletionFewShotMapperParams, \
+    MapperInputOutputPair
+from pydantic import BaseModel
+
+# Stress test: a single summarizer instance serves many concurrent sessions.
+# The mock provider answers with the session tokens found in the instruction and in the dialogue,
+# so any cross-talk between concurrent calls shows up as a mismatch.
+# Run from the repository root: python -m chatlib.test_mapper_concurrency
+
+NUM_SESSIONS = 300
+
+session_token_pattern = re.compile(r"\[session:(\w+)]")
+
+
+class EchoResult(BaseModel):
+    instruction_session: str
+    dialogue_session: str
+
+
+class EchoParams(ChatCompletionFewShotMapperParams):
+    session: str
+
+
+async def echo_responder(model: str, messages, params: dict) -> str:
+    await asyncio.sleep(random.random() * 0.05)  # Shuffle the completion order.
+    return json.dumps(dict(instruction_session=session_token_pattern.search(messages[0].content).group(1),
+                           dialogue_session=session_token_pattern.search(messages[-1].content).group(1)))
+
+
+def make_dialogue(session: str):
+    return [DialogueTurn(message=f"Hi. [session:{session}]", is_user=False),
+            DialogueTurn(message="Hello!", is_user=True)]
+
+
+async def stress_versatile_mapper(api: MockChatCompletionAPI):
+    str_to_result, result_to_str = generate_pydantic_converter(EchoResult)
+    summarizer = DialogueSummarizer[EchoResult, EchoParams](
+        api=api,
+        instruction_generator=lambda dialogue, params: f"Summarize. [session:{params.session}]",
+        output_str_converter=result_to_str,
+        str_output_converter=str_to_result)
+
+    examples = [MapperInputOutputPair(input=make_dialogue("example"),
+                                      output=EchoResult(instruction_session="example", dialogue_session="example"))]
+
+    async def run_session(session: str):
+        result = await summarizer.run(examples, make_dialogue(session),
+                                      EchoParams(model="mock", api_params=ChatCompletionParams(), session=session))
+        return session, result
+
+    results = await asyncio.gather(*[run_session(f"s{i}") for i in range(NUM_SESSIONS)])
+    mismatches = [(session, result) for session, result in results
+                  if result.instruction_session != session or result.dialogue_session != session]
+    assert len(mismatches) == 0, f"Cross-talk detected: {mismatches[:5]}"
+
+
+async def check_ordered_run_many():
+    # The first item is slow, so every later result has to wait for it to be yielded in order.
+    concurrency, window = 8, 32
+    started: list[int] = []
+
+    async def slow_head_responder(model: str, messages, params: dict) -> str:
+        session = session_token_pattern.search(messages[-1].content).group(1)
+        started.append(int(session[1:]))
+        await asyncio.sleep(0.5 if session == "s0" else 0.001)
+        return json.dumps(dict(instruction_session=session, dialogue_session=session))
+
+    str_to_result, result_to_str = generate_pydantic_converter(EchoResult)
+    summarizer = DialogueSummarizer[EchoResult, EchoParams](
+        api=MockChatCompletionAPI(responder=slow_head_responder),
+        instruction_generator=lambda dialogue, params: "Summarize.",
+        output_str_converter=result_to_str,
+        str_output_converter=str_to_result)
+
+    inputs = [make_dialogue(f"s{i}") for i in range(NUM_SESSIONS)]
+    params = EchoParams(model="mock", api_params=ChatCompletionParams(), session="")
+    index = 0
+    async for result in summarizer.run_many(None, inputs, params, concurrency=concurrency, reorder_window=window):
+        assert result.index == index and result.output.dialogue_session == f"s{index}", result
+        assert max(started) < index + window, f"{max(started)} started while yielding {index}"
+        index += 1
+    assert index == NUM_SESSIONS
+
+
+async def stress_legacy_mapper(api: MockChatCompletionAPI):
+    summarizer = ChatGPTDialogueSummarizer(
+        base_instruction=Template("Summarize. [session:{{session}}]"),
+        model="mock",
+        api=api)
+
+    async def run_session(session: str):
+        result = await summarizer.run(make_dialogue(session),
+                                      ChatDialogSummarizerParams(instruction_params=dict(session=session)))
+        return session, result
+
+    results = await asyncio.gather(*[run_session(f"s{i}") for i in range(NUM_SESSIONS)])
+    mismatches = [(session, result) for session, result in results
+                  if result["instruction_session"] != session or result["dialogue_session"] != session]
+    assert len(mismatches) == 0, f"Cross-talk detected: {mismatches[:5]}"
+
+
+if __name__ == "__main__":
+    async def run():
+        api = MockChatCompletionAPI(responder=echo_responder)
+
+        start_ts = perf_counter()
+        await stress_versatile_mapper(api)
+        await stress_legacy_mapper(api)
+        await check_ordered_run_many()
+        end_ts = perf_counter()
+
+        print(f"{api.request_count} requests over {NUM_SESSIONS} concurrent sessions without cross-talk. "
+              f"Elapsed time: {int((end_ts - start_ts) * 1000)} millis.")
+
+    asyncio.run(run())
@@ -0,0 +1,94 @@
+import copy
+
+from chatlib.chatlib.chatbot.message_transformer import SpecialTokenExtractionTransformer, \
+    SpecialTokenListExtractionTransformer, compile_message_transformer_chain, run_message_transformer_chain
+from chatlib.chatlib.utils import dict_utils
+
+# Runs the compiled single-pass chains and the sequential chains on the same messages, and checks that they give the
+# same messages and metadata, and that the streamed deltas add up to the message.
+# Run from the repository root: python -m chatlib.test_message_transformers
+
+SPECIAL_TOKEN_REGEX = r"<\|[a-zA-Z0-9-_]+\|>"
+PHASE_TOKENS = ["<|Explore|>", "<|Label|>"]
+
+
+def on_phase_tokens_found(tokens: list[str], original_message: str, cleaned_message: str, metadata: dict | None):
+    for token in tokens:
+        metadata = dict_utils.set_nested_value(metadata, ["phase", token], True)
+    metadata = dict_utils.set_nested_value(metadata, "token_uncleaned_message", original_message)
+    return cleaned_message, metadata
+
+
+def on_terminate_found(cleaned_message: str, metadata: dict | None):
+    return cleaned_message.strip(), dict_utils.set_nested_value(metadata, "terminate", True)
+
+
+def make_chains():
+    return dict(
+        regex=[SpecialTokenExtractionTransformer.remove_all_regex("clean_special_tokens", SPECIAL_TOKEN_REGEX)],
+        token_list=[SpecialTokenListExtractionTransformer("special_tokens", PHASE_TOKENS, on_phase_tokens_found)],
+        token_list_then_regex=[
+            SpecialTokenListExtractionTransformer("special_tokens", PHASE_TOKENS, on_phase_tokens_found),
+            SpecialTokenExtractionTransformer.remove_all_regex("clean_special_tokens", SPECIAL_TOKEN_REGEX)],
+        callback_then_regex=[
+            SpecialTokenExtractionTransformer("terminate", "<|Terminate|>", on_terminate_found),
+            SpecialTokenExtractionTransformer.remove_all_regex("clean_special_tokens", SPECIAL_TOKEN_REGEX)],
+        overlapping=[SpecialTokenExtractionTransformer("bc", "bc"), SpecialTokenExtractionTransformer("ab", "ab")],
+    )
+
+
+MESSAGES = [
+    "",
+    "Hello, how was your day?",
+    "Tell me more about it. <|Explore|>",
+    "<|Explore|>",
+    "<|Label|><|Explore|>",
+    "<|Label|> So you felt upset. <|Label|> <|Other|>",
+    "Let's wrap up here. <|Terminate|>",
+    "<|Terminate|>",
+    "abc abd",
+    "<|Ex<|Label|>plore|> hi",  # A token formed by removing another one
+]
+
+# Messages whose streamed deltas cannot add up to the message, as a removal in the middle forms a token.
+UNSTREAMABLE_MESSAGES = ["<|Ex<|Label|>plore|> hi"]
+STREAM_CHUNK_SIZE = 3
+
+
+def check_same_results():
+    num_cases = 0
+    for name, chain in make_chains().items():
+        compiled = compile_message_transformer_chain(chain)
+        assert compiled is not None, name
+        for message in MESSAGES:
+            for metadata in [None, dict(existing=True, transformers=dict(earlier=True))]:
+                expected = run_message_transformer_chain(message, copy.deepcopy(metadata), chain)
+                actual = run_message_transformer_chain(message, copy.deepcopy(metadata), compiled)
+                assert actual == expected, (name, message, actual, expected)
+                num_cases += 1
+    print(f"All {num_cases} compiled chain cases matched the sequential chains.")
+
+
+def check_streamed_deltas():
+    num_cases = 0
+    for name, chain in make_chains().items():
+        if name in ["callback_then_regex", "overlapping"]:
+            continue
+        compiled = compile_message_transformer_chain(chain)
+        for message in MESSAGES:
+            if message in UNSTREAMABLE_MESSAGES:
+                continue
+            stream = compiled.stream()
+            deltas = [stream.feed(message[i:i + STREAM_CHUNK_SIZE])
+                      for i in range(0, len(message), STREAM_CHUNK_SIZE)]
+            last_delta, cleaned_message, metadata = stream.close()
+            expected = run_message_transformer_chain(message, None, chain)
+            assert (cleaned_message, metadata) == expected, (name, message)
+            assert "".join(deltas) + last_delta == cleaned_message, (name, message, deltas, last_delta)
+            num_cases += 1
+    print(f"All {num_cases} streamed messages added up to the cleaned messages.")
+
+
+if __name__ == "__main__":
+    check_same_results()
+    check_streamed_deltas()
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+from time import time, perf_counter
+from uuid import uuid4
+
+from chatlib.chatlib.chatbot import TurnTakingChatSession, DialogueTurn, ResponseGenerator, Dialogue
+from chatlib.chatlib.chatbot.async_session_writer import get_async_session_writer
+from chatlib.chatlib.chatbot.session_cache import ChatSessionCache, ChatSessionCacheStats
+from chatlib.chatlib.chatbot.session_lease import SqliteSessionLeaseManager
+from chatlib.chatlib.chatbot.session_writer import WriteBehindSessionWriter, SessionWriteDurability
+from chatlib.chatlib.chatbot.sqlite_session_writer import SqliteSessionWriter
+
+# Serves chat requests on a shared set of sessions from several worker processes that share a SQLite store,
+# the way backend/routers/chat.py does with SESSION_STORE=sqlite, and checks that no turn is lost on handoffs.
+# A worker that serves a session last changed by another worker reloads it from the store. With random routing, most
+# requests are such handoffs. With sticky routing, as a load balancer that hashes the session ID does, each session has
+# a home worker and only SESSION_AFFINITY_MISS_RATE of the requests go elsewhere.
+# Run from the repository root: python -m chatlib.test_multi_worker_sessions
+
+NUM_SESSIONS = 40
+NUM_REQUESTS = 1280
+CONCURRENT_REQUESTS_PER_WORKER = 8
+RESPONSE_CPU_MILLIS = 2  # Prompt rendering and response parsing, which hold the worker's event loop
+SESSION_AFFINITY_MISS_RATE = 0.05
+
+
+class BusyEchoResponseGenerator(ResponseGenerator):
+
+    async def _get_response_impl(self, dialog: Dialogue, dry: bool = False) -> tuple[str, dict | None]:
+        start = perf_counter()
+        while perf_counter() - start < RESPONSE_CPU_MILLIS / 1000:
+            pass
+        await asyncio.sleep(0.005)  # The LLM request
+        return f"Echo: {dialog[-1].message if len(dialog) > 0 else 'Hello'}", None
+
+    def write_to_json(self, parcel: dict):
+        pass
+
+    def restore_from_json(self, parcel: dict):
+        pass
+
+
+async def serve(db_path: str, worker_index: int, num_workers: int, num_requests: int,
+                sticky: bool) -> tuple[dict[str, int], ChatSessionCacheStats, list[float]]:
+    writer = WriteBehindSessionWriter(SqliteSessionWriter(db_path), durability=SessionWriteDurability.Flush)
+    async_writer = get_async_session_writer(writer)
+    lease_manager = SqliteSessionLeaseManager(db_path)
+    cache: ChatSessionCache[TurnTakingChatSession] = ChatSessionCache(save_on_hibernate=False)
+    num_messages: dict[str, int] = dict()
+    reload_times: list[float] = []
+
+    async def handle_request(session_id: str, message: str):
+        async with lease_manager.hold(session_id, f"worker_{worker_index}:{uuid4().hex[:8]}") as lease:
+            with cache.pin(session_id):
+                session = await cache.get(session_id, lease.version)
+                if session is None:
+                    session = TurnTakingChatSession(session_id, BusyEchoResponseGenerator(), writer)
+                    start = perf_counter()
+                    if await session.load_async():
+                        reload_times.append(perf_counter() - start)
+                    else:
+                        await session.initialize()
+                    await cache.put(session_id, session, lease.version)
+                await session.push_user_message(DialogueTurn(message=message, is_user=True))
+                await async_writer.flush(session_id)
+        cache.update_version(session_id, lease.released_version)
+        num_messages[session_id] = num_messages.get(session_id, 0) + 1
+
+    home_session_indices = [i for i in range(NUM_SESSIONS) if i % num_workers == worker_index]
+
+    async def client(request_indices: range):
+        for i in request_indices:
+            if sticky and random.random() >= SESSION_AFFINITY_MISS_RATE:
+                session_index = random.choice(home_session_indices)
+            else:
+                session_index = random.randrange(NUM_SESSIONS)
+            await handle_request(f"session_{session_index}", f"Message {worker_index}-{i}")
+
+    per_client = num_requests // CONCURRENT_REQUESTS_PER_WORKER
+    await asyncio.gather(*[client(range(c * per_client, (c + 1) * per_client))
+                           for c in range(CONCURRENT_REQUESTS_PER_WORKER)])
+    await cache.clear()
+    async_writer.shutdown()
+    writer.close()
+    return num_messages, cache.stats, reload_times
+
+
+def run_worker(db_path: str, worker_index: int, num_workers: int, sticky: bool, results: multiprocessing.Queue):
+    start_ts = time()
+    num_messages, stats, reload_times = asyncio.run(serve(db_path, worker_index, num_workers,
+                                                          NUM_REQUESTS // num_workers, sticky))
+    results.put((start_ts, time(), num_messages, stats.hits, stats.misses, reload_times))
+
+
+def run(db_path: str, num_workers: int, sticky: bool) -> dict[str, int]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=run_worker, args=(db_path, i, num_workers, sticky, results))
+                 for i in range(num_workers)]
+    for process in processes:
+        process.start()
+    outputs = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    elapsed = max([output[1] for output in outputs]) - min([output[0] for output in outputs])
+    hits = sum([output[3] for output in outputs])
+    misses = sum([output[4] for output in outputs])
+    reload_times = [t for output in outputs for t in output[5]]
+    print(f"{num_workers} worker(s), {'sticky' if sticky else 'random'} routing: {NUM_REQUESTS / elapsed:.1f} "
+          f"requests/sec, cache hit rate {hits / (hits + misses) * 100:.1f}%, {len(reload_times)} reloads from the "
+          f"store taking {sum(reload_times) / max(1, len(reload_times)) * 1000:.2f} ms on average")
+    num_messages = dict()
+    for output in outputs:
+        for session_id, count in output[2].items():
+            num_messages[session_id] = num_messages.get(session_id, 0) + count
+    return num_messages
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp()
+    try:
+        for num_workers, sticky in [(1, False), (4, False), (4, True)]:
+            db_path = os.path.join(work_dir, f"sessions_{num_workers}_{sticky}.db")
+            num_messages = run(db_path, num_workers, sticky)
+            store = SqliteSessionWriter(db_path)
+            for session_id, count in num_messages.items():
+                dialogue = store.read_dialogue(session_id)
+                # The initial system message and a pair of turns for each user message
+                assert len(dialogue) == 1 + count * 2, (session_id, len(dialogue), count)
+                assert all([turn.is_user == (i % 2 == 1) for i, turn in enumerate(dialogue)])
+                assert store.read_session_info(session_id)["turns"] == len(dialogue)
+            print(f"{num_workers} worker(s): all {sum(num_messages.values())} messages were stored in order.")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+from chatlib.chatlib.chatbot import TurnTakingChatSession, DialogueTurn, ResponseGenerator, Dialogue
+from chatlib.chatlib.chatbot.session_cache import ChatSessionCache
+from chatlib.chatlib.chatbot.session_writer import SessionFileWriter
+
+# Serves a skewed stream of requests over many sessions through a bounded session cache,
+# and checks that hibernated sessions are restored with their dialogues intact.
+# Run from the repository root: python -m chatlib.test_session_cache
+
+NUM_SESSIONS = 500
+NUM_REQUESTS = 5000
+MAX_SESSIONS = 50
+
+
+class EchoResponseGenerator(ResponseGenerator):
+
+    def __init__(self):
+        super().__init__()
+        self.num_responses = 0
+
+    async def _get_response_impl(self, dialog: Dialogue, dry: bool = False) -> tuple[str, dict | None]:
+        self.num_responses += 1
+        return f"Echo: {dialog[-1].message if len(dialog) > 0 else 'Hello'}", None
+
+    def write_to_json(self, parcel: dict):
+        parcel["num_responses"] = self.num_responses
+
+    def restore_from_json(self, parcel: dict):
+        self.num_responses = parcel.get("num_responses", 0)
+
+
+class CountingSessionFileWriter(SessionFileWriter):
+    """
+    Counts the session info writes made on the event loop thread, which only a collected session makes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.num_blocking_info_writes = 0
+
+    def write_session_info(self, session_id, session_info: dict):
+        if threading.current_thread() is threading.main_thread():
+            self.num_blocking_info_writes += 1
+        super().write_session_info(session_id, session_info)
+
+
+async def serve(cache: ChatSessionCache[TurnTakingChatSession], writer: SessionFileWriter):
+    num_turns: dict[str, int] = dict()
+    for i in range(NUM_REQUESTS):
+        # A few sessions are busy and most are visited rarely.
+        session_id = f"session_{min(int(random.expovariate(1 / 40)), NUM_SESSIONS - 1)}"
+        session = await cache.get(session_id)
+        if session is None:
+            session = TurnTakingChatSession(session_id, EchoResponseGenerator(), writer)
+            if not await session.load_async():
+                await session.initialize()
+            await cache.put(session_id, session)
+        await session.push_user_message(DialogueTurn(message=f"Message {i}", is_user=True))
+        num_turns[session_id] = num_turns.get(session_id, 1) + 2
+        assert len(session.dialog) == num_turns[session_id]
+        assert cache.stats.size <= MAX_SESSIONS
+    return num_turns
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        cache = ChatSessionCache(max_sessions=MAX_SESSIONS)
+        writer = CountingSessionFileWriter()
+        num_turns = asyncio.run(serve(cache, writer))
+        print(cache.stats)
+        assert cache.stats.evictions > 0
+        # The hibernated sessions were saved on the I/O threads and never again when collected.
+        assert writer.num_blocking_info_writes == 0, writer.num_blocking_info_writes
+        print(f"{len(num_turns)} sessions served by at most {MAX_SESSIONS} sessions in memory.")
+        asyncio.run(cache.clear())
+        assert writer.num_blocking_info_writes == 0, writer.num_blocking_info_writes
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
@@ -0,0 +1,115 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+from os import path
+from time import perf_counter
+
+from chatlib.chatlib.chatbot import DialogueTurn
+from chatlib.chatlib.chatbot.session_writer import SessionFileWriter, SessionWriterBase, migrate_to_sharded_layout
+from chatlib.chatlib.chatbot.sqlite_session_writer import SqliteSessionWriter, migrate_session_files
+
+# Compares write throughput and point-lookup latency of the file writer and the SQLite writer.
+# Run from the repository root: python -m chatlib.test_session_writers
+
+NUM_SESSIONS = 10000
+TURNS_PER_SESSION = 6
+NUM_LOOKUPS = 2000
+
+
+def make_session_info(session_id: str, num_turns: int) -> dict:
+    return dict(id=session_id, turns=num_turns,
+                response_generator=dict(state_snapshot=dict(state="explore", entry_payload=None), verbose=False,
+                                        payload_memory=dict()))
+
+
+def write_sessions(writer: SessionWriterBase, session_ids: list[str]) -> float:
+    start_ts = perf_counter()
+    for session_id in session_ids:
+        # Mirrors ChatSessionBase, which saves the session info after every turn.
+        for i in range(TURNS_PER_SESSION):
+            writer.write_turn(session_id, DialogueTurn(message=f"Message {i} of {session_id}", is_user=i % 2 == 1))
+            writer.write_session_info(session_id, make_session_info(session_id, i + 1))
+    return perf_counter() - start_ts
+
+
+def look_up_sessions(writer: SessionWriterBase, session_ids: list[str]) -> float:
+    start_ts = perf_counter()
+    for session_id in session_ids:
+        writer.read_session_info(session_id)
+        assert len(writer.read_dialogue(session_id)) == TURNS_PER_SESSION
+    return perf_counter() - start_ts
+
+
+def check_in_place_session_info_changes():
+    writer = SessionFileWriter()
+    session_info = make_session_info("in_place", 1)
+    writer.write_session_info("in_place", session_info)
+    # Sessions change nested values of their info in place between saves.
+    session_info["response_generator"]["state_snapshot"]["entry_payload"] = dict(key_episode="exam")
+    session_info["response_generator"]["payload_memory"]["explore"] = dict(revisited=True)
+    writer.write_session_info("in_place", session_info)
+    session_info["response_generator"]["payload_memory"]["explore"]["revisited"] = False
+    writer.write_session_info("in_place", session_info)
+
+    reread_info = SessionFileWriter().read_session_info("in_place")
+    assert reread_info == session_info, reread_info
+    print("Session info changed in place was read back intact.")
+
+
+def check_sharded_layout_migration():
+    # A flat sessions directory, with one session whose info was never written.
+    for session_id, has_info in [("flat_with_info", True), ("flat_without_info", False)]:
+        dir_path = path.join(os.getcwd(), "data/sessions", session_id)
+        os.makedirs(dir_path)
+        with open(path.join(dir_path, "dialogue.jsonl"), "w") as f:
+            f.write(json.dumps(DialogueTurn(message=f"Hello from {session_id}", is_user=False).__dict__) + "\n")
+        if has_info:
+            with open(path.join(dir_path, "info.json"), "w") as f:
+                json.dump(make_session_info(session_id, 1), f)
+
+    assert migrate_to_sharded_layout() == 2
+    writer = SessionFileWriter()
+    assert sorted(writer.list_session_ids()) == ["flat_with_info", "flat_without_info"]
+    assert writer.read_dialogue("flat_without_info")[0].message == "Hello from flat_without_info"
+    assert writer.read_session_info("flat_with_info")["turns"] == 1
+    print("Migrated a flat sessions directory into the sharded layout.")
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        session_ids = [f"session_{i}" for i in range(NUM_SESSIONS)]
+        lookup_ids = random.sample(session_ids, NUM_LOOKUPS)
+        num_writes = NUM_SESSIONS * TURNS_PER_SESSION * 2
+
+        file_writer = SessionFileWriter()
+        sqlite_writer = SqliteSessionWriter(path.join(work_dir, "sessions.db"))
+
+        for name, writer in [("File", file_writer), ("SQLite", sqlite_writer)]:
+            write_time = write_sessions(writer, session_ids)
+            lookup_time = look_up_sessions(writer, lookup_ids)
+            print(f"{name}: {int(num_writes / write_time)} writes/sec, "
+                  f"{lookup_time / NUM_LOOKUPS * 1000:.3f} millis per session lookup")
+
+        with sqlite_writer.batch():
+            write_time = write_sessions(sqlite_writer, [f"batched_{i}" for i in range(NUM_SESSIONS)])
+        print(f"SQLite (single batch): {int(num_writes / write_time)} writes/sec")
+
+        migrated_writer = SqliteSessionWriter(path.join(work_dir, "migrated.db"))
+        start_ts = perf_counter()
+        num_migrated = migrate_session_files(file_writer, migrated_writer)
+        assert num_migrated == NUM_SESSIONS
+        assert migrated_writer.read_dialogue(lookup_ids[0]) == file_writer.read_dialogue(lookup_ids[0])
+        print(f"Migrated {num_migrated} sessions in {perf_counter() - start_ts:.1f} secs.")
+
+        check_in_place_session_info_changes()
+
+        os.chdir(tempfile.mkdtemp(dir=work_dir))
+        check_sharded_layout_migration()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
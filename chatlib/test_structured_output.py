@@ -0,0 +1,69 @@
+from pydantic import BaseModel
+
+from chatlib.chatlib.tool.structured_output import make_structured_output_json_schema, IncrementalJsonValidator
+
+# Checks the strict JSON schemas derived from pydantic models, and that outputs of the models pass the validator.
+# Run from the repository root: python -m chatlib.test_structured_output
+
+
+class Emotion(BaseModel):
+    emotion: str
+    reason: str | None = None
+    default: bool = False  # A field named like the JSON schema keyword
+
+
+class Result(BaseModel):
+    key_episode: str | None = None
+    emotions: list[Emotion] = []
+    default: str = "none"
+    properties: dict[str, int] = dict()
+
+
+def find_defaults(node, path: str = "") -> list[str]:
+    """
+    :return: Paths of the "default" keywords left in the schema nodes.
+    """
+    found = []
+    if isinstance(node, dict):
+        for key, value in node.items():
+            # A "default" under "properties" is a field name, not the keyword.
+            if key == "default" and not path.endswith("/properties"):
+                found.append(path)
+            found.extend(find_defaults(value, f"{path}/{key}"))
+    elif isinstance(node, list):
+        for i, value in enumerate(node):
+            found.extend(find_defaults(value, f"{path}/{i}"))
+    return found
+
+
+def check_schema():
+    schema = make_structured_output_json_schema(Result)
+    assert find_defaults(schema) == [], find_defaults(schema)
+
+    assert list(schema["properties"].keys()) == ["key_episode", "emotions", "default", "properties"]
+    assert schema["required"] == ["key_episode", "emotions", "default", "properties"]
+    assert schema["additionalProperties"] is False
+
+    emotion_schema = schema["$defs"]["Emotion"]
+    assert list(emotion_schema["properties"].keys()) == ["emotion", "reason", "default"]
+    assert emotion_schema["required"] == ["emotion", "reason", "default"]
+    assert emotion_schema["additionalProperties"] is False
+    assert dict(type="null") in emotion_schema["properties"]["reason"]["anyOf"]
+    print("The strict schema keeps the fields named like schema keywords and drops the defaults.")
+
+
+def check_validation():
+    schema = make_structured_output_json_schema(Result)
+    result = Result(key_episode="a fight", emotions=[Emotion(emotion="sad", default=True)], default="x",
+                    properties=dict(a=1))
+    validator = IncrementalJsonValidator(schema)
+    text = result.model_dump_json()
+    for i in range(0, len(text), 7):
+        validator.feed(text[i:i + 7])
+    assert validator.is_complete
+    print("An output of the model passed the validator in chunks.")
+
+
+if __name__ == "__main__":
+    check_schema()
+    check_validation()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from enum import StrEnum
+from time import perf_counter, process_time
+from typing import AsyncIterator, Callable
+from uuid import uuid4
+
+from starlette.testclient import TestClient
+
+from app.common import ChatbotLocale, SPECIAL_TOKEN_REGEX
+from backend.routers import chat
+from backend.server import app
+from chatlib.chatlib.chatbot import ChatCompletionResponseGenerator, ResponseGenerator, Dialogue
+from chatlib.chatlib.chatbot.generators import StateBasedResponseGenerator
+from chatlib.chatlib.chatbot.message_transformer import SpecialTokenExtractionTransformer
+from chatlib.chatlib.llm.chat_completion_api import ChatCompletionMessage, ChatCompletionResult, \
+    ChatCompletionFinishReason
+from chatlib.chatlib.llm.integration import MockChatCompletionAPI
+
+# Serves the same conversations through the REST APIs and through the WebSocket of a session, and compares the
+# client-perceived latency and the CPU time per turn. The chatbot is replaced with a two-phase mock whose completions
+# are streamed in small deltas, like those of the LLM providers. Both transports run in this process.
+# Run from the repository root: python compare_chat_transports.py
+
+NUM_CLIENTS = 16
+TURNS_PER_CLIENT = 20
+FIRST_DELTA_LATENCY = 0.3
+DELTA_INTERVAL = 0.02
+STREAM_CHUNK_SIZE = 4
+COMPLETION = ("That sounds like it was a long day. What was the moment that stayed with you the most, "
+              "and how did you feel right after it? <|Explore|>")
+
+
+class PacedMockChatCompletionAPI(MockChatCompletionAPI):
+    """
+    Takes as long as a provider generating the completion chunk by chunk, whether streamed or not.
+    """
+
+    def __init__(self):
+        super().__init__(responder=lambda model, messages, params: COMPLETION, latency=FIRST_DELTA_LATENCY,
+                         stream_chunk_size=STREAM_CHUNK_SIZE)
+
+    async def _run_chat_completion_impl(self, model: str, messages: list[ChatCompletionMessage],
+                                        params: dict) -> ChatCompletionResult:
+        await asyncio.sleep(DELTA_INTERVAL * (len(COMPLETION) // STREAM_CHUNK_SIZE))
+        return await super()._run_chat_completion_impl(model, messages, params)
+
+    async def run_chat_completion_stream(self, model: str, messages: list[ChatCompletionMessage],
+                                         params: dict,
+                                         on_finish_reason: Callable[[ChatCompletionFinishReason], None] | None = None
+                                         ) -> AsyncIterator[str]:
+        async for delta in super().run_chat_completion_stream(model, messages, params, on_finish_reason):
+            yield delta
+            await asyncio.sleep(DELTA_INTERVAL)
+
+
+api = PacedMockChatCompletionAPI()
+
+
+class MockPhase(StrEnum):
+    Greet = "greet"
+    Talk = "talk"
+
+
+class MockChatbotResponseGenerator(StateBasedResponseGenerator[MockPhase]):
+
+    def __init__(self, user_name: str | None = None, user_age: int | None = None,
+                 locale: ChatbotLocale = ChatbotLocale.Korean):
+        super().__init__(initial_state=MockPhase.Greet, message_transformers=[
+            SpecialTokenExtractionTransformer.remove_all_regex("clean_special_tokens", SPECIAL_TOKEN_REGEX)])
+        self.user_name = user_name
+        self.user_age = user_age
+        self.locale = locale
+        self.__generator = ChatCompletionResponseGenerator(api, "mock", base_instruction="You are a friendly chatbot.")
+
+    def get_generator(self, state: MockPhase, payload: dict | None) -> ResponseGenerator:
+        return self.__generator
+
+    def update_generator(self, generator: ResponseGenerator, payload: dict | None):
+        pass
+
+    async def calc_next_state_info(self, current: MockPhase, dialog: Dialogue) -> tuple[
+                                                                                      MockPhase | None, dict | None] | None:
+        if current == MockPhase.Greet and len(dialog) >= 3:
+            return MockPhase.Talk, dict(num_turns=len(dialog))
+        return None
+
+    def write_to_json(self, parcel: dict):
+        super().write_to_json(parcel)
+        parcel["user_name"] = self.user_name
+        parcel["user_age"] = self.user_age
+        parcel["locale"] = self.locale
+
+    def restore_from_json(self, parcel: dict):
+        self.user_name = parcel["user_name"]
+        self.user_age = parcel["user_age"]
+        self.locale = parcel["locale"]
+        super().restore_from_json(parcel)
+
+
+def initialize_session(client: TestClient) -> str:
+    session_id = uuid4().hex
+    response = client.post(f"/api/v1/chat/sessions/{session_id}/initialize",
+                           json=dict(user_name="Tester", user_age=12, locale=ChatbotLocale.English))
+    assert response.status_code == 200, response.text
+    return session_id
+
+
+def converse_rest(client: TestClient, session_id: str) -> list[tuple[float, float]]:
+    latencies = []
+    for i in range(TURNS_PER_CLIENT):
+        start = perf_counter()
+        response = client.post(f"/api/v1/chat/sessions/{session_id}/message",
+                               json=dict(id=uuid4().hex, message=f"Message {i}", is_user=True, timestamp=0))
+        elapsed = perf_counter() - start
+        assert response.status_code == 200 and response.json()["message"] == COMPLETION[:COMPLETION.index("<|")]
+        # Nothing is shown until the whole response arrives.
+        latencies.append((elapsed, elapsed))
+    return latencies
+
+
+def converse_websocket(client: TestClient, session_id: str) -> list[tuple[float, float]]:
+    latencies = []
+    with client.websocket_connect(f"/api/v1/chat/sessions/{session_id}/ws") as websocket:
+        for i in range(TURNS_PER_CLIENT):
+            message_id = uuid4().hex
+            start = perf_counter()
+            websocket.send_json(dict(type="message", id=message_id, message=f"Message {i}"))
+            first_delta = None
+            deltas = []
+            while (event := websocket.receive_json())["type"] != "turn":
+                assert event["type"] in ["delta", "state"] and event["reply_to"] == message_id, event
+                if event["type"] == "delta":
+                    first_delta = first_delta or perf_counter() - start
+                    deltas.append(event["delta"])
+            assert "".join(deltas) == event["turn"]["message"] == COMPLETION[:COMPLETION.index("<|")]
+            latencies.append((first_delta, perf_counter() - start))
+    return latencies
+
+
+def run(client: TestClient, converse) -> str:
+    session_ids = [initialize_session(client) for _ in range(NUM_CLIENTS)]
+    cpu_start = process_time()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=NUM_CLIENTS) as executor:
+        latencies = [latency for result in executor.map(lambda s: converse(client, s), session_ids)
+                     for latency in result]
+    elapsed = perf_counter() - start
+    cpu_elapsed = process_time() - cpu_start
+    num_turns = len(latencies)
+    return (f"{num_turns / elapsed:.1f} turns/sec, "
+            f"first text after {sum([l[0] for l in latencies]) / num_turns * 1000:.1f} ms, "
+            f"whole turn after {sum([l[1] for l in latencies]) / num_turns * 1000:.1f} ms, "
+            f"CPU {cpu_elapsed / num_turns * 1000:.2f} ms/turn")
+
+
+if __name__ == "__main__":
+    chat.EmotionChatbotResponseGenerator = MockChatbotResponseGenerator
+
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with TestClient(app) as client:
+            print(f"{NUM_CLIENTS} clients x {TURNS_PER_CLIENT} turns, {len(COMPLETION) // STREAM_CHUNK_SIZE} deltas "
+                  f"every {DELTA_INTERVAL * 1000:.0f} ms after {FIRST_DELTA_LATENCY * 1000:.0f} ms")
+            print(f"REST:      {run(client, converse_rest)}")
+            print(f"WebSocket: {run(client, converse_websocket)}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
@@ -1,5 +1,8 @@
+from os import getenv
+
 bind = "0.0.0.0:3000"
-workers = 1
+# More than one worker requires the SQLite session store (SESSION_STORE=sqlite), which the workers share.
+workers = int(getenv("BACKEND_WORKERS", 1))
 proc_name = "chacha_backend"
 reload = False
 worker_class = "uvicorn.workers.UvicornWorker"
@@ -0,0 +1,13 @@
+import argparse
+from os import path, getcwd
+
+from chatlib.chatlib.chatbot.session_writer import migrate_to_sharded_layout
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move the session directories under data/sessions/ and the archives under data/archive/ "
+                    "into the sharded layout, and build the session manifest. Stop the server before running this.")
+    parser.parse_args()
+
+    num_migrated = migrate_to_sharded_layout()
+    print(f"Moved {num_migrated} session(s) into the sharded layout under {path.join(getcwd(), 'data/sessions/')}.")
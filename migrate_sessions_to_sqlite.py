@@ -0,0 +1,25 @@
+import argparse
+from os import path, getcwd
+
+from chatlib.chatlib.chatbot.session_writer import SessionFileWriter
+from chatlib.chatlib.chatbot.sqlite_session_writer import SqliteSessionWriter, migrate_session_files
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy the sessions stored under data/sessions/ into a SQLite database. "
+                    "Run the server with SESSION_STORE=sqlite to use the database afterwards.")
+
+    parser.add_argument('-db', '--db', dest="db", type=str, default=path.join(getcwd(), "data/sessions.db"),
+                        help="Path of the database file.")
+    parser.add_argument('-sessions', '--sessions', dest="sessions", nargs="*", type=str,
+                        help="Session IDs to migrate. All stored sessions if omitted.")
+    parser.add_argument('-batch', '--batch', dest="batch", type=int, default=100,
+                        help="Number of sessions committed per transaction.")
+    parser.add_argument('--overwrite', dest="overwrite", action="store_true",
+                        help="Replace sessions that already exist in the database.")
+
+    args = parser.parse_args()
+
+    num_migrated = migrate_session_files(SessionFileWriter(), SqliteSessionWriter(args.db), args.sessions,
+                                         batch_size=args.batch, overwrite=args.overwrite)
+    print(f"Migrated {num_migrated} session(s) into {args.db}.")